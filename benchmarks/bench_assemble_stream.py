@@ -0,0 +1,80 @@
+"""
+Peak memory and time assembling large machine-generated assembly from a file,
+with assemble() (reading the whole text in) and assemble_stream(). Each run
+happens in a fresh process, so its peak RSS is its own.
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from yaksh.bytecode_compiler import assemble, assemble_stream
+
+
+SIZES = (10000, 100000, 300000)
+
+
+def write_asm(path, num_functions):
+    with open(path, 'w') as f:
+        for i in xrange(num_functions):
+            f.write("PROC\n.line %d\nSTORE_VAR 0\nLOAD_LOCAL 0\nJZ _zero\n"
+                    "LOAD_CONST 'value %d'\nCALL_BUILTIN 0\n"
+                    "_zero: LOAD_CONST %d\nRETN\nMAKE_FUNCTION\n" % (i, i, i))
+        for i in xrange(num_functions):
+            f.write('LOAD_CONST %d\nCALL %d\n' % (i % 2, i))
+
+
+def run(mode, asm_path, out_path):
+    start = time.time()
+    with open(out_path, 'wb') as out:
+        if mode == 'assemble':
+            with open(asm_path) as f:
+                out.write(assemble(f.read()))
+        else:
+            with open(asm_path) as f:
+                assemble_stream(f, out)
+    elapsed = time.time() - start
+    # ru_maxrss is in KB on Linux
+    print elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(mode, asm_path, out_path):
+    output = subprocess.check_output([
+        sys.executable, '-m', 'benchmarks.bench_assemble_stream', mode,
+        asm_path, out_path])
+    elapsed, max_rss = output.split()
+    return float(elapsed), int(max_rss) / 1024.0
+
+
+def main():
+    print '%10s %10s %14s %14s %14s %14s' % (
+        'functions', 'asm (MB)', 'assemble s', 'assemble MB', 'stream s',
+        'stream MB')
+    fd, asm_path = tempfile.mkstemp(suffix='.yasm')
+    os.close(fd)
+    fd, out_path = tempfile.mkstemp(suffix='.ysh')
+    os.close(fd)
+    try:
+        for num_functions in SIZES:
+            write_asm(asm_path, num_functions)
+            size = os.path.getsize(asm_path) / 1e6
+            in_memory = measure('assemble', asm_path, out_path)
+            with open(out_path, 'rb') as f:
+                expected = f.read()
+            streamed = measure('stream', asm_path, out_path)
+            with open(out_path, 'rb') as f:
+                assert f.read() == expected
+            print '%10d %10.1f %14.2f %14.1f %14.2f %14.1f' % (
+                (num_functions, size) + in_memory + streamed)
+    finally:
+        os.unlink(asm_path)
+        os.unlink(out_path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        run(*sys.argv[1:])
+    else:
+        main()
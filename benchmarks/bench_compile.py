@@ -0,0 +1,63 @@
+"""
+Compile time of large sources, assembling the generator's in-memory assembly
+directly versus round-tripping it through textual assembly.
+"""
+import time
+
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import assemble
+from yaksh.lexer import lex
+from yaksh.parser import parse
+
+
+NUM_FUNCTIONS = (100, 1000, 5000)
+
+FUNCTION = '''
+def f%d(a, b):
+    c = a * 2 + b
+    if c > 10:
+        c = c - 10
+    elif c < 0:
+        c = 0 - c
+    else:
+        print('small')
+    return c + %d
+'''
+
+
+def program(num_functions):
+    source = [FUNCTION % (i, i) for i in xrange(num_functions)]
+    source.append('print(f%d(1, 2))' % (num_functions - 1))
+    return parse(lex(''.join(source)))
+
+
+def best_of(f, *args):
+    best = None
+    for _ in xrange(3):
+        start = time.time()
+        f(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def direct(symbols):
+    return assemble(BytecodeAssemblyGenerator(symbols).generate())
+
+
+def via_text(symbols):
+    return assemble(str(BytecodeAssemblyGenerator(symbols).generate()))
+
+
+def main():
+    print '%10s %12s %12s' % ('functions', 'direct (ms)', 'text (ms)')
+    for num_functions in NUM_FUNCTIONS:
+        symbols = program(num_functions)
+        print '%10d %12.1f %12.1f' % (num_functions,
+                                      best_of(direct, symbols) * 1000,
+                                      best_of(via_text, symbols) * 1000)
+
+
+if __name__ == '__main__':
+    main()
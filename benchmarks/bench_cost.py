@@ -0,0 +1,54 @@
+"""
+Calibrates the cost estimator's opcode timings on this machine, then checks
+the run times it estimates against those measured. The programs print, and
+print is costed as a call, so they run somewhat over their estimates.
+"""
+from yaksh.bytecode_compiler import Instr
+from yaksh.cost import TIMINGS, calibrate, estimate
+from yaksh.vm import AbstractMachine
+
+from benchmarks.bench_compile import FUNCTION
+from benchmarks.common import compile_source, timed
+
+
+NUM_FUNCTIONS = (10, 100, 1000)
+
+
+def program(num_functions):
+    source = [FUNCTION % (i, i) for i in xrange(num_functions)]
+    source.extend('print(f%d(%d, 2))\n' % (i, i % 12)
+                  for i in xrange(num_functions))
+    return ''.join(source)
+
+
+def decoded(bytecode):
+    am = AbstractMachine(bytecode)
+    am.decode_all()
+    return am
+
+
+def run(am):
+    am.run()
+
+
+def main():
+    timings = calibrate()
+    print '%-14s %12s %12s' % ('opcode', 'TIMINGS (us)', 'here (us)')
+    for instr in sorted(timings):
+        print '%-14s %12.2f %12.2f' % (Instr._asm_names[instr],
+                                       TIMINGS[instr] * 1e6,
+                                       timings[instr] * 1e6)
+
+    print
+    print '%10s %14s %14s %14s' % ('functions', 'min est (ms)', 'max est (ms)',
+                                   'measured (ms)')
+    for num_functions in NUM_FUNCTIONS:
+        bytecode = compile_source(program(num_functions))
+        _, cost = estimate(bytecode, timings)
+        print '%10d %14.2f %14.2f %14.2f' % (
+            num_functions, cost.min * 1000, cost.max * 1000,
+            timed(run, decoded(bytecode)) * 1000)
+
+
+if __name__ == '__main__':
+    main()
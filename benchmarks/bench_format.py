@@ -0,0 +1,65 @@
+"""
+Compares binary size and full decode time of format versions 1 and 2 over a
+small corpus of generated programs.
+"""
+import time
+
+from yaksh import TEST_PROGRAM
+from yaksh.vm import AbstractMachine, convert
+
+from benchmarks.common import compile_source
+
+
+def many_functions(n=2000):
+    source = []
+    for i in xrange(n):
+        source.append('def f%d(a, b):' % i)
+        source.append('    if a > b:')
+        source.append('        return a - b + %d' % i)
+        source.append('    return b - a')
+    source.append('print(f%d(1, 2))' % (n - 1))
+    return '\n'.join(source)
+
+
+def many_strings(n=5000):
+    return '\n'.join("s%d = 'string constant number %d'" % (i % 200, i)
+                     for i in xrange(n))
+
+
+def many_numbers(n=5000):
+    return '\n'.join('n%d = %d + %d.5' % (i % 200, i, i) for i in xrange(n))
+
+
+CORPUS = (
+    ('TEST_PROGRAM', TEST_PROGRAM),
+    ('many_functions', many_functions()),
+    ('many_strings', many_strings()),
+    ('many_numbers', many_numbers()),
+)
+
+
+def decode_time(bytecode):
+    best = None
+    for _ in xrange(5):
+        start = time.time()
+        AbstractMachine(bytecode).decode_all()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    print '%-16s %10s %10s %7s %12s %12s' % (
+        'program', 'v1 bytes', 'v2 bytes', 'ratio', 'v1 decode ms',
+        'v2 decode ms')
+    for name, source in CORPUS:
+        v1 = convert(compile_source(source), version=1)
+        v2 = convert(v1, version=2)
+        print '%-16s %10d %10d %7.2f %12.2f %12.2f' % (
+            name, len(v1), len(v2), float(len(v2)) / len(v1),
+            decode_time(v1) * 1e3, decode_time(v2) * 1e3)
+
+
+if __name__ == '__main__':
+    main()
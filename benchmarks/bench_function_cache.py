@@ -0,0 +1,40 @@
+"""
+Rebuild time of large sources after editing one function, compiling from
+scratch versus reusing the other functions from a FunctionCache.
+"""
+from yaksh.cache import compile_source
+from yaksh.function_cache import FunctionCache
+
+from benchmarks.bench_compile import FUNCTION, NUM_FUNCTIONS
+from benchmarks.common import timed
+
+
+def program(num_functions, edited=0):
+    source = [FUNCTION % (i, i) for i in xrange(num_functions)]
+    # An edit to the last function
+    source[-1] = FUNCTION % (num_functions - 1, edited)
+    source.append('print(f%d(1, 2))' % (num_functions - 1))
+    return ''.join(source)
+
+
+def rebuild(functions, source):
+    compile_source(source, functions)
+
+
+def main():
+    print '%10s %14s %14s %8s' % ('functions', 'scratch (ms)', 'cached (ms)',
+                                  'reused')
+    for num_functions in NUM_FUNCTIONS:
+        source = program(num_functions)
+        edited = program(num_functions, edited=1)
+        functions = FunctionCache()
+        compile_source(source, functions)
+        functions.hits = functions.misses = 0
+        cached = timed(rebuild, functions, edited)
+        print '%10d %14.1f %14.1f %7.1f%%' % (
+            num_functions, timed(compile_source, edited) * 1000,
+            cached * 1000, functions.hit_rate * 100)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Run time of a program making many calls to small helpers, with and without
+inlining them at their call sites.
+"""
+from yaksh.vm import AbstractMachine
+
+from benchmarks.common import compile_source, timed
+
+
+SIZES = (1000, 5000, 20000)
+
+HELPERS = '''
+def test(a, b, c):
+    return a + b * c
+def clamp(x):
+    if x > 10:
+        return 10
+    return x
+def f(x):
+    return test(x, 2, 3) + clamp(x)
+'''
+
+
+def source(num_calls):
+    calls = ['print(f(%d))' % (i % 20) for i in xrange(num_calls)]
+    return HELPERS + '\n'.join(calls)
+
+
+def run(bytecode):
+    AbstractMachine(bytecode).run()
+
+
+def main():
+    print '%8s %14s %14s' % ('calls', 'called (ms)', 'inlined (ms)')
+    for num_calls in SIZES:
+        called = compile_source(source(num_calls), inline_max_size=0)
+        inlined = compile_source(source(num_calls))
+        print '%8d %14.1f %14.1f' % (num_calls, timed(run, called) * 1000,
+                                     timed(run, inlined) * 1000)
+
+
+if __name__ == '__main__':
+    main()
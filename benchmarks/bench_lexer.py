@@ -0,0 +1,26 @@
+"""
+Compares lexing a source character by character, with lex(), and a token at
+a time with lex_fast().
+"""
+from yaksh.lexer import lex, lex_fast
+
+from benchmarks.bench_compile import FUNCTION
+from benchmarks.common import timed
+
+
+NUM_FUNCTIONS = (100, 1000, 5000)
+
+
+def main():
+    print '%10s %12s %14s %8s' % ('functions', 'lex (ms)', 'lex_fast (ms)',
+                                  'speedup')
+    for num_functions in NUM_FUNCTIONS:
+        source = ''.join(FUNCTION % (i, i) for i in xrange(num_functions))
+        slow = timed(lex, source)
+        fast = timed(lex_fast, source)
+        print '%10d %12.1f %14.1f %7.1fx' % (num_functions, slow * 1000,
+                                            fast * 1000, slow / fast)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Decode time of string-heavy binaries, loaded from a str and memory-mapped
+from a file. Throughput should stay flat as the binary grows.
+"""
+import os
+import tempfile
+import time
+
+from yaksh.bytecode_compiler import assemble
+from yaksh.vm import AbstractMachine
+
+
+NUM_STRINGS = 250
+STRING_SIZES = (1024, 4096, 16384, 65536)
+
+
+def string_heavy_binary(string_size):
+    asm = []
+    for i in xrange(NUM_STRINGS):
+        s = ('%d' % i).ljust(string_size, 'x')
+        asm.append("LOAD_CONST '%s'" % s)
+    return assemble('\n'.join(asm))
+
+
+def best_of(f, *args):
+    best = None
+    for _ in xrange(3):
+        start = time.time()
+        f(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    print '%10s %12s %12s' % ('size (MB)', 'str MB/s', 'mmap MB/s')
+    for string_size in STRING_SIZES:
+        bytecode = string_heavy_binary(string_size)
+        fd, path = tempfile.mkstemp(suffix='.ysh')
+        try:
+            os.write(fd, bytecode)
+            os.close(fd)
+            mb = len(bytecode) / 1e6
+            in_memory = best_of(AbstractMachine, bytecode)
+            mapped = best_of(AbstractMachine.from_file, path)
+            print '%10.2f %12.1f %12.1f' % (mb, mb / in_memory, mb / mapped)
+        finally:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Compile time of large sources, serially and split across processes.
+
+It also times the two halves of a parallel compile in one process: compiling
+the pieces, which the processes share, and linking them and inferring types,
+which the parent does alone. With a core for each process, -j N takes
+about pieces / N + linking: the pieces are most of the work, so from two
+cores it beats compiling serially. With fewer cores than processes, they
+only take turns, and -j N is no faster than -j 1.
+"""
+import time
+from multiprocessing import cpu_count
+
+from yaksh.linker import link
+from yaksh.parallel import (_check_references, _compile_piece,
+                            _specialize_linked, compile_parallel,
+                            split_pieces)
+
+from benchmarks.bench_compile import FUNCTION
+from benchmarks.common import compile_source, timed
+
+
+NUM_FUNCTIONS = (500, 2000)
+
+
+def program(num_functions):
+    source = [FUNCTION % (i, i) for i in xrange(num_functions)]
+    # Every function is called, so none are shaken out of the serial build
+    source.extend('print(f%d(1, 2))\n' % i for i in xrange(num_functions))
+    return ''.join(source)
+
+
+def phases(source):
+    """
+    @return: seconds compiling the pieces of source, and seconds linking
+        them and inferring types after, in this process
+    """
+    start = time.time()
+    compiled = map(_compile_piece, split_pieces(source))
+    pieces = time.time() - start
+    _check_references(compiled, ())
+    bytecode = link([obj for obj, _, _, _ in compiled], one_source=True)
+    _specialize_linked(bytecode, ())
+    return pieces, time.time() - start - pieces
+
+
+def main():
+    print 'cores: %d' % cpu_count()
+    jobs = sorted(set([1, 2, 4, cpu_count()]))
+    print '%10s %12s %12s %12s' % ('functions', 'serial (ms)', 'pieces (ms)',
+                                   'linking (ms)') + ''.join(
+        '%12s' % ('-j %d (ms)' % j) for j in jobs)
+    for num_functions in NUM_FUNCTIONS:
+        source = program(num_functions)
+        pieces, linking = phases(source)
+        print '%10d %12.1f %12.1f %12.1f' % (
+            num_functions, timed(compile_source, source) * 1000,
+            pieces * 1000, linking * 1000) + ''.join(
+            '%12.1f' % (timed(compile_parallel, source, j) * 1000)
+            for j in jobs)
+
+
+if __name__ == '__main__':
+    main()
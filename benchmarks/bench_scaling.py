@@ -0,0 +1,48 @@
+"""
+Programs with N functions and N constants, past the old 1-byte operand limit.
+Reports assembly, load and run (a single CALL) time per function; load and
+run stay flat thanks to lazy decoding, and assembly grows linearly.
+"""
+import time
+
+from yaksh.bytecode_compiler import assemble
+from yaksh.tests.utils import capture_stdout
+from yaksh.vm import AbstractMachine
+
+
+SIZES = (1000, 10000, 50000, 100000)
+
+
+def program_asm(n):
+    asm = []
+    for i in xrange(n):
+        asm.append("PROC\nLOAD_CONST 'function %d'\nCALL_BUILTIN 0\n"
+                   "MAKE_FUNCTION" % i)
+    asm.append('CALL %d' % (n - 1))
+    return '\n'.join(asm)
+
+
+def main():
+    print '%8s %10s %14s %14s %14s' % ('funcs', 'size (KB)', 'assemble us/f',
+                                       'load us/f', 'run us')
+    for n in SIZES:
+        asm = program_asm(n)
+
+        start = time.time()
+        bytecode = assemble(asm)
+        assembled = time.time()
+        am = AbstractMachine(bytecode)
+        loaded = time.time()
+        with capture_stdout():
+            am.run()
+        ran = time.time()
+
+        print '%8d %10d %14.2f %14.4f %14.1f' % (
+            n, len(bytecode) / 1024,
+            (assembled - start) / n * 1e6,
+            (loaded - assembled) / n * 1e6,
+            (ran - loaded) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Time to first output of a large binary read from a slow stream, e.g. a pipe
+or network socket, when buffering the whole binary first versus streaming it
+with StreamingMachine.
+"""
+import sys
+import time
+
+from benchmarks.common import compile_source
+from yaksh.vm import AbstractMachine, StreamingMachine
+
+
+NUM_FUNCTIONS = (1000, 10000, 50000)
+CHUNK_SIZE = 64 * 1024
+# Simulated stream throughput, in bytes per second
+THROUGHPUT = 20e6
+
+
+def program(num_functions):
+    source = ['def f%d(a):\n    b = a * 2 + 1\n    return b - a / 3' % i
+              for i in xrange(num_functions)]
+    source.append("print('started')")
+    source.append('print(f%d(1))' % (num_functions - 1))
+    return compile_source('\n'.join(source))
+
+
+def slow_chunks(bytecode):
+    for i in xrange(0, len(bytecode), CHUNK_SIZE):
+        chunk = bytecode[i:i + CHUNK_SIZE]
+        time.sleep(len(chunk) / THROUGHPUT)
+        yield chunk
+
+
+class FirstWrite(object):
+    """Stands in for stdout, noting when the first output arrives"""
+
+    def __init__(self):
+        self.at = None
+
+    def write(self, s):
+        if self.at is None:
+            self.at = time.time()
+
+
+def time_to_first_output(load, bytecode):
+    stdout = sys.stdout
+    sys.stdout = first_write = FirstWrite()
+    try:
+        start = time.time()
+        load(slow_chunks(bytecode)).run()
+    finally:
+        sys.stdout = stdout
+    return first_write.at - start
+
+
+def buffered(chunks):
+    return AbstractMachine(''.join(chunks))
+
+
+def main():
+    print '%10s %10s %14s %14s' % ('functions', 'size (KB)', 'buffered (ms)',
+                                   'streamed (ms)')
+    for num_functions in NUM_FUNCTIONS:
+        bytecode = program(num_functions)
+        print '%10d %10d %14.1f %14.1f' % (
+            num_functions, len(bytecode) / 1024,
+            time_to_first_output(buffered, bytecode) * 1000,
+            time_to_first_output(StreamingMachine, bytecode) * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Accumulator-style string building: a program of N `s = s + '...'` statements.
+With ropes, run time per append stays flat as N grows; with eager
+concatenation it grows linearly (quadratic overall).
+"""
+from yaksh import vm
+from yaksh.vm import AbstractMachine
+
+from benchmarks.common import compile_source, timed
+
+
+SIZES = (1000, 2000, 4000, 8000)
+PIECE = 'the quick brown fox jumps over the lazy dog ' * 4
+
+
+def accumulator_source(n):
+    lines = ["s = ''"]
+    lines.extend(["s = s + '%s'" % PIECE] * n)
+    lines.append('print(len(s))')
+    return '\n'.join(lines)
+
+
+def run(bytecode, rope_min_length):
+    old, vm.ROPE_MIN_LENGTH = vm.ROPE_MIN_LENGTH, rope_min_length
+    try:
+        AbstractMachine(bytecode).run()
+    finally:
+        vm.ROPE_MIN_LENGTH = old
+
+
+def main():
+    print '%8s %14s %14s' % ('appends', 'rope us/op', 'eager us/op')
+    for n in SIZES:
+        bytecode = compile_source(accumulator_source(n))
+        rope = timed(run, bytecode, vm.ROPE_MIN_LENGTH)
+        eager = timed(run, bytecode, float('inf'))
+        print '%8d %14.2f %14.2f' % (n, rope / n * 1e6, eager / n * 1e6)
+
+
+if __name__ == '__main__':
+    main()
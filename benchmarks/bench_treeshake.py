@@ -0,0 +1,39 @@
+"""
+Size and decode time of generated sources calling only a few of their many
+helper functions, before and after tree shaking.
+"""
+from benchmarks.common import compile_source
+from yaksh.treeshake import shake_binary
+
+
+NUM_HELPERS = (100, 1000, 10000)
+NUM_CALLED = 10
+
+HELPER = '''
+def helper%d(a):
+    b = a * %d + 1
+    print('helper %d')
+    return b - a / 3
+'''
+
+
+def program(num_helpers):
+    source = [HELPER % (i, i, i) for i in xrange(num_helpers)]
+    source.extend('print(helper%d(1))\n' % i for i in xrange(NUM_CALLED))
+    return compile_source(''.join(source))
+
+
+def main():
+    print '%10s %12s %12s %14s %14s' % ('helpers', 'before (KB)',
+                                        'after (KB)', 'decode before',
+                                        'decode after')
+    for num_helpers in NUM_HELPERS:
+        _, report = shake_binary(program(num_helpers))
+        print '%10d %12.1f %12.1f %11.1f ms %11.1f ms' % (
+            num_helpers, report.bytes_before / 1024.0,
+            report.bytes_after / 1024.0, report.decode_before * 1000,
+            report.decode_after * 1000)
+
+
+if __name__ == '__main__':
+    main()
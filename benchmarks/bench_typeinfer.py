@@ -0,0 +1,47 @@
+"""
+Run time of arithmetic, comparisons and string concatenation, with the
+opcodes type inference specializes them to, and with the generic ones.
+"""
+from yaksh.bytecode_compiler import assemble
+from yaksh.vm import AbstractMachine
+
+from benchmarks.common import timed
+
+
+SIZES = (1000, 5000, 20000)
+
+# ADD and MULT of numbers, CMP, and ADD of strings
+GENERIC_OPS = ('ADD', 'MULT', 'CMP', 'ADD')
+TYPED_OPS = ('ADD_NUM', 'MULT_NUM', 'CMP_NUM', 'ADD_STR')
+
+
+def write_asm(num_statements, ops):
+    add, mult, cmp_, add_str = ops
+    lines = ['LOAD_CONST 1', 'STORE_GLOBAL 0',
+             "LOAD_CONST ''", 'STORE_GLOBAL 1']
+    for i in xrange(num_statements):
+        lines.extend([
+            'LOAD_CONST %d' % (i % 7), 'LOAD_GLOBAL 0', mult,
+            'LOAD_CONST 3', add, 'STORE_GLOBAL 0',
+            'LOAD_CONST 1000', 'LOAD_GLOBAL 0', '%s 2' % cmp_, 'POP',
+            "LOAD_CONST 'x'", 'LOAD_GLOBAL 1', add_str, 'STORE_GLOBAL 1',
+        ])
+    return '\n'.join(lines)
+
+
+def run(bytecode):
+    AbstractMachine(bytecode).run()
+
+
+def main():
+    print '%10s %14s %14s' % ('statements', 'generic (ms)', 'typed (ms)')
+    for num_statements in SIZES:
+        generic = assemble(write_asm(num_statements, GENERIC_OPS))
+        typed = assemble(write_asm(num_statements, TYPED_OPS))
+        print '%10d %14.1f %14.1f' % (
+            num_statements, timed(run, generic) * 1000,
+            timed(run, typed) * 1000)
+
+
+if __name__ == '__main__':
+    main()
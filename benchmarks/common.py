@@ -0,0 +1,34 @@
+"""
+Helpers shared by the benchmarks. Run a benchmark from the repository root,
+e.g. `python -m benchmarks.bench_strings`.
+"""
+import time
+
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import assemble
+from yaksh.lexer import lex
+from yaksh.optimizer import optimize
+from yaksh.parser import parse
+from yaksh.tests.utils import capture_stdout
+
+
+def compile_source(source, **options):
+    """
+    @param options: passed to BytecodeAssemblyGenerator
+    """
+    asm = BytecodeAssemblyGenerator(parse(lex(source)), **options).generate()
+    optimize(asm)
+    return assemble(asm)
+
+
+def timed(f, *args, **kwargs):
+    """Returns the best wall time of three calls to f, in seconds"""
+    best = None
+    for _ in xrange(3):
+        start = time.time()
+        with capture_stdout():
+            f(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
@@ -0,0 +1,44 @@
+"""
+Runs a yaksh binary (.ysh) or source file (.yk):
+
+    python -m yaksh program.yk
+
+A version 2 binary piped over stdin starts running as it arrives:
+
+    python -m yaksh - < program.ysh
+"""
+import argparse
+import io
+import sys
+
+from yaksh import cache
+from yaksh.vm import AbstractMachine, StreamingMachine
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='yaksh')
+    parser.add_argument('path', help='.ysh binary or .yk source to run, or '
+                                     '- to stream a binary from stdin')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write the decoded program cache")
+    parser.add_argument('--cache-dir',
+                        help='where decoded programs are cached')
+    args = parser.parse_args()
+
+    if args.path == '-':
+        # Unlike sys.stdin, reads whatever has arrived
+        stdin = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+        am = StreamingMachine(stdin)
+    elif args.no_cache:
+        if args.path.endswith(cache.SOURCE_EXT):
+            with open(args.path) as f:
+                am = AbstractMachine(cache.compile_source(f.read()))
+        else:
+            am = AbstractMachine.from_file(args.path)
+    else:
+        am = cache.load(args.path, args.cache_dir)
+    am.run()
+
+
+if __name__ == '__main__':
+    main()
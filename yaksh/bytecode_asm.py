@@ -1,102 +1,226 @@
 """
 A bytecode compiler for this god-forsaken language.
 """
+import operator
+from collections import OrderedDict
 from contextlib import contextmanager
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
+from yaksh.bytecode_compiler import Assembly, Compare, Instr, Instruction
 from yaksh.parser import Symbol
 
 
 RESERVED_STMTS = {'return_stmt', 'pass_stmt', 'if_chain'}
 BUILTINS = (
     'print',
+    'vector',
+    'sum',
+    'min',
+    'max',
+    'dot',
+    'slice',
 )
+# Builtins which compile down to a single instruction instead of CALL_BUILTIN,
+# mapped to their generator method
+INSTR_BUILTINS = {
+    'len': 'len',
+}
+# How the VM applies each operator, for folding constants at compile time
+FOLD_OPS = {
+    'add': operator.add,
+    'sub': operator.sub,
+    'mult': operator.mul,
+    'div': operator.div,
+}
+# Folded values must fit in a version 1 constant
+FOLD_INT_RANGE = (-2 ** 31, 2 ** 31 - 1)
+# Functions of up to this many instructions are inlined at their call sites
+INLINE_MAX_SIZE = 16
+# Most clones specialized for constant arguments generated of each function
+SPECIALIZE_MAX_CLONES = 4
+
+# Tables of the generator which generating a function reads and writes (see
+# BytecodeAssemblyGenerator.tables), and which of them are lists
+TABLES = ('funcs', 'func_list_names', 'func_names', 'globals',
+          'global_consts', 'fdefs', 'specializations', 'num_clones')
+LIST_TABLES = ('funcs', 'func_list_names')
+
+# Returned by _const_value for values not known at compile time
+_NOT_CONST = object()
+
+
+class _Folded(object):
+    """Stands in for a constant subexpression of a value_stmt"""
+
+    def __init__(self, value):
+        self.value = value
 
 
 class BytecodeAssemblyGenerator(object):
-    def __init__(self, symbols):
+    def __init__(self, symbols, host_globals=(), module=False,
+                 inline_max_size=INLINE_MAX_SIZE,
+                 specialize_max_clones=SPECIALIZE_MAX_CLONES,
+                 fold_constants=True, function_cache=None):
+        """
+        @param host_globals: names of globals provided by the embedding host,
+            which are given the first global indices, in order
+        @param module: compile a module to be linked with others (see
+            yaksh.linker). Functions it calls without defining, and globals
+            it reads without assigning, are left to the linker to find.
+        @param inline_max_size: functions of up to this many instructions are
+            inlined where they're called, instead of being CALLed. 0 turns
+            inlining off.
+        @param specialize_max_clones: how many clones of each function may be
+            generated for calls passing it constant arguments (see
+            _specialize). 0 turns specialization off.
+        @param fold_constants: whether to evaluate expressions and conditions
+            known at compile time, rather than leave them to the VM
+        @param function_cache: a yaksh.function_cache.FunctionCache to reuse
+            the code of functions from, where their symbols are LazyFdefs
+        """
         self.symbols = symbols
+        self.module = module
+        self.inline_max_size = inline_max_size
+        self.specialize_max_clones = specialize_max_clones
+        self.fold_constants = fold_constants
 
-        self._bc = StringIO()
+        # Instructions of the function being generated, or the toplevel
+        self._code = []
         self._locals = None
-        self._globals = {}
+        self._globals = dict((name, idx)
+                             for idx, name in enumerate(host_globals))
+        self._num_host_globals = len(host_globals)
         self._func_globals = []
         self._funcs = []
         self._func_names = {}
-
-        self._label = None
+        # Name of each function in self._funcs
+        self._func_list_names = []
+        # Name of the function being generated, or None for the toplevel
+        self._func_name = None
+        # In module mode, names of functions called before being defined,
+        # mapped to their CALL instructions
+        self.import_calls = OrderedDict()
+        # Functions called but never defined, in module mode
+        self.imported_funcs = []
+        # In module mode, functions called before being defined and globals
+        # read before being assigned, which compiling the whole program at
+        # once would reject: ('function' or 'global', name, the error it
+        # would raise), in the order they're generated
+        self.forward_refs = []
+        # Call sites inlined, as (calling function's name, or None for the
+        # toplevel, inlined function's name, source line)
+        self.inlined = []
+
+        # Functions which can be specialized, by index, mapped to (their
+        # fdef, parameters which can be bound to constants)
+        self._fdefs = {}
+        # Clones of functions specialized for constant arguments, keyed by
+        # (function index, the arguments bound)
+        self._specializations = {}
+        # Number of clones generated of each function, by index
+        self._num_clones = {}
+        # Parameters bound to constants in the clone being generated
+        self._local_consts = {}
+        # Call sites specialized, as (called function's name, clone's name,
+        # source line)
+        self.specialized = []
+        # Depth of _discarded blocks being generated
+        self._discarding = 0
+
+        # Labels for the next instruction
+        self._labels = []
         self._label_counters = [0]
-
-    def _(self, asm):
-        if self._label:
-            self._bc.write(self._label + ': ')
-            self._label = None
-        self._bc.write(asm)
-        self._bc.write('\n')
+        # Source line of the statement being generated
+        self._line_no = None
+
+        # Globals assigned a constant exactly once, at the toplevel, mapped to
+        # their value once that assignment has been generated. Host globals
+        # and module globals can be assigned elsewhere, so aren't candidates.
+        self._global_consts = {}
+        self._write_once = set()
+        if not module:
+            self._write_once = (self._find_write_once(symbols) -
+                                set(host_globals))
+
+        self.function_cache = function_cache
+        if function_cache is not None:
+            function_cache.trace(self)
+
+    def _(self, instr, param=None):
+        if self._labels:
+            labels = self._labels
+            self._labels = []
+        else:
+            labels = ()
+        self._code.append(Instruction(instr, param, labels, self._line_no))
 
     ###############################
     # BYTECODE GENERATING METHODS #
     ###############################
     def add(self):
-        self._('ADD')
+        self._(Instr.ADD)
 
     def sub(self):
-        self._('SUB')
+        self._(Instr.SUB)
 
     def div(self):
-        self._('DIV')
+        self._(Instr.DIV)
 
     def mult(self):
-        self._('MULT')
+        self._(Instr.MULT)
 
     def retn(self):
-        self._('RETN')
+        self._(Instr.RETN)
 
     def call(self, func_idx):
-        self._('CALL %d' % func_idx)
+        self._(Instr.CALL, func_idx)
 
     def store_var(self, local_index):
-        self._('STORE_VAR %d' % local_index)
+        self._(Instr.STORE_VAR, local_index)
 
     def store_global(self, global_idx):
-        self._('STORE_GLOBAL %d' % global_idx)
+        self._(Instr.STORE_GLOBAL, global_idx)
 
     def load_const(self, value):
-        self._('LOAD_CONST %s' % value)
+        self._(Instr.LOAD_CONST, value)
 
     def load_global(self, global_idx):
-        self._('LOAD_GLOBAL %d' % global_idx)
+        self._(Instr.LOAD_GLOBAL, global_idx)
 
     def load_local(self, local_idx):
-        self._('LOAD_LOCAL %d' % local_idx)
-
-    def proc(self):
-        self._('PROC')
-
-    def make_function(self):
-        self._('MAKE_FUNCTION')
+        self._(Instr.LOAD_LOCAL, local_idx)
 
     def call_builtin(self, builtin_idx):
-        self._('CALL_BUILTIN %d' % builtin_idx)
+        self._(Instr.CALL_BUILTIN, builtin_idx)
 
     def y_pass(self):
-        self._('PASS')
+        self._(Instr.PASS)
 
     def jz(self, label):
-        self._('JZ %s' % label)
+        self._(Instr.JZ, label)
 
     def jnz(self, label):
-        self._('JNZ %s' % label)
+        self._(Instr.JNZ, label)
 
     def jmp(self, label):
-        self._('JMP %s' % label)
+        self._(Instr.JMP, label)
 
     def cmp(self, op):
-        self._('CMP %d' % op)
+        self._(Instr.CMP, op)
+
+    def build_list(self, size):
+        self._(Instr.BUILD_LIST, size)
+
+    def build_map(self, size):
+        self._(Instr.BUILD_MAP, size)
+
+    def load_index(self):
+        self._(Instr.LOAD_INDEX)
+
+    def store_index(self):
+        self._(Instr.STORE_INDEX)
+
+    def len(self):
+        self._(Instr.LEN)
 
     #############
     # Utilities #
@@ -113,44 +237,80 @@ class BytecodeAssemblyGenerator(object):
             return int(s_num)
 
     def _store_var(self, name):
-        if self._locals:
+        if self._locals is not None:
             if name in self._locals:
                 index = self._locals[name]
                 if isinstance(index, str):
                     self._store_global(index)
                     return
-                else:
-                    index = len(self._locals)
-                    self._locals[name] = index
-                self.store_var(index)
+            else:
+                index = len(self._locals)
+                self._locals[name] = index
+            self.store_var(index)
         else:
             self._store_global(name)
 
     def _store_global(self, name):
+        self.store_global(self._global_index(name))
+
+    def _global_index(self, name):
         if name in self._globals:
-            index = self._globals[name]
-        else:
-            index = len(self._globals)
-            self._globals[name] = index
-        self.store_global(index)
+            return self._globals[name]
+        index = len(self._globals)
+        self._globals[name] = index
+        return index
 
     @contextmanager
-    def _define_function(self, funcname):
-        bytecode = self._bc
-        self._bc = StringIO()
+    def _discarded(self):
+        """
+        Generates code that can never run, for the names it assigns, but
+        without emitting it
+        """
+        code, self._code = self._code, []
+        labels, self._labels = self._labels, []
+        self._discarding += 1
+        yield
+        self._discarding -= 1
+        self._code = code
+        self._labels = labels
+
+    @contextmanager
+    def _define_function(self, funcname, local_consts=None):
+        """
+        @param local_consts: names bound to constants instead of locals, for
+            a specialized clone
+        """
+        code = self._code
+        self._code = []
+        # Labels pending in the enclosing code mustn't land in the function
+        labels, self._labels = self._labels, []
+        line_no, self._line_no = self._line_no, None
 
-        self.proc()
         old_locals = self._locals
         self._locals = {}
+        old_local_consts, self._local_consts = (self._local_consts,
+                                                local_consts or {})
+        old_func_name, self._func_name = self._func_name, funcname
+        # Named before the body is generated, so it can call itself. Its
+        # index is reserved, as clones may be defined while it's generated.
+        func_idx = len(self._funcs)
+        self._func_names[funcname] = func_idx
+        self._func_list_names.append(funcname)
+        self._funcs.append(None)
 
         yield
 
+        if self._labels:
+            # Jumps to the end of the function
+            self.y_pass()
         self._locals = old_locals
-        self._func_names[funcname] = len(self._funcs)
-        self.make_function()
-        self._funcs.append(self._bc.getvalue())
+        self._local_consts = old_local_consts
+        self._func_name = old_func_name
+        self._funcs[func_idx] = self._code
 
-        self._bc = bytecode
+        self._code = code
+        self._labels = labels
+        self._line_no = line_no
 
     @contextmanager
     def _local_labels(self):
@@ -170,12 +330,102 @@ class BytecodeAssemblyGenerator(object):
         return actual_label
 
     def _label_next(self, label):
-        self._label = label
+        self._labels.append(label)
+
+    def _mark_line(self, symbol):
+        """Attributes the following instructions to symbol's source line"""
+        line_no = symbol.line_no
+        if line_no is not None:
+            # Tokens count lines from 0, line tables from 1
+            self._line_no = line_no + 1
+
+    ####################
+    # Constant folding #
+    ####################
+    @staticmethod
+    def _find_write_once(symbols):
+        """Names of globals assigned only once, by a toplevel statement"""
+        counts = {}
+        unconditional = set()
+
+        def count(stmts, toplevel):
+            for stmt in stmts:
+                if stmt.name == 'assign':
+                    counts[stmt.var] = counts.get(stmt.var, 0) + 1
+                    if toplevel:
+                        unconditional.add(stmt.var)
+                elif stmt.name == 'if_chain':
+                    for test_stmt in stmt.symbols:
+                        count(test_stmt.block.symbols, False)
+
+        count([symbol for symbol in symbols if symbol.name != 'fdef'], True)
+        return set(name for name in unconditional if counts[name] == 1)
+
+    def _const_value(self, symbol):
+        """
+        The value of symbol, if it's known at compile time, else _NOT_CONST.
+        Only numbers are folded, and comparisons of them.
+        """
+        if not self.fold_constants:
+            return _NOT_CONST
+
+        if symbol.name == 'value':
+            val_sym = symbol.symbols[0]
+            if val_sym.name == 'number':
+                return val_sym.value
+            elif val_sym.name == 'var':
+                if val_sym.text in self._local_consts:
+                    return self._local_consts[val_sym.text]
+                if self._locals is None or val_sym.text not in self._locals:
+                    return self._global_consts.get(val_sym.text, _NOT_CONST)
+            return _NOT_CONST
+
+        elif symbol.name == 'cmp_stmt':
+            left = self._const_value(symbol.left)
+            right = self._const_value(symbol.right)
+            if _NOT_CONST in (left, right):
+                return _NOT_CONST
+            return Compare.cmp(symbol.op, left, right)
+
+        elif symbol.name == 'value_stmt':
+            vals, ops = self._split_value_stmt(symbol)
+            if ops and vals[-1].name == 'cmp_stmt':
+                return _NOT_CONST
+            values = [self._const_value(v) for v in vals]
+            if _NOT_CONST in values:
+                return _NOT_CONST
+            return self._fold(values, ops)
+
+        return _NOT_CONST
+
+    @staticmethod
+    def _fold(values, ops):
+        """
+        Applies ops between values as the VM would: grouped from the right,
+        so `4 - 4 - 2` is `4 - (4 - 2)`
+        """
+        result = values[-1]
+        try:
+            for op, v in reversed(zip(ops, values)):
+                result = FOLD_OPS[op.opfunc](v, result)
+        except (ArithmeticError, TypeError):
+            # Left for the VM to raise, with a line number
+            return _NOT_CONST
+        return result
+
+    @staticmethod
+    def _is_loadable(value):
+        """Whether a folded value loads back as the same value"""
+        if type(value) is int:
+            return FOLD_INT_RANGE[0] <= value <= FOLD_INT_RANGE[1]
+        # Comparisons give bools, which would load as ints
+        return type(value) is float
 
     #################################
     # SYMBOL TRANSFORMATION METHODS #
     #################################
-    def gen_value_stmt(self, value_stmt):
+    @staticmethod
+    def _split_value_stmt(value_stmt):
         vals = []
         ops = []
         for v in value_stmt.symbols:
@@ -184,6 +434,27 @@ class BytecodeAssemblyGenerator(object):
             else:
                 # Operator
                 ops.append(v)
+        return vals, ops
+
+    def gen_value_stmt(self, value_stmt):
+        value = self._const_value(value_stmt)
+        if self._is_loadable(value):
+            self.load_const(value)
+            return
+
+        vals, ops = self._split_value_stmt(value_stmt)
+        if ops and vals[-1].name != 'cmp_stmt':
+            # Operators group from the right, so any run of constants at the
+            # end is a subexpression of its own
+            values = [self._const_value(v) for v in vals]
+            start = len(vals)
+            while start and values[start - 1] is not _NOT_CONST:
+                start -= 1
+            if len(vals) - start > 1:
+                value = self._fold(values[start:], ops[start:])
+                if self._is_loadable(value):
+                    vals[start:] = [_Folded(value)]
+                    del ops[start:]
 
         if ops:
             while ops:
@@ -191,6 +462,8 @@ class BytecodeAssemblyGenerator(object):
                     v = vals.pop()
                     if v is None:
                         pass
+                    elif isinstance(v, _Folded):
+                        self.load_const(v.value)
                     elif v.name == 'cmp_stmt':
                         self.gen_cmp_stmt(v)
                         vals.append(None)
@@ -204,7 +477,9 @@ class BytecodeAssemblyGenerator(object):
                 vals.append(None)
         else:
             v = vals.pop()
-            if v.name == 'cmp_stmt':
+            if isinstance(v, _Folded):
+                self.load_const(v.value)
+            elif v.name == 'cmp_stmt':
                 self.gen_cmp_stmt(v)
             elif v.name == 'value_stmt':
                 self.gen_value_stmt(v)
@@ -223,46 +498,104 @@ class BytecodeAssemblyGenerator(object):
         if val_sym.name == 'number':
             self.load_const(val_sym.value)
         elif val_sym.name == 'literal':
-            self.load_const("%r" % val_sym)
+            self.load_const(val_sym.text)
         elif val_sym.name == 'var':
             name = val_sym.text
+            if name in self._local_consts:
+                self.load_const(self._local_consts[name])
+                return
             try:
                 self.load_local(self._locals[name])
             except (KeyError, TypeError):
-                try:
-                    self.load_global(self._globals[name])
-                except KeyError:
-                    raise ValueError("Global or local var '%s' does not "
-                                     "exist" % name)
+                if name in self._global_consts:
+                    self.load_const(self._global_consts[name])
+                elif name in self._globals:
+                    self.load_global(self._global_index(name))
+                else:
+                    error = ValueError("Global or local var '%s' does not "
+                                       "exist" % name)
+                    if not self.module:
+                        raise error
+                    self.forward_refs.append(('global', name, error))
+                    self.load_global(self._global_index(name))
         elif val_sym.name == 'fcall':
             self.gen_fcall(val_sym)
+        elif val_sym.name == 'list_literal':
+            for item in val_sym.items:
+                self.gen_value_stmt(item)
+            self.build_list(len(val_sym.items))
+        elif val_sym.name == 'dict_literal':
+            for key, v in val_sym.items:
+                self.gen_value_stmt(key)
+                self.gen_value_stmt(v)
+            self.build_map(len(val_sym.items))
+        elif val_sym.name == 'subscript':
+            self.gen_subscript(val_sym)
+            self.load_index()
         else:
             raise NotImplementedError()
 
+    def gen_subscript(self, subscript):
+        # Pushes the index, then the container, leaving the container on top
+        # for LOAD_INDEX/STORE_INDEX to pop first.
+        self.gen_value_stmt(subscript.index)
+        self.gen_value(subscript.container)
+
     def gen_assign(self, assign):
         self.gen_value_stmt(assign.value)
         self._store_var(assign.var)
+        if self._locals is None and assign.var in self._write_once:
+            value = self._const_value(assign.value)
+            if self._is_loadable(value):
+                self._global_consts[assign.var] = value
+
+    def gen_index_assign(self, index_assign):
+        self.gen_value_stmt(index_assign.value)
+        self.gen_subscript(index_assign.target)
+        self.store_index()
 
     def gen_if_chain(self, if_chain):
         with self._local_labels():
+            chain_out = self._get_next_label('chain_out')
             label_idx = 0
             last_test = len(if_chain.symbols) - 1
+            # Whether any test jumps to chain_out
+            jumps_out = False
+            # Whether an earlier test is always true, so the rest never run
+            decided = False
             for i, test_stmt in enumerate(if_chain.symbols):
+                self._mark_line(test_stmt)
                 if test_stmt.cond:
+                    cond = self._const_value(test_stmt.cond)
+                else:
+                    cond = True
+
+                if decided or (cond is not _NOT_CONST and cond == 0):
+                    with self._discarded():
+                        self._gen_block(test_stmt.block)
+                elif cond is not _NOT_CONST:
+                    self._gen_block(test_stmt.block)
+                    decided = True
+                else:
                     self.gen_value_stmt(test_stmt.cond)
                     if i != last_test:
                         next_label = self._get_next_label('chain_next%d' % label_idx)
                         label_idx += 1
                     else:
-                        next_label = 'chain_out'
+                        next_label = chain_out
                     self.jz(next_label)
-                for stmt in test_stmt.block.symbols:
-                    self.gen_stmt(stmt)
-                if test_stmt.cond and i != last_test:
-                    self.jmp('chain_out')
-                    self._label_next(next_label)
+                    self._gen_block(test_stmt.block)
+                    if i != last_test:
+                        self.jmp(chain_out)
+                        self._label_next(next_label)
+                    jumps_out = True
+
+            if jumps_out:
+                self._label_next(chain_out)
 
-            self._label_next('chain_out')
+    def _gen_block(self, block):
+        for stmt in block.symbols:
+            self.gen_stmt(stmt)
 
     def gen_reserved(self, reserved):
         if reserved.name == 'return_stmt':
@@ -277,26 +610,237 @@ class BytecodeAssemblyGenerator(object):
             raise NotImplementedError()
 
     def gen_fcall(self, fcall):
+        if fcall.func_name in INSTR_BUILTINS:
+            for arg in fcall.args:
+                self.gen_value_stmt(arg)
+            getattr(self, INSTR_BUILTINS[fcall.func_name])()
+            return
+
+        args = fcall.args
         try:
             func_idx = BUILTINS.index(fcall.func_name)
             call = self.call_builtin
         except ValueError:
             try:
                 func_idx = self._func_names[fcall.func_name]
-                call = self.call
+                call = self._call_function
             except KeyError:
-                raise NameError("name '%s' does not exist" % fcall.func_name)
+                error = NameError("name '%s' does not exist" %
+                                  fcall.func_name)
+                if not self.module:
+                    raise error
+                self.forward_refs.append(('function', fcall.func_name, error))
+                func_idx = fcall.func_name
+                call = self._call_import
+            else:
+                specialization = self._specialize(func_idx, args)
+                if specialization:
+                    func_idx, args = specialization
 
-        for arg in fcall.args:
+        for arg in args:
             self.gen_value_stmt(arg)
 
         call(func_idx)
 
+    def _call_function(self, func_idx):
+        """Calls a function, or inlines it, if it's small enough"""
+        if self._can_inline(func_idx):
+            self._inline(func_idx)
+        else:
+            self.call(func_idx)
+
+    def _can_inline(self, func_idx):
+        # The function being defined isn't finished, so can't be inlined
+        # into itself
+        if self._funcs[func_idx] is None:
+            return False
+        body = self._funcs[func_idx]
+        if len(body) > self.inline_max_size:
+            return False
+        for instruction in body:
+            # Recursive functions, and calls imports not yet resolved
+            if instruction.instr == Instr.CALL and instruction.param in (
+                    func_idx, None):
+                return False
+        return True
+
+    def _inline(self, func_idx):
+        """
+        Emits a copy of a function's body in place of a CALL. The arguments
+        are on the stack, as for the call. Its locals get new slots in the
+        caller's frame, or at the toplevel, which has none, new globals. A
+        RETN jumps past the end, leaving any return value on the stack.
+        """
+        body = self._funcs[func_idx]
+        site = len(self.inlined)
+        self.inlined.append((self._func_name, self._func_list_names[func_idx],
+                             self._line_no))
+
+        num_slots = 1 + max([-1] + [
+            instruction.param for instruction in body
+            if instruction.instr in (Instr.STORE_VAR, Instr.LOAD_LOCAL)])
+        if self._locals is not None:
+            base = len(self._locals)
+            for slot in xrange(num_slots):
+                # Reserved under a name no variable can have
+                self._locals[('inline', site, slot)] = base + slot
+            slots = dict((slot, (Instr.STORE_VAR, Instr.LOAD_LOCAL,
+                                 base + slot))
+                         for slot in xrange(num_slots))
+        else:
+            # Names beginning with an underscore are private to a module
+            slots = dict((slot, (Instr.STORE_GLOBAL, Instr.LOAD_GLOBAL,
+                                 self._global_index('_<inline %d>.%d' %
+                                                    (site, slot))))
+                         for slot in xrange(num_slots))
+
+        prefix = '_inline%d' % site
+        end_label = prefix + '_end'
+        jumps_to_end = False
+        for i, instruction in enumerate(body):
+            instr, param = instruction.instr, instruction.param
+            if instr == Instr.RETN:
+                if i == len(body) - 1:
+                    # Falls through to the end anyway
+                    if instruction.labels:
+                        instr = Instr.PASS
+                    else:
+                        continue
+                else:
+                    instr, param = Instr.JMP, end_label
+                    jumps_to_end = True
+            elif instr in Instr.JUMPS:
+                param = prefix + param
+            elif instr == Instr.STORE_VAR:
+                instr, _, param = slots[param]
+            elif instr == Instr.LOAD_LOCAL:
+                _, instr, param = slots[param]
+
+            labels = [prefix + label for label in instruction.labels]
+            if self._labels:
+                labels = self._labels + labels
+                self._labels = []
+            self._code.append(Instruction(instr, param, labels,
+                                          instruction.line_no))
+        if jumps_to_end:
+            self._label_next(end_label)
+
+    ##################
+    # Specialization #
+    ##################
+    @staticmethod
+    def _bindable_params(fdef):
+        """
+        Parameters used by a function's conditions, and never assigned, so
+        which can be bound to constants
+        """
+        assigned = set()
+        in_conds = set()
+        pending = list(fdef.stmts)
+        while pending:
+            symbol = pending.pop()
+            if not isinstance(symbol, Symbol):
+                continue
+            if symbol.name == 'assign':
+                assigned.add(symbol.var)
+            cond = getattr(symbol, 'cond', None)
+            if cond is not None:
+                in_conds.update(token.text for token in cond.tokens()
+                                if token.type == 'NAME')
+            pending.extend(symbol.symbols)
+        return (set(fdef.params) & in_conds) - assigned
+
+    def _specialize(self, func_idx, args):
+        """
+        Finds or generates a clone of a function with the parameters its
+        conditions use bound to the constants a call passes for them, so
+        those conditions fold away. Other parameters are passed as usual, so
+        calls differing only in them share a clone. Each function gets at
+        most specialize_max_clones clones; calls needing another call the
+        function itself.
+
+        @return: (the clone's index, the arguments still to pass), or None to
+            call the function itself
+        """
+        if (not self.specialize_max_clones or self._discarding or
+                func_idx not in self._fdefs):
+            return None
+        fdef, bindable = self._fdefs[func_idx]
+        if len(args) != len(fdef.params):
+            # Left for the VM to raise
+            return None
+
+        consts = {}
+        for param, arg in zip(fdef.params, args):
+            if param in bindable:
+                value = self._const_value(arg)
+                if self._is_loadable(value):
+                    consts[param] = value
+        if not consts:
+            return None
+
+        # Keyed by type too, as 1 == 1.0
+        key = (func_idx, tuple((param, type(consts[param]).__name__,
+                                consts[param])
+                               for param in fdef.params if param in consts))
+        if key not in self._specializations:
+            num_clones = self._num_clones.get(func_idx, 0)
+            if num_clones >= self.specialize_max_clones:
+                return None
+            self._num_clones[func_idx] = num_clones + 1
+            # Private to the module, and not a name any source can call
+            name = '_<%s %s>' % (fdef.func_name, ', '.join(
+                '%s=%r' % (param, consts[param])
+                for param in fdef.params if param in consts))
+            with self._define_function(name, consts):
+                self._gen_function(fdef)
+            self._specializations[key] = self._func_names[name]
+
+        clone_idx = self._specializations[key]
+        self.specialized.append((fdef.func_name,
+                                 self._func_list_names[clone_idx],
+                                 self._line_no))
+        return clone_idx, [arg for param, arg in zip(fdef.params, args)
+                           if param not in consts]
+
+    def _call_import(self, name):
+        """Calls a function not defined yet, numbered by _resolve_imports"""
+        self.call(None)
+        self.import_calls.setdefault(name, []).append(self._code[-1])
+
+    def _resolve_imports(self):
+        """
+        Points calls to functions defined after them at their definitions,
+        and numbers the rest after the module's own functions
+        """
+        for name, calls in self.import_calls.iteritems():
+            if name in self._func_names:
+                func_idx = self._func_names[name]
+            else:
+                func_idx = len(self._funcs) + len(self.imported_funcs)
+                self.imported_funcs.append(name)
+            for call in calls:
+                call.param = func_idx
+
+    def symbol_table(self):
+        """
+        @return: (function names, global names), each in index order. The
+            function names are those of the functions defined, then those
+            imported.
+        """
+        global_names = [None] * len(self._globals)
+        for name, idx in self._globals.iteritems():
+            global_names[idx] = name
+        return self._func_list_names + self.imported_funcs, global_names
+
     def gen_stmt(self, stmt):
+        self._mark_line(stmt)
         if stmt.name in RESERVED_STMTS:
             self.gen_reserved(stmt)
         elif stmt.name == 'assign':
             self.gen_assign(stmt)
+        elif stmt.name == 'index_assign':
+            self.gen_index_assign(stmt)
         elif stmt.name == 'fcall':
             self.gen_fcall(stmt)
         elif stmt.name == 'value_stmt':
@@ -305,14 +849,52 @@ class BytecodeAssemblyGenerator(object):
             raise NotImplementedError('Symbol type %s' % stmt.name)
 
     def gen_fdef(self, fdef):
-        with self._define_function(fdef.func_name):
-            last_param_idx = len(fdef.params) - 1
-            for param in fdef.params:
-                self._locals[param] = idx = len(self._locals)
-                self.store_var(last_param_idx - idx)
+        if self.function_cache is not None:
+            bindable = self.function_cache.gen_function(self, fdef)
+        else:
+            bindable = self.generate_function(fdef)
+        self._fdefs[self._func_names[fdef.func_name]] = (fdef, bindable)
 
-            for stmt in fdef.stmts:
-                self.gen_stmt(stmt)
+    def generate_function(self, fdef):
+        """
+        Defines and generates a function, without consulting any function
+        cache
+
+        @return: the parameters of fdef which can be bound to constants
+        """
+        with self._define_function(fdef.func_name):
+            self._gen_function(fdef)
+        return self._bindable_params(fdef)
+
+    def _gen_function(self, fdef):
+        """Generates a function's body, without the parameters bound"""
+        self._mark_line(fdef)
+        params = [param for param in fdef.params
+                  if param not in self._local_consts]
+        last_param_idx = len(params) - 1
+        for param in params:
+            self._locals[param] = idx = len(self._locals)
+            self.store_var(last_param_idx - idx)
+
+        for stmt in fdef.stmts:
+            self.gen_stmt(stmt)
+
+    ####################
+    # Function caching #
+    ####################
+    def tables(self):
+        """
+        The tables generating a function reads and writes, by name: what a
+        function cache traces and replays (see yaksh.function_cache). Those
+        in LIST_TABLES are lists, the rest dicts.
+        """
+        return OrderedDict((name, getattr(self, '_' + name))
+                           for name in TABLES)
+
+    def replace_tables(self, tables):
+        """Puts tables, such as traced copies, in place of those named"""
+        for name, table in tables.iteritems():
+            setattr(self, '_' + name, table)
 
     #############
     # Generate! #
@@ -323,8 +905,8 @@ class BytecodeAssemblyGenerator(object):
                 self.gen_fdef(symbol)
             else:
                 self.gen_stmt(symbol)
-        if self._label:
+        if self._labels:
             self.gen_stmt(Symbol('pass_stmt', ()))
-        funcs = '\n'.join(self._funcs)
-        return '\n'.join((funcs, self._bc.getvalue()))
+        self._resolve_imports()
+        return Assembly(self._funcs, self._code, self._num_host_globals)
 
@@ -1,38 +1,123 @@
 """
-# .ysh file format
+Two binary formats are written: version 2 by default, and version 1. Both
+load, as do version 0 binaries, written in the original layout before there
+were versions, and `yaksh.vm.convert` rewrites any of them as version 2 (or
+1).
 
+# .ysh file format, version 2
+
+All integers, including instruction parameters, are unsigned LEB128 varints
+unless noted otherwise.
+
+----------------------
+ MAGIC_V2
+----------------------
+ SECTION DIRECTORY
+----------------------
+ SECTIONS
+----------------------
+
+The section directory is a count of sections, followed by each section's
+1-byte id (see Section class) and length in bytes. The sections follow in
+directory order, with no padding. Readers skip sections they don't know.
+
+STRINGS is the string pool: a count, then each distinct string as its length
+and UTF-8 bytes. Being length-prefixed, strings are found without scanning.
+
+CONSTS is a count, then each constant's 1-byte type (see Const class) and
+value: a zigzag-encoded varint for integers, a little-endian 64-bit double
+for floats, and a string pool index for strings.
+
+CODE holds the toplevel instructions. FUNCS is a count of functions, then
+each function body's length in bytes, then the bodies back to back. The
+lengths let the VM decode each function on its first CALL. CODE is written
+before FUNCS, so a streaming reader (see yaksh.vm.StreamingMachine) can start
+running the toplevel before the functions have arrived.
+
+An instruction is its 1-byte type, followed by its parameter, if it takes
+one. Jump parameters are the index of the target instruction within the same
+body, so no PROC, MAKE_FUNCTION or EXTENDED_ARG instructions are needed.
+
+LINES, written when the assembly has .line directives, maps instructions back
+to source lines. It's a count of line tables: one per function, then one for
+the toplevel. Each table is a count of entries, then each entry as the change
+in instruction index from the previous entry, and the zigzag-encoded change in
+line number (both starting from 0). An entry's line applies to the
+instructions from its index up to the next entry's.
+
+SYMBOLS makes the binary a relocatable object file (see yaksh.linker). It's
+a count of function names, then each name (its length, then its bytes), and
+the same for global names. The function names are those of the functions in
+FUNCS, then those of functions called but defined elsewhere, numbered after
+them.
+
+
+# .ysh file format, version 1
+
+-----------------
+ MAGIC
 -----------------
  CONSTANTS
+-----------------
+ FUNCTION INDEX
 -----------------
  FUNCTIONS
 -----------------
  TOP-LEVEL CODE
 -----------------
 
-The constants table begins with a 32-bit unsigned integer denoting the size of
-the table. Each constant is comprised of a 1-byte type identifier (see Const
-class), and a variable number of bytes depending on the type. Floats and
-integers use a fixed 4-byte word. Strings are variable-length and
-null-terminated.
+The constants table begins with two 32-bit unsigned integers denoting the size
+of the table's data in bytes, and the number of constants. Then comes an index
+of 32-bit offsets to each constant, relative to the start of the data. Each
+constant is comprised of a 1-byte type identifier (see Const class), and a
+variable number of bytes depending on the type. Floats and integers use a
+fixed 4-byte word. Strings are variable-length and null-terminated.
+
+The function index is a 32-bit count of functions, followed by count + 1
+32-bit offsets: one to each function's PROC, and a final one to the top-level
+code. Offsets are relative to the start of the functions section, as are jump
+pointers. The index lets the VM decode each function on its first CALL, and
+each constant on its first LOAD_CONST.
 
 The functions section is comprised of function definitions, each delimited by
-a PROC and MAKE_FUNCTION. The end of the section is the last MAKE_FUNCTION call
-preceded by a PROC.
+a PROC and MAKE_FUNCTION.
 
 The top-level code section is comprised of pure instructions to be run.
 
 Every instruction begins with 1 byte denoting the instruction type. Depending
-on the type, there may be a 1-byte parameter which follows.
+on the type, there may be a 1-byte parameter which follows. Parameters which
+don't fit in a byte are preceded by EXTENDED_ARG instructions, each carrying
+the next most significant byte of the parameter. Jump pointers are always a
+32-bit word.
+
+
+Version 1 has no line table.
+
+
+# .ysh file format, version 0
+
+The original layout, under MAGIC_V0. It's version 1 without the indexes: the
+constants table is only its 32-bit size in bytes and the constants, and the
+functions follow it directly, so they can only be found by decoding them in
+order. Parameters are a single byte, with no EXTENDED_ARG, and jump pointers
+are 16-bit words, relative to the start of the functions section. The VM
+decodes these binaries in full as it loads them.
 
 
 Extra notes:
  - The LOAD_CONST instruction accepts a string parameter in assembly. This
    value is packed and placed in the constants table. In the generated
    bytecode, the parameter is replaced with an index into the constants table.
+ - The `.line N` directive in assembly marks the instructions after it as
+   coming from source line N (counting from 1).
+ - The `.host_globals N` directive, before any instruction, says the first N
+   globals are provided by the embedding host (see Assembly.host_globals).
+   The assembler itself ignores it.
 """
+import hashlib
+import shutil
 import struct
-from collections import defaultdict
-from os import SEEK_SET, SEEK_END
+import tempfile
 
 try:
     from cStringIO import StringIO
@@ -40,7 +125,11 @@ except ImportError:
     from StringIO import StringIO
 
 
-MAGIC = '\x42YAK'
+# The original layout, without indexes, which is read but no longer written
+MAGIC_V0 = '\x42YAK'
+MAGIC = '\x42YK1'
+MAGIC_V2 = '\x42YK2'
+FORMAT_VERSION = 2
 PYTHON_RESERVED = ('pass',)
 
 
@@ -48,13 +137,16 @@ class _InstrMeta(type):
     def __new__(meta, name, bases, attrs):
         cls = type.__new__(meta, name, bases, attrs)
         names = {}
+        asm_names = {}
         for name, value in attrs.iteritems():
             if isinstance(value, int):
+                asm_names[value] = name
                 name = name.lower()
                 if name in PYTHON_RESERVED:
                     name = 'y_' + name
                 names[value] = name
         cls._names = names
+        cls._asm_names = asm_names
         return cls
 
 
@@ -80,6 +172,20 @@ class Instr(object):
     JNZ             = 17
     JMP             = 18
     CMP             = 19
+    BUILD_LIST      = 20
+    BUILD_MAP       = 21
+    LOAD_INDEX      = 22
+    STORE_INDEX     = 23
+    LEN             = 24
+    EXTENDED_ARG    = 25
+    POP             = 26
+    DUP             = 27
+    # ADD, MULT and CMP of operands known to be numbers, or strings (see
+    # yaksh.typeinfer)
+    ADD_NUM         = 28
+    ADD_STR         = 29
+    MULT_NUM        = 30
+    CMP_NUM         = 31
 
     NO_PARAMS = (
         ADD,
@@ -90,6 +196,14 @@ class Instr(object):
         PROC,
         MAKE_FUNCTION,
         PASS,
+        LOAD_INDEX,
+        STORE_INDEX,
+        LEN,
+        POP,
+        DUP,
+        ADD_NUM,
+        ADD_STR,
+        MULT_NUM,
     )
 
     JUMPS = {
@@ -107,6 +221,10 @@ class Instr(object):
         LOAD_LOCAL,
         CALL_BUILTIN,
         CMP,
+        CMP_NUM,
+        BUILD_LIST,
+        BUILD_MAP,
+        EXTENDED_ARG,
     }.union(JUMPS)
 
 
@@ -132,6 +250,15 @@ class Const(object):
         return struct.pack('B', t) + v_p
 
 
+class Section(object):
+    STRINGS = 1
+    CONSTS  = 2
+    FUNCS   = 3
+    CODE    = 4
+    LINES   = 5
+    SYMBOLS = 6
+
+
 class _CompareMeta(type):
     def __new__(meta, name, bases, attrs):
         cls = type.__new__(meta, name, bases, attrs)
@@ -170,54 +297,228 @@ class Compare(object):
             raise NotImplementedError('Unknown comparison op %d' % op)
 
 
-def assemble(asm):
-    # Note: this assumes function definitions are already at the top of the
-    #       assembly. This is unnecessary, but makes the assembler simpler.
+class Instruction(object):
+    """
+    An instruction of in-memory assembly.
+
+    @ivar param: None, an int, the label name of a jump's target, or the value
+        loaded by LOAD_CONST
+    @ivar labels: names of the labels pointing at this instruction
+    @ivar line_no: source line the instruction was compiled from, or None
+    """
+    __slots__ = ('instr', 'param', 'labels', 'line_no')
+
+    def __init__(self, instr, param=None, labels=(), line_no=None):
+        self.instr = instr
+        self.param = param
+        self.labels = labels
+        self.line_no = line_no
+
+    def __eq__(self, other):
+        return (isinstance(other, Instruction) and
+                self.instr == other.instr and
+                type(self.param) is type(other.param) and
+                self.param == other.param and
+                list(self.labels) == list(other.labels) and
+                self.line_no == other.line_no)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<Instruction %s>' % _dump_instruction(self)
+
+
+class Assembly(object):
+    """
+    In-memory assembly, as produced by BytecodeAssemblyGenerator and consumed
+    by the assembler: a list of Instructions for each function, and one for
+    the toplevel.
+
+    Textual assembly is a dump and load format for it: str(assembly) and
+    load_assembly(text).
+
+    @ivar host_globals: number of globals, numbered first, which the
+        embedding host provides and may read or store, so whose values the
+        optimizer can't know
+    """
+
+    def __init__(self, funcs=None, toplevel=None, host_globals=0):
+        self.funcs = funcs if funcs is not None else []
+        self.toplevel = toplevel if toplevel is not None else []
+        self.host_globals = host_globals
+
+    @property
+    def bodies(self):
+        """The function bodies, then the toplevel"""
+        return self.funcs + [self.toplevel]
+
+    def __eq__(self, other):
+        return (isinstance(other, Assembly) and self.funcs == other.funcs and
+                self.toplevel == other.toplevel and
+                self.host_globals == other.host_globals)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return dump_assembly(self)
+
+
+def assemble(asm, version=FORMAT_VERSION):
+    """
+    Assembles yaksh assembly, an Assembly or its text, into a binary of the
+    given format version
+    """
+    return write_program(*parse_assembly(asm), version=version)
 
-    out = StringIO()
-    # List of packed constants
+
+def parse_assembly(asm):
+    """
+    Collects the constants, functions and toplevel code of yaksh assembly,
+    resolving labels and constants to indices.
+
+    @param asm: an Assembly, or its text
+    @return: (consts, funcs, toplevel, lines), where consts is a list of
+        values, and funcs and toplevel are lists of (instr, param) tuples.
+        Jump parameters are the index of their target instruction. lines
+        holds a line table for each function, then one for the toplevel: a
+        list of (instruction index, source line) pairs.
+    """
+    if isinstance(asm, basestring):
+        asm = load_assembly(asm)
+
+    # List of constant values
     consts = []
-    # Hash table of packed constants, to remove unnecessary duplication
+    # Hash table of constants, to remove unnecessary duplication. Keyed by
+    # type too, as 1 == 1.0
     consts_table = {}
-    # Map of labels to `out` indices
-    labels = [{}]
-    # Label locations in `out` to replace with pointers
-    label_rplc = [defaultdict(list)]
-
-    def _replace_labels():
-        for label, rpl_locs in label_rplc[-1].iteritems():
-            if label not in labels[-1]:
-                raise ValueError("Unknown label '%s'" % label)
-            for loc in rpl_locs:
-                local_offs = labels[-1][label]
-                out.seek(loc, SEEK_SET)
-                out.write(struct.pack('H', local_offs))
-                out.seek(0, SEEK_END)
-
-    def _pop_labels():
-        labels.pop()
-        label_rplc.pop()
-
-    def _push_labels():
-        labels.append({})
-        label_rplc.append(defaultdict(list))
-
-    for line in asm.split('\n'):
+    bodies = []
+    lines = []
+    for body in asm.bodies:
+        labels = {}
+        for i, instruction in enumerate(body):
+            for label in instruction.labels:
+                if label in labels:
+                    raise ValueError("Label '%s' already exists" % label)
+                labels[label] = i
+
+        code = []
+        code_lines = []
+        for i, instruction in enumerate(body):
+            instr = instruction.instr
+            param = instruction.param
+            if instr in Instr.JUMPS:
+                if param not in labels:
+                    raise ValueError("Unknown label '%s'" % param)
+                param = labels[param]
+            elif instr == Instr.LOAD_CONST:
+                key = (type(param), param)
+                if key in consts_table:
+                    param = consts_table[key]
+                else:
+                    consts.append(param)
+                    param = consts_table[key] = len(consts) - 1
+            code.append((instr, param))
+
+            line_no = instruction.line_no
+            if line_no is not None and (not code_lines or
+                                        code_lines[-1][1] != line_no):
+                code_lines.append((i, line_no))
+
+        bodies.append(code)
+        lines.append(code_lines)
+    return consts, bodies[:-1], bodies[-1], lines
+
+
+def build_assembly(consts, funcs, toplevel, lines=None, host_globals=0):
+    """
+    The inverse of parse_assembly: in-memory assembly of a decoded program,
+    with a label at each jump target
+
+    @param lines: a line table for each function, then one for the toplevel,
+        or None if there are none
+    @param host_globals: see Assembly
+    """
+    consts = list(consts)
+    bodies = []
+    for body_idx, code in enumerate(funcs + [toplevel]):
+        targets = set(param for instr, param in code if instr in Instr.JUMPS)
+        if len(code) in targets:
+            # A jump to the end needs an instruction to land on
+            code = code + [(Instr.PASS, None)]
+        line_changes = dict(lines[body_idx]) if lines else {}
+        line_no = None
+        body = []
+        for i, (instr, param) in enumerate(code):
+            if instr in Instr.JUMPS:
+                param = 'L%d' % param
+            elif instr == Instr.LOAD_CONST:
+                param = consts[param]
+            line_no = line_changes.get(i, line_no)
+            labels = ['L%d' % i] if i in targets else []
+            body.append(Instruction(instr, param, labels, line_no))
+        bodies.append(body)
+    return Assembly(bodies[:-1], bodies[-1], host_globals)
+
+
+def load_assembly(asm):
+    """Parses the text of yaksh assembly into an Assembly"""
+    assembly = Assembly()
+    code = []
+    for instruction in _read_assembly(asm.split('\n'), assembly):
+        if instruction is None:
+            assembly.funcs.append(code)
+            code = []
+        elif instruction.instr != Instr.PROC:
+            code.append(instruction)
+    assembly.toplevel = code
+    return assembly
+
+
+def _read_assembly(lines, assembly=None):
+    """
+    Parses lines of yaksh assembly, yielding each Instruction, with a PROC
+    instruction at the start of each function, and None at its end
+
+    @param assembly: an Assembly to set the .host_globals directive on
+    """
+    # Note: this assumes function definitions are already at the top of the
+    #       assembly. This is unnecessary, but makes the assembler simpler.
+
+    # Number of instructions in the current function, or the toplevel
+    code_len = 0
+    in_function = False
+    # Labels for the next instruction
+    labels = []
+    # Source line of the following instructions, from .line directives
+    line_no = None
+    started = False
+
+    for line in lines:
         line = line.strip()
         if not line:
             continue
 
+        if line.startswith('.'):
+            directive, value = _parse_directive(line)
+            if directive == '.line':
+                line_no = value
+            elif started:
+                raise ValueError('.host_globals must precede all instructions')
+            elif assembly is not None:
+                assembly.host_globals = value
+            continue
+
+        started = True
         s_instr, _, arg = line.partition(' ')
-        if s_instr.endswith(':'):
+        while s_instr.endswith(':'):
             if not s_instr[0].isalpha():
                 if len(s_instr) == 1:
                     raise ValueError('Empty label')
                 elif not s_instr[0] == '_':
                     raise ValueError("Invalid label name '%s'" % s_instr[:-1])
-            label_name = s_instr[:-1]
-            if label_name in labels:
-                raise ValueError("Label '%s' already exists" % label_name)
-            labels[-1][label_name] = out.tell()
+            labels.append(s_instr[:-1])
 
             # Redo the partition on the rest of the line
             s_instr, _, arg = arg.lstrip().partition(' ')
@@ -233,54 +534,546 @@ def assemble(asm):
         elif instr in Instr.ONE_PARAM and not arg:
             raise ValueError("Instruction '%s' takes one parameter" % s_instr)
 
-        out.write(struct.pack('B', instr))
-        if instr in Instr.NO_PARAMS:
-            if instr == Instr.MAKE_FUNCTION:
-                _replace_labels()
-                _pop_labels()
-            elif instr == Instr.PROC:
-                _push_labels()
+        if instr == Instr.PROC:
+            if in_function:
+                raise ValueError('PROC inside a function')
+            if code_len:
+                raise ValueError('Function definitions must precede '
+                                 'toplevel code')
+            if labels:
+                raise ValueError("Label '%s' precedes a PROC" % labels[0])
+            yield Instruction(Instr.PROC)
+            in_function = True
+            line_no = None
             continue
-        elif instr == Instr.LOAD_CONST:
-            if arg[0] in ('"', "'"):
-                if len(arg) == 1 or arg[-1] != arg[0]:
-                    raise ValueError('Malformed string constant: %s' % arg)
-                v = arg[1:-1]
-            elif '.' in arg:
-                try:
-                    v = float(arg)
-                except ValueError:
-                    raise ValueError('Malformed float constant: %s' % arg)
-            else:
-                try:
-                    v = int(arg)
-                except ValueError:
-                    raise ValueError('Malformed int constant: %s' % arg)
-
-            packed = Const.pack(v)
-            if packed in consts_table:
-                idx = consts_table[packed]
-            else:
-                idx = len(consts)
-                consts.append(packed)
-                consts_table[packed] = idx
-            param = idx
-        elif instr in Instr.JUMPS:
-            label_rplc[-1][arg].append(out.tell())
-            out.write(struct.pack('H', 0))
+        elif instr == Instr.MAKE_FUNCTION:
+            if not in_function:
+                raise ValueError('MAKE_FUNCTION without a PROC')
+            if labels:
+                # Labels at the end of the function jump past its last
+                # instruction
+                yield Instruction(Instr.PASS, None, labels, line_no)
+                labels = []
+            yield None
+            in_function = False
+            code_len = 0
+            line_no = None
             continue
+        elif instr == Instr.EXTENDED_ARG:
+            raise ValueError('EXTENDED_ARG is only emitted by the assembler')
+        elif instr in Instr.JUMPS:
+            param = arg
+        elif instr in Instr.NO_PARAMS:
+            param = None
+        else:
+            param = _parse_param(instr, arg)
+
+        yield Instruction(instr, param, labels, line_no)
+        code_len += 1
+        labels = []
+
+    if in_function:
+        raise ValueError('PROC without a MAKE_FUNCTION')
+    if labels:
+        yield Instruction(Instr.PASS, None, labels, line_no)
+
+
+def _parse_directive(line):
+    """
+    Parses a .line or .host_globals directive
+
+    @return: (the directive, its number)
+    """
+    directive, _, arg = line.partition(' ')
+    if directive not in ('.line', '.host_globals'):
+        raise ValueError("Unknown directive '%s'" % directive)
+    try:
+        return directive, int(arg)
+    except ValueError:
+        raise ValueError('Malformed %s number: %s' % (directive[1:], arg))
+
+
+def _parse_param(instr, arg):
+    if instr != Instr.LOAD_CONST:
+        try:
+            param = int(arg)
+        except ValueError:
+            raise ValueError('Malformed parameter: %s' % arg)
+        if param < 0:
+            raise ValueError('Negative parameter: %s' % arg)
+        return param
+
+    if arg[0] in ('"', "'"):
+        if len(arg) == 1 or arg[-1] != arg[0]:
+            raise ValueError('Malformed string constant: %s' % arg)
+        try:
+            return arg[1:-1].decode('string_escape')
+        except ValueError:
+            raise ValueError('Malformed string constant: %s' % arg)
+    try:
+        return int(arg)
+    except ValueError:
+        pass
+    try:
+        return float(arg)
+    except ValueError:
+        raise ValueError('Malformed constant: %s' % arg)
+
+
+def dump_assembly(assembly):
+    """Writes an Assembly as text, which load_assembly reads back"""
+    out = []
+    if assembly.host_globals:
+        out.append('.host_globals %d' % assembly.host_globals)
+    bodies = [(True, func) for func in assembly.funcs]
+    bodies.append((False, assembly.toplevel))
+    for is_func, body in bodies:
+        if is_func:
+            out.append('PROC')
+        line_no = None
+        for instruction in body:
+            if (instruction.line_no is not None and
+                    instruction.line_no != line_no):
+                line_no = instruction.line_no
+                out.append('.line %d' % line_no)
+            out.append(_dump_instruction(instruction))
+        if is_func:
+            out.append('MAKE_FUNCTION')
+        out.append('')
+    return '\n'.join(out)
+
+
+def _dump_instruction(instruction):
+    text = Instr._asm_names[instruction.instr]
+    param = instruction.param
+    if isinstance(param, str):
+        if instruction.instr == Instr.LOAD_CONST:
+            text += " '%s'" % param.encode('string_escape')
+        else:
+            text += ' ' + param
+    elif isinstance(param, float):
+        text += ' ' + repr(param)
+    elif param is not None:
+        text += ' %d' % param
+    if instruction.labels:
+        text = ''.join(label + ': ' for label in instruction.labels) + text
+    return text
+
+
+def write_program(consts, funcs, toplevel, lines=None,
+                  version=FORMAT_VERSION, symbols=None):
+    """
+    Serializes a program, in the form returned by parse_assembly (and
+    AbstractMachine.decode_all), as a binary of the given format version.
+    Version 1 binaries drop the line tables.
+
+    @param symbols: (function names, global names), to write an object file
+    """
+    if version == 1:
+        if symbols is not None:
+            raise ValueError('Object files need format version 2')
+        return _write_v1(consts, funcs, toplevel)
+    elif version == 2:
+        return _write_v2(consts, funcs, toplevel, lines, symbols)
+    else:
+        raise ValueError('Unknown format version %r' % version)
+
+
+#############
+# Version 1 #
+#############
+def _v1_size(instr, param):
+    if instr in Instr.JUMPS:
+        return 5
+    elif instr in Instr.NO_PARAMS:
+        return 1
+    else:
+        size = 2
+        param >>= 8
+        while param:
+            size += 2
+            param >>= 8
+        return size
+
+
+def _write_v1_body(out, code, offset):
+    """
+    Writes instructions to the list `out`, and returns the offset after them.
+
+    @param offset: offset of the first instruction from the start of the
+        functions section, which jump pointers are relative to
+    """
+    offsets = []
+    for instr, param in code:
+        offsets.append(offset)
+        offset += _v1_size(instr, param)
+    offsets.append(offset)
+
+    for instr, param in code:
+        if instr in Instr.JUMPS:
+            out.append(struct.pack('=BI', instr, offsets[param]))
+        elif instr in Instr.NO_PARAMS:
+            out.append(chr(instr))
+        else:
+            out.append(_extended_arg_prefix(param))
+            out.append(struct.pack('BB', instr, param & 0xff))
+    return offset
+
+
+def _write_v1(consts, funcs, toplevel):
+    packed_consts = [Const.pack(v) for v in consts]
+    const_offsets = []
+    offset = 0
+    for packed in packed_consts:
+        const_offsets.append(offset)
+        offset += len(packed)
+
+    code = []
+    func_offsets = []
+    code_offset = 0
+    for func in funcs:
+        func_offsets.append(code_offset)
+        code.append(chr(Instr.PROC))
+        code_offset = _write_v1_body(code, func, code_offset + 1)
+        code.append(chr(Instr.MAKE_FUNCTION))
+        code_offset += 1
+    func_offsets.append(code_offset)
+    _write_v1_body(code, toplevel, code_offset)
+
+    return ''.join((
+        MAGIC,
+        struct.pack('II', offset, len(consts)),
+        _pack_offsets(const_offsets),
+        ''.join(packed_consts),
+        struct.pack('I', len(funcs)),
+        _pack_offsets(func_offsets),
+        ''.join(code),
+    ))
+
+
+def _extended_arg_prefix(param):
+    """
+    Returns the EXTENDED_ARG instructions carrying all but the least
+    significant byte of param, most significant first.
+    """
+    prefix = []
+    param >>= 8
+    while param:
+        prefix.append(struct.pack('BB', Instr.EXTENDED_ARG, param & 0xff))
+        param >>= 8
+    return ''.join(reversed(prefix))
+
+
+def _pack_offsets(offsets):
+    return struct.pack('%dI' % len(offsets), *offsets)
+
+
+#############
+# Version 2 #
+#############
+_DOUBLE = struct.Struct('<d')
+
+
+def varint(n):
+    """Encodes a non-negative int as an unsigned LEB128 varint"""
+    if n < 0x80:
+        return chr(n)
+    out = []
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+
+def zigzag(n):
+    """Maps signed ints to unsigned, keeping small magnitudes small"""
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def _write_v2_body(code):
+    out = []
+    for instr, param in code:
+        out.append(chr(instr))
+        if param is not None:
+            out.append(varint(param))
+    return ''.join(out)
+
+
+def _write_v2_lines(lines):
+    out = [varint(len(lines))]
+    for table in lines:
+        out.append(varint(len(table)))
+        last_index = last_line = 0
+        for index, line_no in table:
+            out.append(varint(index - last_index))
+            out.append(varint(zigzag(line_no - last_line)))
+            last_index, last_line = index, line_no
+    return ''.join(out)
+
+
+def _write_v2_symbols(symbols):
+    out = []
+    for names in symbols:
+        out.append(varint(len(names)))
+        for name in names:
+            out.append(varint(len(name)))
+            out.append(name)
+    return ''.join(out)
+
+
+def _write_v2(consts, funcs, toplevel, lines=None, symbols=None):
+    strings = []
+    strings_table = {}
+    p_consts = [varint(len(consts))]
+    for v in consts:
+        if isinstance(v, (int, long)):
+            p_consts.append(chr(Const.INT) + varint(zigzag(v)))
+        elif isinstance(v, float):
+            p_consts.append(chr(Const.FLOAT) + _DOUBLE.pack(v))
+        elif isinstance(v, str):
+            if v not in strings_table:
+                strings_table[v] = len(strings)
+                strings.append(v)
+            p_consts.append(chr(Const.STRING) + varint(strings_table[v]))
         else:
-            try:
-                param = int(arg)
-            except ValueError:
-                raise ValueError('Malformed parameter: %s' % arg)
+            raise NotImplementedError()
+
+    p_strings = [varint(len(strings))]
+    for v in strings:
+        p_strings.append(varint(len(v)))
+        p_strings.append(v)
+
+    bodies = [_write_v2_body(func) for func in funcs]
+    p_funcs = [varint(len(bodies))]
+    p_funcs.extend(varint(len(body)) for body in bodies)
+    p_funcs.extend(bodies)
+
+    # The toplevel comes before the functions, so a streaming reader can
+    # begin running it sooner
+    sections = [
+        (Section.STRINGS, ''.join(p_strings)),
+        (Section.CONSTS, ''.join(p_consts)),
+        (Section.CODE, _write_v2_body(toplevel)),
+        (Section.FUNCS, ''.join(p_funcs)),
+    ]
+    if lines and any(lines):
+        sections.append((Section.LINES, _write_v2_lines(lines)))
+    if symbols is not None:
+        sections.append((Section.SYMBOLS, _write_v2_symbols(symbols)))
+    return write_sections(sections)
+
+
+def write_sections(sections):
+    """Lays out a version 2 binary from (section id, data) pairs"""
+    directory = [varint(len(sections))]
+    for section_id, data in sections:
+        directory.append(chr(section_id) + varint(len(data)))
+    return ''.join([MAGIC_V2] + directory + [data for _, data in sections])
+
+
+#############
+# Streaming #
+#############
+# Strings longer than this are deduplicated by hash, rather than by keeping
+# them in memory
+_HASHED_STRING_LENGTH = 64
+
+
+def assemble_stream(lines, out):
+    """
+    Assembles textual assembly into a version 2 binary, in memory bounded by
+    the assembly's largest function, rather than its size.
+
+    The output is the same as assemble()'s. Sections are spilled to temporary
+    files as they're built, and each body's instructions are encoded as soon
+    as no forward jumps in them are waiting on a label. What's kept in memory
+    is the table of distinct constants (with long strings reduced to hashes),
+    each body's labels, and the instructions spanned by unresolved forward
+    jumps.
+
+    @param lines: iterable of lines of assembly, such as a file
+    @param out: file-like object the binary is written to
+    """
+    if isinstance(lines, basestring):
+        lines = lines.split('\n')
+
+    spills = []
+
+    def _spill():
+        spill = tempfile.TemporaryFile()
+        spills.append(spill)
+        return spill
+
+    try:
+        consts = _StreamingConsts(_spill(), _spill())
+        func_lengths = _spill()
+        func_bodies = _spill()
+        code = _spill()
+        lines_out = _spill()
+        toplevel_lines = _spill()
+
+        num_funcs = 0
+        num_line_entries = 0
+        body = toplevel = _StreamingBody(consts, code, toplevel_lines)
+        for instruction in _read_assembly(lines):
+            if instruction is None:
+                body.finish()
+                func_lengths.write(varint(body.size))
+                lines_out.write(varint(body.num_lines))
+                lines_out.write(body.lines_out.getvalue())
+                num_line_entries += body.num_lines
+                num_funcs += 1
+                body = toplevel
+            elif instruction.instr == Instr.PROC:
+                # A function's line table is small enough to keep in memory
+                body = _StreamingBody(consts, func_bodies, StringIO())
+            else:
+                body.add(instruction)
+
+        toplevel.finish()
+        lines_out.write(varint(toplevel.num_lines))
+        _copy(toplevel_lines, lines_out)
+        num_line_entries += toplevel.num_lines
+
+        sections = [
+            (Section.STRINGS, varint(consts.num_strings), consts.strings_out),
+            (Section.CONSTS, varint(consts.count), consts.consts_out),
+            (Section.CODE, '', code),
+            (Section.FUNCS, varint(num_funcs), func_lengths, func_bodies),
+        ]
+        if num_line_entries:
+            sections.append((Section.LINES, varint(num_funcs + 1), lines_out))
+
+        out.write(MAGIC_V2)
+        out.write(varint(len(sections)))
+        for section in sections:
+            section_id, prefix = section[:2]
+            length = len(prefix) + sum(_size(f) for f in section[2:])
+            out.write(chr(section_id) + varint(length))
+        for section in sections:
+            out.write(section[1])
+            for f in section[2:]:
+                _copy(f, out)
+    finally:
+        for spill in spills:
+            spill.close()
+
+
+def _size(f):
+    f.seek(0, 2)
+    return f.tell()
+
+
+def _copy(src, dst):
+    src.seek(0)
+    shutil.copyfileobj(src, dst)
+
+
+class _StreamingConsts(object):
+    """Builds the CONSTS and STRINGS sections, deduplicating constants"""
+
+    def __init__(self, consts_out, strings_out):
+        self.consts_out = consts_out
+        self.strings_out = strings_out
+        self.count = 0
+        self.num_strings = 0
+        self.table = {}
+
+    def index(self, v):
+        if isinstance(v, str) and len(v) > _HASHED_STRING_LENGTH:
+            key = (str, len(v), hashlib.sha1(v).digest())
+        else:
+            # Keyed by type too, as 1 == 1.0
+            key = (type(v), v)
+        idx = self.table.get(key)
+        if idx is not None:
+            return idx
+
+        if isinstance(v, (int, long)):
+            self.consts_out.write(chr(Const.INT) + varint(zigzag(v)))
+        elif isinstance(v, float):
+            self.consts_out.write(chr(Const.FLOAT) + _DOUBLE.pack(v))
+        elif isinstance(v, str):
+            # Constants are distinct, so every string is new to the pool
+            self.strings_out.write(varint(len(v)))
+            self.strings_out.write(v)
+            self.consts_out.write(chr(Const.STRING) + varint(self.num_strings))
+            self.num_strings += 1
+        else:
+            raise NotImplementedError()
+        idx = self.table[key] = self.count
+        self.count += 1
+        return idx
+
+
+class _StreamingBody(object):
+    """
+    Encodes the instructions of a function or the toplevel to `out`, holding
+    back only those following a forward jump whose label hasn't been seen.
+    """
+
+    def __init__(self, consts, out, lines_out):
+        self.consts = consts
+        self.out = out
+        # Encoded line table entries
+        self.lines_out = lines_out
+        self.num_lines = 0
+        self._last_index = self._last_line = 0
+        self.size = 0
+        # Instructions added
+        self.count = 0
+        # Map of labels to instruction indices
+        self.labels = {}
+        # [instr, param] of the instructions held back
+        self._buffer = []
+        # Map of unseen labels to the indices in _buffer of jumps to them
+        self._forward = {}
+
+    def add(self, instruction):
+        index = self.count
+        self.count += 1
+        for label in instruction.labels:
+            if label in self.labels:
+                raise ValueError("Label '%s' already exists" % label)
+            self.labels[label] = index
+            for i in self._forward.pop(label, ()):
+                self._buffer[i][1] = index
+
+        instr = instruction.instr
+        param = instruction.param
+        if instr in Instr.JUMPS:
+            if param in self.labels:
+                param = self.labels[param]
+            else:
+                self._forward.setdefault(param, []).append(len(self._buffer))
+        elif instr == Instr.LOAD_CONST:
+            param = self.consts.index(param)
 
-        out.write(struct.pack('B', param))
+        self._buffer.append([instr, param])
+        self._add_line(index, instruction.line_no)
+        if not self._forward:
+            self._flush()
 
-    _replace_labels()
+    def _add_line(self, index, line_no):
+        if line_no is None or (self.num_lines and line_no == self._last_line):
+            return
+        self.lines_out.write(varint(index - self._last_index))
+        self.lines_out.write(varint(zigzag(line_no - self._last_line)))
+        self._last_index, self._last_line = index, line_no
+        self.num_lines += 1
 
-    p_consts = ''.join(consts)
-    p_const_size = struct.pack('I', len(p_consts))
-    p_pieces = out.getvalue()
+    def _flush(self):
+        data = _write_v2_body(self._buffer)
+        self.out.write(data)
+        self.size += len(data)
+        del self._buffer[:]
 
-    return ''.join((MAGIC, p_const_size, p_consts, p_pieces))
+    def finish(self):
+        if self._forward:
+            raise ValueError("Unknown label '%s'" % next(iter(self._forward)))
+        self._flush()
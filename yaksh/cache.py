@@ -0,0 +1,85 @@
+"""
+An on-disk cache of decoded programs, the .pyc of yaksh.
+
+Loading a program normally means checking the magic, then decoding constants,
+function bodies and jump pointers. The cache stores the fully decoded form
+(see AbstractMachine.decode_all), and any symbol table, marshalled, keyed by
+a hash of the binary's contents -- or, for .yk sources, of the source, which
+skips compilation too.
+A source that misses is compiled reusing the functions it shares with those
+compiled before (see yaksh.function_cache), kept in the functions/
+subdirectory.
+
+Each cache file begins with CACHE_MAGIC and CACHE_VERSION. Bump CACHE_VERSION
+whenever the decoded form changes, and stale entries are rebuilt.
+"""
+import hashlib
+import os
+
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import assemble
+from yaksh.cachefile import read_cache_file, write_cache_file
+from yaksh.function_cache import FunctionCache, split_source
+from yaksh.lexer import lex_fast
+from yaksh.optimizer import optimize
+from yaksh.parser import parse
+from yaksh.vm import AbstractMachine
+
+
+CACHE_MAGIC = 'YKC'
+CACHE_VERSION = 3
+SOURCE_EXT = '.yk'
+
+
+def default_cache_dir():
+    return os.environ.get('YAKSH_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache',
+                                       'yaksh'))
+
+
+def compile_source(source, function_cache=None):
+    """
+    @param function_cache: a FunctionCache to reuse the code generated for
+        unchanged functions from
+    """
+    if function_cache is not None:
+        symbols = split_source(source)
+    else:
+        symbols = parse(lex_fast(source))
+    asm = BytecodeAssemblyGenerator(symbols,
+                                    function_cache=function_cache).generate()
+    optimize(asm)
+    return assemble(asm)
+
+
+def _cache_path(cache_dir, data, kind):
+    digest = hashlib.sha1(data).hexdigest()
+    return os.path.join(cache_dir, '%s.%s.ykc' % (digest, kind))
+
+
+def load(path, cache_dir=None):
+    """
+    Returns an AbstractMachine for the .ysh binary or .yk source at path,
+    from the cache if possible.
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    is_source = path.endswith(SOURCE_EXT)
+    cache_path = _cache_path(cache_dir, data, 'src' if is_source else 'bin')
+
+    decoded = read_cache_file(cache_path, CACHE_MAGIC, CACHE_VERSION)
+    if decoded is not None:
+        return AbstractMachine.from_decoded(*decoded)
+
+    if is_source:
+        functions = FunctionCache(os.path.join(cache_dir, 'functions'))
+        bytecode = compile_source(data, functions)
+    else:
+        bytecode = data
+    am = AbstractMachine(bytecode)
+    write_cache_file(cache_path, CACHE_MAGIC, CACHE_VERSION,
+                     am.decode_all() + (am.symbol_table(),))
+    return am
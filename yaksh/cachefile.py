@@ -0,0 +1,62 @@
+"""
+The files yaksh keeps on disk between runs: caches, and object files.
+
+A cache file begins with a three-byte magic, naming the kind of cache, and
+a version byte, followed by a marshalled value. One whose header doesn't
+match what the reader expects, or which is corrupt, reads as a miss, so
+stale or damaged entries are simply rebuilt.
+
+Files are written to a temporary file first and renamed into place, so
+concurrent builds and loads never see one partially written.
+"""
+import marshal
+import os
+import struct
+import tempfile
+
+
+_HEADER = struct.Struct('3sB')
+
+
+def read_cache_file(path, magic, version):
+    """
+    @return: the value cached at path, or None if there isn't one, or it's
+        stale or corrupt
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+
+    try:
+        if _HEADER.unpack_from(data) != (magic, version):
+            return None
+        return marshal.loads(data[_HEADER.size:])
+    except (struct.error, ValueError, EOFError, TypeError):
+        return None
+
+
+def write_cache_file(path, magic, version, value):
+    """Caches a marshallable value at path"""
+    write_atomic(path, _HEADER.pack(magic, version) + marshal.dumps(value))
+
+
+def write_atomic(path, data):
+    """Writes data to path, creating its directory if need be"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
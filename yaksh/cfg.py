@@ -0,0 +1,239 @@
+"""
+Control-flow graphs of in-memory assembly, and dataflow analyses over them.
+
+A ControlFlowGraph splits a body (a list of Instructions, as in an Assembly)
+into basic blocks: runs of instructions only entered at the top and only left
+at the bottom. A block ends at a jump or RETN, or before a jump target.
+
+solve() is a generic iterative dataflow solver. The analyses built on it work
+on the local slots of a function body (STORE_VAR and LOAD_LOCAL):
+ - dominators: the blocks every path from the entry passes through
+ - liveness: the slots whose current value may still be loaded
+ - reaching_definitions: the STORE_VARs whose value may still be in a slot
+"""
+from collections import deque
+
+from yaksh.bytecode_compiler import Instr
+
+
+_BLOCK_ENDS = Instr.JUMPS | set([Instr.RETN])
+
+
+class BasicBlock(object):
+    """
+    body[start:end] of a ControlFlowGraph's body
+
+    @ivar succs: indices of the blocks control can flow to
+    @ivar preds: indices of the blocks control can flow from
+    """
+
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.succs = []
+        self.preds = []
+
+    def __repr__(self):
+        return '<BasicBlock %d [%d:%d]>' % (self.index, self.start, self.end)
+
+
+class ControlFlowGraph(object):
+    def __init__(self, body):
+        self.body = body
+        self.blocks = []
+        # Index of the block each instruction belongs to
+        self._block_of = []
+        self._build()
+
+    def _build(self):
+        body = self.body
+        labels = {}
+        for i, instruction in enumerate(body):
+            for label in instruction.labels:
+                labels[label] = i
+
+        leaders = set([0])
+        for i, instruction in enumerate(body):
+            if instruction.instr in Instr.JUMPS:
+                leaders.add(labels[instruction.param])
+            if instruction.instr in _BLOCK_ENDS:
+                leaders.add(i + 1)
+        leaders = sorted(i for i in leaders if i < len(body))
+
+        for start, end in zip(leaders, leaders[1:] + [len(body)]):
+            block = BasicBlock(len(self.blocks), start, end)
+            self.blocks.append(block)
+            self._block_of.extend([block.index] * (end - start))
+
+        for block in self.blocks:
+            last = body[block.end - 1]
+            if last.instr in Instr.JUMPS:
+                block.succs.append(self._block_of[labels[last.param]])
+            if (last.instr not in (Instr.JMP, Instr.RETN) and
+                    block.end < len(body)):
+                block.succs.append(block.index + 1)
+            # A JZ to the next instruction
+            block.succs = sorted(set(block.succs))
+            for succ in block.succs:
+                self.blocks[succ].preds.append(block.index)
+
+    def block_of(self, i):
+        """The block holding body[i]"""
+        return self.blocks[self._block_of[i]]
+
+    def instructions(self, block):
+        return self.body[block.start:block.end]
+
+    @property
+    def exits(self):
+        """Blocks control leaves the body from"""
+        return [block for block in self.blocks if not block.succs]
+
+
+def solve(cfg, transfer, meet, boundary, initial, forward=True):
+    """
+    Solves a dataflow problem over cfg by iterating to a fixed point.
+
+    @param transfer: f(block, value) -> the value after the block, given the
+        value before it, in the direction of the analysis
+    @param meet: f(values) -> the combined value of several incoming edges
+    @param boundary: the value entering the entry block (forward), or leaving
+        the exit blocks (backward)
+    @param initial: the starting value of every other block
+    @return: (ins, outs): the values before and after each block, in program
+        order, indexed by block
+    """
+    num_blocks = len(cfg.blocks)
+    if not num_blocks:
+        return [], []
+    ins = [initial] * num_blocks
+    outs = [initial] * num_blocks
+
+    if forward:
+        order = range(num_blocks)
+        sources = lambda block: block.preds
+        entries = set([0])
+        before, after = ins, outs
+    else:
+        order = range(num_blocks - 1, -1, -1)
+        sources = lambda block: block.succs
+        entries = set(block.index for block in cfg.exits)
+        before, after = outs, ins
+
+    pending = deque(order)
+    queued = set(pending)
+    while pending:
+        index = pending.popleft()
+        queued.discard(index)
+        block = cfg.blocks[index]
+
+        incoming = [after[i] for i in sources(block)]
+        if index in entries:
+            incoming.append(boundary)
+        value = meet(incoming) if incoming else initial
+        before[index] = value
+        result = transfer(block, value)
+        if result != after[index]:
+            after[index] = result
+            dependents = block.succs if forward else block.preds
+            for i in dependents:
+                if i not in queued:
+                    pending.append(i)
+                    queued.add(i)
+    return ins, outs
+
+
+def _union(values):
+    return frozenset().union(*values)
+
+
+def _intersection(values):
+    return frozenset.intersection(*values)
+
+
+def dominators(cfg):
+    """
+    @return: for each block, in order, the frozenset of indices of the
+        blocks dominating it (itself included)
+    """
+    all_blocks = frozenset(xrange(len(cfg.blocks)))
+    _, outs = solve(cfg, lambda block, doms: doms | frozenset([block.index]),
+                    _intersection, frozenset(), all_blocks)
+    return outs
+
+
+def _uses_defs(instructions):
+    """Slots loaded before being stored in instructions, and slots stored"""
+    uses = set()
+    defs = set()
+    for instruction in instructions:
+        if instruction.instr == Instr.LOAD_LOCAL:
+            if instruction.param not in defs:
+                uses.add(instruction.param)
+        elif instruction.instr == Instr.STORE_VAR:
+            defs.add(instruction.param)
+    return frozenset(uses), frozenset(defs)
+
+
+def liveness(cfg):
+    """
+    @return: (live_in, live_out): for each block, the frozensets of slots
+        live before and after it
+    """
+    uses_defs = [_uses_defs(cfg.instructions(block)) for block in cfg.blocks]
+
+    def transfer(block, live_out):
+        uses, defs = uses_defs[block.index]
+        return uses | (live_out - defs)
+
+    return solve(cfg, transfer, _union, frozenset(), frozenset(),
+                 forward=False)
+
+
+def live_after(cfg, live_out, block):
+    """
+    @return: for each instruction of block, the frozenset of slots live right
+        after it
+    """
+    live = live_out[block.index]
+    after = []
+    for instruction in reversed(cfg.instructions(block)):
+        after.append(live)
+        if instruction.instr == Instr.STORE_VAR:
+            live = live - frozenset([instruction.param])
+        elif instruction.instr == Instr.LOAD_LOCAL:
+            live = live | frozenset([instruction.param])
+    after.reverse()
+    return after
+
+
+def reaching_definitions(cfg):
+    """
+    Definitions are the indices of STORE_VAR instructions in cfg.body.
+
+    @return: (reach_in, reach_out): for each block, the frozensets of
+        definitions reaching its start and end
+    """
+    body = cfg.body
+    defs_of_slot = {}
+    for i, instruction in enumerate(body):
+        if instruction.instr == Instr.STORE_VAR:
+            defs_of_slot.setdefault(instruction.param, set()).add(i)
+
+    gen_kill = []
+    for block in cfg.blocks:
+        gen = {}
+        for i in xrange(block.start, block.end):
+            if body[i].instr == Instr.STORE_VAR:
+                gen[body[i].param] = i
+        kill = set()
+        for slot in gen:
+            kill.update(defs_of_slot[slot])
+        gen_kill.append((frozenset(gen.itervalues()), frozenset(kill)))
+
+    def transfer(block, reach_in):
+        gen, kill = gen_kill[block.index]
+        return gen | (reach_in - kill)
+
+    return solve(cfg, transfer, _union, frozenset(), frozenset())
@@ -0,0 +1,417 @@
+"""
+Static estimates of what running a compiled program costs, without running
+it.
+
+yaksh has no loops, so every path through a function is finite, and only
+recursion can make a call run for unbounded time. estimate() follows each
+path through each body, counting the instructions on it, with a CALL also
+counting every instruction of the function it calls:
+ - straight-line code costs exactly the instructions it runs
+ - code with branches costs between its cheapest and dearest path
+ - a function which may recurse, directly or through the functions it
+   calls, has no upper bound, and is flagged
+ - a function every path through which recurses, like `def f(a): return
+   f(a)`, never returns, so has no lower bound either. Nor does anything
+   which always calls it.
+
+Given weights, the cost of each instruction is its weight instead of 1.
+TIMINGS holds the seconds each opcode takes the VM, measured by calibrate(),
+so estimate(program, TIMINGS) bounds a program's run time. Builtins are
+costed as a CALL; what printing or summing a vector really takes depends on
+its arguments.
+
+    python -m yaksh.cost program.ysh
+"""
+import argparse
+import time
+
+from yaksh.bytecode_compiler import (Assembly, Instr, Instruction,
+                                     assemble, load_assembly, parse_assembly)
+from yaksh.vm import AbstractMachine
+
+
+# Seconds each opcode takes, as measured by calibrate() under CPython 2.7.
+# They vary from machine to machine, but mostly in proportion;
+# `python -m benchmarks.bench_cost` measures them again.
+TIMINGS = {
+    Instr.ADD: 1.13e-6,
+    Instr.SUB: 1.05e-6,
+    Instr.DIV: 1.35e-6,
+    Instr.MULT: 1.39e-6,
+    Instr.RETN: 2.11e-6,
+    Instr.CALL: 1.24e-6,
+    Instr.STORE_VAR: 0.92e-6,
+    Instr.STORE_GLOBAL: 0.90e-6,
+    Instr.LOAD_CONST: 0.78e-6,
+    Instr.LOAD_GLOBAL: 0.69e-6,
+    Instr.LOAD_LOCAL: 0.68e-6,
+    Instr.CALL_BUILTIN: 1.24e-6,
+    Instr.PASS: 0.63e-6,
+    Instr.JZ: 0.75e-6,
+    Instr.JNZ: 0.93e-6,
+    Instr.JMP: 0.42e-6,
+    Instr.CMP: 1.71e-6,
+    Instr.BUILD_LIST: 1.23e-6,
+    Instr.BUILD_MAP: 2.40e-6,
+    Instr.LOAD_INDEX: 1.36e-6,
+    Instr.STORE_INDEX: 1.52e-6,
+    Instr.LEN: 1.04e-6,
+    Instr.POP: 0.78e-6,
+    Instr.DUP: 0.90e-6,
+    Instr.ADD_NUM: 0.85e-6,
+    Instr.ADD_STR: 1.13e-6,
+    Instr.MULT_NUM: 0.95e-6,
+    Instr.CMP_NUM: 1.12e-6,
+}
+
+
+# Cost of a path which never returns, while estimating
+_NEVER = float('inf')
+
+
+class Cost(object):
+    """
+    The cost of running a body, from its cheapest path to its dearest
+
+    @ivar min: None if it never returns, as every path recurses forever
+    @ivar max: None if unbounded
+    @ivar recursive: whether it may recurse, directly or through the
+        functions it calls
+    """
+    __slots__ = ('min', 'max', 'recursive')
+
+    def __init__(self, min, max, recursive=False):
+        self.min = min
+        self.max = max
+        self.recursive = recursive
+
+    @property
+    def exact(self):
+        return self.min is not None and self.min == self.max
+
+    @property
+    def returns(self):
+        """Whether any path through the body returns"""
+        return self.min is not None
+
+    def __eq__(self, other):
+        return (isinstance(other, Cost) and self.min == other.min and
+                self.max == other.max and self.recursive == other.recursive)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if not self.returns:
+            bounds = 'never returns'
+        else:
+            bounds = '%s..%s' % (self.min, '' if self.max is None
+                                 else self.max)
+        return '<Cost %s%s>' % (bounds,
+                                ' recursive' if self.recursive else '')
+
+
+def _bodies(program):
+    """The (instr, param) function bodies and toplevel of program"""
+    if isinstance(program, Assembly):
+        _, funcs, toplevel, _ = parse_assembly(program)
+    else:
+        _, funcs, toplevel, _ = AbstractMachine(program).decode_all()
+    return funcs, toplevel
+
+
+def _path_costs(body, weight, callee_cost):
+    """
+    The cheapest and dearest path through body
+
+    @param callee_cost: f(func_idx) -> (min, max) of the function a CALL
+        runs. A min of None never returns, and a max of None is unbounded.
+    @return: (min, max), where a min of None is a body no path through which
+        returns
+    """
+    end = len(body)
+    # Cost of running from each instruction to the end of the body
+    cheapest = [0] * (end + 1)
+    dearest = [0] * (end + 1)
+    loops = False
+    for i in xrange(end - 1, -1, -1):
+        instr, param = body[i]
+        succs = []
+        if instr in Instr.JUMPS:
+            if param <= i:
+                # Jumps backwards never come out of the generator, but a
+                # hand-written loop may run forever
+                loops = True
+            else:
+                succs.append(min(param, end))
+        if instr not in (Instr.JMP, Instr.RETN):
+            succs.append(i + 1)
+
+        low = high = weight(instr)
+        if instr == Instr.CALL:
+            callee_min, callee_max = callee_cost(param)
+            low += _NEVER if callee_min is None else callee_min
+            high = None if callee_max is None else high + callee_max
+        cheapest[i] = low + min([cheapest[s] for s in succs] or [0])
+        if high is None or None in [dearest[s] for s in succs]:
+            dearest[i] = None
+        else:
+            dearest[i] = high + max([dearest[s] for s in succs] or [0])
+    low = None if cheapest[0] == _NEVER else cheapest[0]
+    return low, None if loops else dearest[0]
+
+
+def _call_graph_sccs(funcs):
+    """
+    Strongly-connected components of the call graph, callees before their
+    callers
+
+    @return: lists of function indices
+    """
+    calls = [sorted(set(param for instr, param in body
+                        if instr == Instr.CALL and param < len(funcs)))
+             for body in funcs]
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    sccs = []
+    for root in xrange(len(funcs)):
+        if root in index:
+            continue
+        # Tarjan's algorithm, with an explicit stack for deep call chains
+        work = [(root, 0)]
+        while work:
+            func_idx, i = work.pop()
+            if i == 0:
+                index[func_idx] = low[func_idx] = len(index)
+                stack.append(func_idx)
+                on_stack.add(func_idx)
+            if i < len(calls[func_idx]):
+                work.append((func_idx, i + 1))
+                callee = calls[func_idx][i]
+                if callee not in index:
+                    work.append((callee, 0))
+                elif callee in on_stack:
+                    low[func_idx] = min(low[func_idx], index[callee])
+                continue
+            if work:
+                caller = work[-1][0]
+                low[caller] = min(low[caller], low[func_idx])
+            if low[func_idx] == index[func_idx]:
+                scc = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    scc.append(member)
+                    if member == func_idx:
+                        break
+                sccs.append(sorted(scc))
+    return sccs, calls
+
+
+def estimate(program, weights=None):
+    """
+    Estimates the cost of each function of program, and of its toplevel
+
+    @param program: a binary, or an Assembly
+    @param weights: cost of each opcode, by Instr, such as TIMINGS. By
+        default every instruction costs 1, so costs count instructions run.
+    @return: (a Cost for each function, by index, the Cost of the toplevel)
+    """
+    funcs, toplevel = _bodies(program)
+    if weights is None:
+        weight = lambda instr: 1
+    else:
+        weight = lambda instr: weights.get(instr, 0)
+
+    costs = [None] * len(funcs)
+
+    def callee_cost(func_idx):
+        if func_idx >= len(funcs):
+            # Imported by an object file, so not known
+            return 0, None
+        cost = costs[func_idx]
+        return cost.min, cost.max
+
+    sccs, calls = _call_graph_sccs(funcs)
+    for scc in sccs:
+        recursive = len(scc) > 1 or scc[0] in calls[scc[0]]
+        recursive = recursive or any(
+            costs[callee].recursive for func_idx in scc
+            for callee in calls[func_idx] if callee not in scc)
+        if len(scc) == 1 and scc[0] not in calls[scc[0]]:
+            func_idx, = scc
+            low, high = _path_costs(funcs[func_idx], weight, callee_cost)
+            costs[func_idx] = Cost(low, high, recursive)
+            continue
+
+        # Each path that recurses is dearer than one that doesn't, so the
+        # cheapest are found by relaxing from the paths that don't
+        for func_idx in scc:
+            costs[func_idx] = Cost(_NEVER, None, True)
+        changed = True
+        while changed:
+            changed = False
+            for func_idx in scc:
+                low, _ = _path_costs(funcs[func_idx], weight, callee_cost)
+                if low is not None and low < costs[func_idx].min:
+                    costs[func_idx].min = low
+                    changed = True
+        # Those still without a path that returns never do
+        for func_idx in scc:
+            if costs[func_idx].min == _NEVER:
+                costs[func_idx].min = None
+
+    low, high = _path_costs(toplevel, weight, callee_cost)
+    recursive = any(costs[param].recursive for instr, param in toplevel
+                    if instr == Instr.CALL and param < len(funcs))
+    return costs, Cost(low, high, recursive)
+
+
+###############
+# Calibration #
+###############
+_SETUP = 'LOAD_CONST 0\nLOAD_CONST 1\nBUILD_LIST 2\nSTORE_GLOBAL 0'
+
+# For each opcode timed: its kernel, and the other opcodes in it, timed
+# before it. Kernels leave the stack as they found it.
+_KERNELS = (
+    (Instr.PASS, 'PASS', ()),
+    # A push needs a pop, so the two are taken to cost the same
+    ((Instr.LOAD_CONST, Instr.POP), 'LOAD_CONST 1\nPOP', ()),
+    (Instr.LOAD_GLOBAL, 'LOAD_GLOBAL 0\nPOP', (Instr.POP,)),
+    (Instr.STORE_GLOBAL, 'LOAD_CONST 1\nSTORE_GLOBAL 1',
+     (Instr.LOAD_CONST,)),
+    (Instr.DUP, 'LOAD_CONST 1\nDUP\nPOP\nPOP',
+     (Instr.LOAD_CONST, Instr.POP, Instr.POP)),
+    (Instr.LEN, "LOAD_CONST 'ab'\nLEN\nPOP", (Instr.LOAD_CONST, Instr.POP)),
+    (Instr.BUILD_LIST, 'LOAD_CONST 1\nLOAD_CONST 2\nBUILD_LIST 2\nPOP',
+     (Instr.LOAD_CONST, Instr.LOAD_CONST, Instr.POP)),
+    (Instr.BUILD_MAP, 'LOAD_CONST 1\nLOAD_CONST 2\nBUILD_MAP 1\nPOP',
+     (Instr.LOAD_CONST, Instr.LOAD_CONST, Instr.POP)),
+    (Instr.LOAD_INDEX, 'LOAD_CONST 1\nLOAD_GLOBAL 0\nLOAD_INDEX\nPOP',
+     (Instr.LOAD_CONST, Instr.LOAD_GLOBAL, Instr.POP)),
+    (Instr.STORE_INDEX, 'LOAD_CONST 5\nLOAD_CONST 1\nLOAD_GLOBAL 0\n'
+                        'STORE_INDEX',
+     (Instr.LOAD_CONST, Instr.LOAD_CONST, Instr.LOAD_GLOBAL)),
+) + tuple(
+    (instr, 'LOAD_CONST %s\nLOAD_CONST %s\n%s\nPOP' % (
+        operands + (Instr._asm_names[instr] + param,)),
+     (Instr.LOAD_CONST, Instr.LOAD_CONST, Instr.POP))
+    for instr, operands, param in (
+        (Instr.ADD, (3, 2), ''),
+        (Instr.SUB, (3, 2), ''),
+        (Instr.MULT, (3, 2), ''),
+        (Instr.DIV, (3, 2), ''),
+        (Instr.CMP, (3, 2), ' 2'),
+        (Instr.ADD_NUM, (3, 2), ''),
+        (Instr.ADD_STR, ("'b'", "'a'"), ''),
+        (Instr.MULT_NUM, (3, 2), ''),
+        (Instr.CMP_NUM, (3, 2), ' 2'),
+    )
+)
+# Kernels run in a function, as they use locals
+_FUNC_KERNELS = (
+    (Instr.STORE_VAR, 'LOAD_CONST 1\nSTORE_VAR 0', (Instr.LOAD_CONST,)),
+    (Instr.LOAD_LOCAL, 'LOAD_LOCAL 0\nPOP', (Instr.POP,)),
+)
+# Jumps to the next instruction, a labelled PASS, after their setup
+_JUMP_KERNELS = (
+    (Instr.JMP, '', (Instr.PASS,)),
+    (Instr.JZ, 'LOAD_CONST 1', (Instr.LOAD_CONST, Instr.PASS)),
+    (Instr.JNZ, 'LOAD_CONST 1', (Instr.LOAD_CONST, Instr.PASS)),
+)
+
+
+def _time(bytecode):
+    am = AbstractMachine(bytecode)
+    am.decode_all()
+    start = time.time()
+    am.run()
+    return time.time() - start
+
+
+def calibrate(reps=2000, repeat=5):
+    """
+    Times each opcode on this machine, from kernels run reps times, the
+    best of repeat runs each. The kernels take turns, so that the machine
+    slowing for a moment slows one run of each rather than every run of a few.
+
+    @return: a dict like TIMINGS
+    """
+    # (opcodes timed, binary, other opcodes in it), in the order timed
+    kernels = []
+
+    def measure(instrs, asm, others):
+        kernels.append((instrs, assemble(asm), others))
+
+    for instr, kernel, others in _KERNELS:
+        measure(instr, '\n'.join([_SETUP] + [kernel] * reps), others)
+
+    # Locals need a frame
+    for instr, kernel, others in _FUNC_KERNELS:
+        measure(instr, 'PROC\n%s\nMAKE_FUNCTION\nCALL 0' % '\n'.join(
+            ['LOAD_CONST 1\nSTORE_VAR 0'] + [kernel] * reps), others)
+
+    for instr, setup, others in _JUMP_KERNELS:
+        body = load_assembly(_SETUP).toplevel
+        for i in xrange(reps):
+            body.extend(load_assembly(setup).toplevel)
+            body.append(Instruction(instr, 'l%d' % i))
+            body.append(Instruction(Instr.PASS, None, ['l%d' % i]))
+        measure(instr, Assembly(toplevel=body), others)
+
+    # Calls, to a function doing nothing, then to one returning at once
+    measure(Instr.CALL, 'PROC\nPASS\nMAKE_FUNCTION\n' + '\n'.join(
+        ['CALL 0'] * reps), (Instr.PASS,))
+    measure(Instr.RETN, 'PROC\nRETN\nMAKE_FUNCTION\n' + '\n'.join(
+        ['CALL 0'] * reps), (Instr.CALL,))
+
+    best = [None] * len(kernels)
+    for _ in xrange(repeat):
+        for i, (_, bytecode, _) in enumerate(kernels):
+            elapsed = _time(bytecode)
+            if best[i] is None or elapsed < best[i]:
+                best[i] = elapsed
+
+    timings = {}
+    for (instrs, _, others), elapsed in zip(kernels, best):
+        per_rep = elapsed / reps - sum(timings[other] for other in others)
+        if not isinstance(instrs, tuple):
+            instrs = (instrs,)
+        for instr in instrs:
+            timings[instr] = max(per_rep / len(instrs), 0.0)
+    timings[Instr.CALL_BUILTIN] = timings[Instr.CALL]
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='yaksh.cost')
+    parser.add_argument('binary', help='.ysh binary to estimate')
+    args = parser.parse_args()
+
+    with open(args.binary, 'rb') as f:
+        bytecode = f.read()
+    counts = estimate(bytecode)
+    times = estimate(bytecode, TIMINGS)
+    symbols = AbstractMachine(bytecode).symbol_table()
+
+    def bound(value, scale=1, format='%d'):
+        return 'unbounded' if value is None else format % (value * scale)
+
+    print '%-24s %12s %12s %12s %12s' % (
+        'function', 'min instrs', 'max instrs', 'min (us)', 'max (us)')
+    names = [symbols[0][i] if symbols else 'function %d' % i
+             for i in xrange(len(counts[0]))] + ['<toplevel>']
+    for name, count, t in zip(names, counts[0] + [counts[1]],
+                              times[0] + [times[1]]):
+        if count.recursive:
+            name += ' (recursive)'
+        print '%-24s %12s %12s %12s %12s' % (
+            name, bound(count.min), bound(count.max),
+            bound(t.min, 1e6, '%.1f'), bound(t.max, 1e6, '%.1f'))
+
+
+if __name__ == '__main__':
+    main()
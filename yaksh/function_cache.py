@@ -0,0 +1,489 @@
+"""
+A content-addressed cache of the code generated for each top-level function,
+so rebuilding a large source only parses and generates the functions that
+changed.
+
+split_source() lexes a source and splits it at column-0 `def`s. The other
+top-level statements are parsed as usual, but each function becomes a
+LazyFdef, only parsed if it has to be generated. Its key is a hash of its
+normalized tokens (their types and text, and lines relative to the `def`, so
+moving a function leaves its key alone) and the generator's options.
+
+Generating a function also depends on what was defined before it: the
+indices of the functions and globals it uses, the bodies of those it
+inlines, the constants globals hold, and so on. While a function is
+generated, the generator's tables note the first value read of each entry,
+and which entries are written: the function itself, and any clones it
+specializes. FunctionCache stores both under the function's key. Next time,
+an entry whose reads all match the generator's tables is a hit, and what it
+wrote is replayed without parsing or generating anything.
+
+The bodies are cached as generated. The optimizer and assembler see the
+whole program, so still run on all of it.
+
+    functions = FunctionCache('build/functions')
+    bytecode = yaksh.cache.compile_source(source, functions)
+    print functions
+
+yaksh.cache.load() keeps one alongside its other entries, so rebuilding an
+edited source only regenerates the functions the edit touched.
+"""
+import bisect
+import hashlib
+import marshal
+import os
+from collections import OrderedDict
+
+from yaksh.bytecode_asm import LIST_TABLES
+from yaksh.bytecode_compiler import Instruction
+from yaksh.cachefile import read_cache_file, write_cache_file
+from yaksh.lexer import lex_fast
+from yaksh.parser import parse
+
+
+FUNCTION_CACHE_MAGIC = 'YKF'
+FUNCTION_CACHE_VERSION = 2
+FUNCTION_CACHE_EXT = '.func.ykc'
+# Entries kept for each key, for functions generated in several contexts
+MAX_ENTRIES = 4
+
+# Key under which a table's length is read
+LENGTH = ('len',)
+
+
+class FunctionCache(object):
+    """
+    Entries of generated functions by key, in memory and, if given a
+    directory, on disk
+
+    @ivar hits: functions replayed from the cache
+    @ivar misses: functions generated
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        looked_up = self.hits + self.misses
+        return float(self.hits) / looked_up if looked_up else 0.0
+
+    def __str__(self):
+        return '%d of %d functions reused (%.1f%%)' % (
+            self.hits, self.hits + self.misses, self.hit_rate * 100)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + FUNCTION_CACHE_EXT)
+
+    def entries(self, key):
+        """(reads, writes) entries stored under key, most recent first"""
+        if key not in self._entries:
+            entries = None
+            if self.cache_dir is not None:
+                entries = read_cache_file(self._path(key),
+                                          FUNCTION_CACHE_MAGIC,
+                                          FUNCTION_CACHE_VERSION)
+            self._entries[key] = entries or []
+        return self._entries[key]
+
+    def store(self, key, entry):
+        entries = [entry] + self.entries(key)[:MAX_ENTRIES - 1]
+        self._entries[key] = entries
+        if self.cache_dir is not None:
+            write_cache_file(self._path(key), FUNCTION_CACHE_MAGIC,
+                             FUNCTION_CACHE_VERSION, entries)
+
+    ##############
+    # Generating #
+    ##############
+    @staticmethod
+    def trace(gen):
+        """
+        Replaces the tables of a BytecodeAssemblyGenerator that generating a
+        function reads or writes with traced ones, sharing a Tracer
+        """
+        tracer = Tracer()
+        traced_tables = OrderedDict()
+        for name, table in gen.tables().iteritems():
+            traced = TracedList if name in LIST_TABLES else TracedDict
+            traced_tables[name] = traced(name, tracer, table)
+        gen.replace_tables(traced_tables)
+
+    @staticmethod
+    def _key(gen, fdef):
+        options = (FUNCTION_CACHE_VERSION, gen.module, gen.inline_max_size,
+                   gen.specialize_max_clones, gen.fold_constants, fdef.key)
+        return hashlib.sha1(marshal.dumps(options)).hexdigest()
+
+    def gen_function(self, gen, fdef):
+        """
+        Generates a function of gen's, or replays it from the cache
+
+        @return: the parameters of fdef which can be bound to constants
+        """
+        if not isinstance(fdef, LazyFdef):
+            return gen.generate_function(fdef)
+
+        tables = gen.tables()
+        # Its lines are packed relative to where it starts
+        funcs = tables['funcs']
+        funcs.tracer.define(list.__len__(funcs), fdef.lines)
+        key = self._key(gen, fdef)
+        for reads, writes in self.entries(key):
+            if all(tables[name].peek(k) == value
+                   for (name, k), value in reads.iteritems()):
+                self.hits += 1
+                return _replay(gen, fdef, writes)
+
+        self.misses += 1
+        reads, writes = _record(gen, fdef)
+        self.store(key, (reads, writes))
+        return set(writes['bindable'])
+
+
+def _record(gen, fdef):
+    """
+    Generates fdef, tracing gen's tables
+
+    @return: (reads, writes) of the generation, marshallable
+    """
+    tables = gen.tables()
+    tracer = tables['funcs'].tracer
+    lengths = dict((name, list.__len__(tables[name])) for name in LIST_TABLES)
+    num_inlined = len(gen.inlined)
+    num_specialized = len(gen.specialized)
+    num_imports = dict((name, len(calls))
+                       for name, calls in gen.import_calls.iteritems())
+
+    tracer.trace = trace = Trace()
+    try:
+        bindable = gen.generate_function(fdef)
+    finally:
+        tracer.trace = None
+
+    writes = {}
+    for name, table in tables.iteritems():
+        if name in LIST_TABLES:
+            writes[name] = list.__getslice__(table, lengths[name],
+                                             list.__len__(table))
+        else:
+            writes[name] = dict((key, dict.__getitem__(table, key))
+                                for table_name, key in trace.written
+                                if table_name == name and key != LENGTH)
+    funcs = writes['funcs']
+    writes['funcs'] = tuple(pack_body(body, tracer) for body in funcs)
+    writes['func_list_names'] = tuple(writes['func_list_names'])
+
+    # Calls to functions not defined yet, as (index in funcs, index in body)
+    positions = {}
+    for i, body in enumerate(funcs):
+        for j, instruction in enumerate(body):
+            positions[id(instruction)] = i, j
+    writes['imports'] = tuple(
+        (name, tuple(positions[id(call)]
+                     for call in calls[num_imports.get(name, 0):]))
+        for name, calls in gen.import_calls.iteritems()
+        if len(calls) > num_imports.get(name, 0))
+
+    writes['inlined'] = tuple(
+        (caller, callee, tracer.pack_line(line_no))
+        for caller, callee, line_no in gen.inlined[num_inlined:])
+    writes['specialized'] = tuple(
+        (name, clone, tracer.pack_line(line_no))
+        for name, clone, line_no in gen.specialized[num_specialized:])
+    writes['bindable'] = tuple(sorted(bindable))
+    return trace.reads, writes
+
+
+def _replay(gen, fdef, writes):
+    """
+    Defines what generating fdef wrote, as recorded by _record
+
+    @return: the parameters of fdef which can be bound to constants
+    """
+    tables = gen.tables()
+    tracer = tables['funcs'].tracer
+    funcs = [unpack_body(body, tracer) for body in writes['funcs']]
+    for name, table in tables.iteritems():
+        if name == 'funcs':
+            table.extend(funcs)
+        elif name in LIST_TABLES:
+            table.extend(writes[name])
+        else:
+            table.update(writes[name])
+
+    for name, positions in writes['imports']:
+        gen.import_calls.setdefault(name, []).extend(
+            funcs[i][j] for i, j in positions)
+    gen.inlined.extend((caller, callee, tracer.unpack_line(line_no))
+                       for caller, callee, line_no in writes['inlined'])
+    gen.specialized.extend((name, clone, tracer.unpack_line(line_no))
+                           for name, clone, line_no in writes['specialized'])
+    return set(writes['bindable'])
+
+
+###########
+# Sources #
+###########
+class LazyFdef(object):
+    """
+    Stands in for the fdef symbol of a top-level function, parsing its
+    tokens only when something other than its name, lines or key is needed
+    """
+    name = 'fdef'
+
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._symbol = None
+        # Blank lines after the function aren't part of it
+        end = len(tokens)
+        while tokens[end - 1].type == 'NEWLINE':
+            end -= 1
+        first = tokens[0].line_no
+        normalized = [(t.type, t.text, t.line_no - first)
+                      for t in tokens[:end]]
+        self.key = hashlib.sha1(marshal.dumps(normalized)).hexdigest()
+        # Tokens count lines from 0, line tables from 1
+        self.lines = first + 1, tokens[end - 1].line_no + 1
+
+    @property
+    def func_name(self):
+        return self._tokens[1].text
+
+    @property
+    def line_no(self):
+        return self._tokens[0].line_no
+
+    @property
+    def symbol(self):
+        if self._symbol is None:
+            self._symbol, = parse(self._tokens)
+        return self._symbol
+
+    def __getattr__(self, name):
+        return getattr(self.symbol, name)
+
+    def __repr__(self):
+        return '<LazyFdef %s>' % self.func_name
+
+
+def split_source(source):
+    """
+    @return: the top-level symbols of source, with LazyFdefs for functions
+        defined in column 0
+    """
+    # Tokens of each top-level line, and whether it begins a function
+    chunks = []
+    line_start = True
+    for token in lex_fast(source):
+        # Indented lines carry on the statement or function above them
+        if (line_start and token.type not in ('NEWLINE', 'INDENT') or
+                not chunks):
+            chunks.append((line_start and token.type == 'R_DEF', []))
+        chunks[-1][1].append(token)
+        line_start = token.type == 'NEWLINE'
+
+    symbols = []
+    statements = []
+    for is_def, tokens in chunks:
+        if is_def:
+            symbols.extend(parse(statements))
+            statements = []
+            symbols.append(LazyFdef(tokens))
+        else:
+            # The lines of an if chain are parsed together
+            statements.extend(tokens)
+    symbols.extend(parse(statements))
+    return symbols
+
+
+###########
+# Tracing #
+###########
+class Trace(object):
+    """
+    What generating one function reads and writes
+
+    @ivar reads: (table name, key) mapped to the fingerprint of the first
+        value read, of those not written first
+    @ivar written: (table name, key)s written
+    """
+
+    def __init__(self):
+        self.reads = {}
+        self.written = set()
+
+    def read(self, item, value):
+        if item not in self.written and item not in self.reads:
+            self.reads[item] = value
+
+    def write(self, item):
+        self.written.add(item)
+
+
+class Tracer(object):
+    """
+    Holds the Trace of the function being generated, if any, and the lines
+    of the functions defined, so lines can be cached relative to them
+    """
+
+    def __init__(self):
+        self.trace = None
+        # Lines of each LazyFdef defined, by function index
+        self.spans = {}
+        # (first line, last line, function index) of each, in order
+        self._sorted_spans = []
+
+    def define(self, func_idx, lines):
+        self.spans[func_idx] = lines
+        bisect.insort(self._sorted_spans, lines + (func_idx,))
+
+    def pack_line(self, line_no):
+        """
+        A line number as it's cached: as (function index, offset from its
+        first line) if it's within a function defined, so it still holds
+        when the function moves
+        """
+        if line_no is None:
+            return None
+        i = bisect.bisect(self._sorted_spans, (line_no, float('inf'))) - 1
+        if i >= 0:
+            first, last, func_idx = self._sorted_spans[i]
+            if line_no <= last:
+                return func_idx, line_no - first
+        return line_no
+
+    def unpack_line(self, line_no):
+        if isinstance(line_no, tuple):
+            func_idx, offset = line_no
+            return self.spans[func_idx][0] + offset
+        return line_no
+
+    def fingerprint(self, name, value):
+        """How a value read from table name is noted"""
+        if name == 'funcs':
+            # Bodies are compared by digest. Unfinished ones are None.
+            if value is None:
+                return None
+            return hashlib.sha1(
+                marshal.dumps(pack_body(value, self))).hexdigest()
+        elif name == 'global_consts':
+            # As 1 == 1.0
+            return type(value).__name__, value
+        elif name == 'fdefs':
+            # Clones of a function are generated from its tokens
+            fdef, _ = value
+            return getattr(fdef, 'key', None)
+        return value
+
+
+class TracedDict(dict):
+    """
+    A dict noting reads and writes in its tracer's Trace. Reads are noted
+    as the tracer's fingerprint of the value, or None for missing keys.
+    """
+
+    def __init__(self, name, tracer, items=()):
+        dict.__init__(self, items)
+        self.name = name
+        self.tracer = tracer
+
+    def peek(self, key):
+        """What a read of key would note, without noting it"""
+        if key == LENGTH:
+            return dict.__len__(self)
+        if dict.__contains__(self, key):
+            return self.tracer.fingerprint(self.name,
+                                           dict.__getitem__(self, key))
+        return None
+
+    def _read(self, key):
+        if self.tracer.trace is not None:
+            self.tracer.trace.read((self.name, key), self.peek(key))
+
+    def __getitem__(self, key):
+        self._read(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self._read(key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        self._read(key)
+        return dict.get(self, key, default)
+
+    def __len__(self):
+        self._read(LENGTH)
+        return dict.__len__(self)
+
+    def __setitem__(self, key, value):
+        if self.tracer.trace is not None:
+            if not dict.__contains__(self, key):
+                self.tracer.trace.write((self.name, LENGTH))
+            self.tracer.trace.write((self.name, key))
+        dict.__setitem__(self, key, value)
+
+
+class TracedList(list):
+    """A list noting reads and writes in its tracer's Trace"""
+
+    def __init__(self, name, tracer, items=()):
+        list.__init__(self, items)
+        self.name = name
+        self.tracer = tracer
+
+    def peek(self, key):
+        """What a read of key would note, without noting it"""
+        if key == LENGTH:
+            return list.__len__(self)
+        if 0 <= key < list.__len__(self):
+            return self.tracer.fingerprint(self.name,
+                                           list.__getitem__(self, key))
+        return None
+
+    def _read(self, key):
+        if self.tracer.trace is not None:
+            self.tracer.trace.read((self.name, key), self.peek(key))
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long)):
+            if index < 0:
+                index += list.__len__(self)
+            self._read(index)
+        return list.__getitem__(self, index)
+
+    def __len__(self):
+        self._read(LENGTH)
+        return list.__len__(self)
+
+    def __setitem__(self, index, value):
+        if self.tracer.trace is not None:
+            self.tracer.trace.write((self.name, index))
+        list.__setitem__(self, index, value)
+
+    def append(self, value):
+        if self.tracer.trace is not None:
+            self.tracer.trace.write((self.name, LENGTH))
+            self.tracer.trace.write((self.name, list.__len__(self)))
+        list.append(self, value)
+
+
+##########
+# Bodies #
+##########
+def pack_body(body, tracer):
+    """Instructions as marshallable tuples, their lines packed by tracer"""
+    return tuple((instruction.instr, instruction.param,
+                  tuple(instruction.labels),
+                  tracer.pack_line(instruction.line_no))
+                 for instruction in body)
+
+
+def unpack_body(packed, tracer):
+    return [Instruction(instr, param, list(labels),
+                        tracer.unpack_line(line_no))
+            for instr, param, labels, line_no in packed]
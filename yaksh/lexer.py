@@ -1,3 +1,5 @@
+import re
+
 COMPARISONS = {
     '!=': 'NOTEQUAL',
     '==': 'ISEQUAL',
@@ -19,6 +21,8 @@ DELIMITERS = {
     ')': 'CLOSE_PAREN',
     '{': 'OPEN_BRACE',
     '}': 'CLOSE_BRACE',
+    '[': 'OPEN_BRACKET',
+    ']': 'CLOSE_BRACKET',
     ',': 'COMMA',
     '"': 'DOUBLE_QUOTE',
     "'": 'SINGLE_QUOTE',
@@ -59,8 +63,11 @@ def lex(s):
     curtype = []
     chars = []
     cur = [0]
+    # Column of the token being built
+    token_char_no = [0]
     line_no = 0
-    char_no = 0
+    # Offset in s of the current line
+    line_start = 0
     c = None
 
     def _cur(assn=None):
@@ -110,7 +117,7 @@ def lex(s):
                     token_type = 'R_' + token_text.upper()
                 else:
                     token_type = 'NAME'
-            t = Token(token_type, token_text, line_no, char_no - len(chars))
+            t = Token(token_type, token_text, line_no, token_char_no[0])
             tokens.append(t)
             curtype[:] = []
         chars[:] = []
@@ -126,9 +133,12 @@ def lex(s):
             _end_token()
         if not curtype:
             curtype.append(type)
+            token_char_no[0] = _cur() - line_start
         chars.append(c)
 
     def _set_type(type):
+        if not curtype:
+            token_char_no[0] = _cur() - line_start
         curtype[:] = [type]
 
     def _change_type(type):
@@ -201,18 +211,19 @@ def lex(s):
         elif c in DELIMITERS:
             _single(DELIMITERS[c])
         elif c == '\n':
+            if _type_is('INDENT'):
+                # Blank lines carry no indentation
+                _suppress()
             if tokens:
                 _single('NEWLINE')
             else:
                 # Eat whitespace at beginning of file
                 _suppress()
             line_no += 1
-            char_no = -1
+            line_start = _cur() + 1
         elif c in ' \t':
-            valid_indent_location = (_last_token_is('NEWLINE') and (
-                _last_token_is('INDENT', offs=-2) or
-                _last_token_is('BLOCK_BEGIN', offs=-2))
-            )
+            # Whitespace at the start of a line is indentation
+            valid_indent_location = _last_token_is('NEWLINE') and not curtype
             if valid_indent_location or _type_is('INDENT'):
                 _token('INDENT')
             else:
@@ -222,12 +233,114 @@ def lex(s):
             _single('UNKNOWN')
 
         _skip(1)
-        char_no += 1
 
     _end_token()
     return tokens
 
 
+# An identifier or number, as lex() builds them
+_WORD = r'(?:[A-Za-z_]\w*|\d(?:\w|\.(?=\d))*)'
+# A backslash escapes only the quote, and is otherwise kept
+_LITERAL = (r"""'[^'\\]*(?:(?:\\'|\\(?!'))[^'\\]*)*'"""
+            r'''|"[^"\\]*(?:(?:\\"|\\(?!"))[^"\\]*)*"''')
+
+# Lines before the first token: lex() drops a word alone on such a line, as
+# well as whitespace
+_LEADING = re.compile(r'(?:[ \t]*%s?\n)*[ \t]*' % _WORD)
+
+# Every token lex() can build, most common first, after any whitespace but
+# indentation. A word running straight into a comparison or literal is taken
+# into it, as in lex().
+_TOKEN = re.compile(r"""
+    (?:(?<!\n)[ \t]+)?
+  (?:
+    # Names, and operators, whose types are looked up alike
+    (?P<NAME>[A-Za-z_]\w*(?!\w|[=<>!]=|['"])
+      | [=<>!]=|[-+*/(){}\[\],;:.=<>])
+  | (?P<INDENT_LITERAL>(?<=\n)[ \t]+(?:%(literal)s))
+  | (?P<INDENT>(?<=\n)[ \t]+(?![ \t\n]))
+  | (?P<SPACE>[ \t]+)
+  | (?P<NEWLINE>\n)
+  | (?P<NUMBER>\d(?:\w|\.(?=\d))*(?!\w|\.\d|[=<>!]=|['"]))
+  | (?P<LITERAL>%(literal)s)
+  | (?P<WORD_OP>%(word)s[=<>!]=)
+  | (?P<WORD_LITERAL>%(word)s(?:%(literal)s))
+  | (?P<UNTERMINATED>%(word)s?['"])
+  | (?P<BANG>!)
+  | (?P<UNKNOWN>.)
+  )
+""" % {'word': _WORD, 'literal': _LITERAL}, re.VERBOSE)
+
+# Types of the operators and reserved words; any other name is a NAME
+_TYPES = dict(COMPARISONS, **OPERATORS)
+_TYPES.update(DELIMITERS)
+_TYPES.update({'==': 'ISEQUAL', '=': 'ASSIGN', '.': 'DOT'})
+_TYPES.update((word, 'R_' + word.upper()) for word in T_RESERVED)
+
+
+def _unquote(text):
+    """@param text: a literal, after any word or indentation taken into it"""
+    start = min(i for i in (text.find("'"), text.find('"')) if i >= 0)
+    q = text[start]
+    return text[:start] + text[start + 1:-1].replace('\\' + q, q)
+
+
+def lex_fast(s):
+    """
+    Returns the same tokens as lex(), about three times faster: each token
+    is matched whole by one regex, rather than built up a character at a
+    time.
+    """
+    if isinstance(s, unicode):
+        try:
+            s.encode('ascii')
+        except UnicodeError:
+            # Letters and digits past ASCII
+            return lex(s)
+
+    tokens = []
+    append = tokens.append
+    token = Token
+    types = _TYPES
+    pos = _LEADING.match(s).end()
+    line_no = s.count('\n', 0, pos)
+    # Offset in s of the current line
+    line_start = s.rfind('\n', 0, pos) + 1
+
+    for match in _TOKEN.finditer(s, pos):
+        kind = match.lastgroup
+        if kind == 'NAME':
+            text = match.group(kind)
+            append(token(types.get(text, 'NAME'), text, line_no,
+                         match.start(kind) - line_start))
+        elif kind == 'NEWLINE':
+            start = match.start(kind)
+            append(token('NEWLINE', '\n', line_no, start - line_start))
+            line_no += 1
+            line_start = start + 1
+        elif kind in ('INDENT', 'NUMBER', 'UNKNOWN'):
+            append(token(kind, match.group(kind), line_no,
+                         match.start(kind) - line_start))
+        elif kind == 'SPACE':
+            continue
+        elif kind == 'BANG':
+            raise ValueError('Unknown operator !')
+        elif kind == 'UNTERMINATED':
+            raise SyntaxError('Unterminated literal')
+        else:
+            # Literals, and words taken into a comparison or literal. Lines
+            # within a literal aren't counted.
+            text = match.group(kind)
+            if kind == 'WORD_OP':
+                token_type = 'NUMBER' if text[0].isdigit() else 'NAME'
+            else:
+                token_type = 'LITERAL'
+                text = _unquote(text)
+            append(token(token_type, text, line_no,
+                         match.start(kind) - line_start))
+    return tokens
+
+
 if __name__ == '__main__':
     from pprint import pprint
     pprint(lex('''
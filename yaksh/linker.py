@@ -0,0 +1,277 @@
+"""
+Separate compilation of yaksh modules, and a linker to join them.
+
+A module is a source file compiled on its own, by compile_module, into a
+relocatable object file: a version 2 binary with a SYMBOLS section (see
+yaksh.bytecode_compiler) naming its functions and globals. Its function,
+global and constant indices are its own. Functions it calls without defining
+are imports, numbered after its own functions, and so are globals it reads
+without assigning.
+
+link() merges object files into one binary:
+ - Functions are numbered in module order, and each import is bound to the
+   function of that name. Two modules can't define the same function.
+ - Modules share globals by name, numbered after any host globals.
+ - Names beginning with an underscore are private to their module, so
+   modules can each have their own `_helper`.
+ - Constants are deduplicated across modules.
+ - The toplevel code of each module runs in turn, in module order.
+
+build() compiles each module to an object file in a build directory, only
+recompiling modules whose source is newer than their object file (in
+parallel, if asked), then links them all:
+
+    python -m yaksh.linker -o program.ysh -j 4 main.yk util.yk
+"""
+import argparse
+import hashlib
+import os
+from multiprocessing import Pool
+
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import (FORMAT_VERSION, Instr, parse_assembly,
+                                     write_program)
+from yaksh.cachefile import write_atomic
+from yaksh.lexer import lex_fast
+from yaksh.optimizer import optimize, optimize_bodies
+from yaksh.parser import parse
+from yaksh.vm import AbstractMachine
+
+
+OBJECT_EXT = '.yko'
+
+_GLOBAL_INSTRS = (Instr.LOAD_GLOBAL, Instr.STORE_GLOBAL)
+
+
+def compile_module(source, first_line=0):
+    """
+    Compiles a module's source to an object file
+
+    @param first_line: line of a larger source the module's source starts
+        on, counting from 0, for its line table
+    """
+    return generate_module(source, first_line)[0]
+
+
+def generate_module(source, first_line=0, infer_types=True):
+    """
+    Like compile_module, for callers wanting to know more of the module
+
+    @param infer_types: whether to specialize opcodes by the types inferred
+        from the module alone, rather than leaving that for the linked
+        program
+    @return: (the object file, the BytecodeAssemblyGenerator which generated
+        it)
+    """
+    tokens = lex_fast(source)
+    if first_line:
+        for token in tokens:
+            token.line_no += first_line
+    gen = BytecodeAssemblyGenerator(parse(tokens), module=True)
+    asm = gen.generate()
+    if infer_types:
+        optimize(asm, whole_program=False)
+    else:
+        optimize_bodies(asm)
+    program = parse_assembly(asm)
+    return write_program(*program, symbols=gen.symbol_table()), gen
+
+
+def _symbol_key(module_idx, name):
+    """Private names are only visible within their own module"""
+    if name.startswith('_'):
+        return module_idx, name
+    return name
+
+
+def link(objects, host_globals=(), version=FORMAT_VERSION,
+         one_source=False):
+    """
+    Links object files, in order, into one binary.
+
+    @param host_globals: names of globals provided by the embedding host,
+        which are given the first global indices, in order
+    @param one_source: the objects are pieces of one source (see
+        yaksh.parallel), so share their private names
+    """
+    modules = []
+    for obj in objects:
+        am = AbstractMachine(obj)
+        symbols = am.symbol_table()
+        if symbols is None:
+            raise ValueError('Not an object file: no symbol table')
+        modules.append((am.decode_all(), symbols))
+
+    # Number every module's functions, and find where each name is defined
+    func_offsets = []
+    definitions = {}
+    owners = {}
+    num_funcs = 0
+    scope = lambda module_idx: 0 if one_source else module_idx
+    for module_idx, ((_, funcs, _, _), (func_names, _)) in enumerate(modules):
+        func_offsets.append(num_funcs)
+        for i, name in enumerate(func_names[:len(funcs)]):
+            key = _symbol_key(scope(module_idx), name)
+            if owners.get(key, module_idx) != module_idx:
+                raise ValueError("Function '%s' is defined by more than one "
+                                 "module" % name)
+            # Within a module, the last definition wins, as it does when
+            # compiled on its own
+            owners[key] = module_idx
+            definitions[key] = num_funcs + i
+        num_funcs += len(funcs)
+
+    global_indices = dict((name, idx) for idx, name in enumerate(host_globals))
+    consts = []
+    consts_table = {}
+    funcs = []
+    toplevel = []
+    func_lines = []
+    toplevel_lines = []
+    for module_idx, (program, symbols) in enumerate(modules):
+        m_consts, m_funcs, m_toplevel, m_lines = program
+        func_names, global_names = symbols
+
+        func_map = []
+        for i, name in enumerate(func_names):
+            if i < len(m_funcs):
+                func_map.append(func_offsets[module_idx] + i)
+                continue
+            try:
+                func_map.append(
+                    definitions[_symbol_key(scope(module_idx), name)])
+            except KeyError:
+                raise NameError("name '%s' does not exist" % name)
+
+        global_map = []
+        for name in global_names:
+            key = _symbol_key(scope(module_idx), name)
+            if key not in global_indices:
+                global_indices[key] = len(global_indices)
+            global_map.append(global_indices[key])
+
+        const_map = []
+        for v in m_consts:
+            # Keyed by type too, as 1 == 1.0
+            key = (type(v), v)
+            if key not in consts_table:
+                consts_table[key] = len(consts)
+                consts.append(v)
+            const_map.append(consts_table[key])
+
+        maps = func_map, global_map, const_map
+        for func in m_funcs:
+            funcs.append(_relocate(func, maps, 0))
+        offset = len(toplevel)
+        toplevel.extend(_relocate(m_toplevel, maps, offset))
+
+        if not m_lines:
+            m_lines = [[]] * (len(m_funcs) + 1)
+        func_lines.extend(m_lines[:-1])
+        toplevel_lines.extend((i + offset, line_no)
+                              for i, line_no in m_lines[-1])
+
+    return write_program(consts, funcs, toplevel,
+                         func_lines + [toplevel_lines], version=version)
+
+
+def _relocate(code, maps, jump_offset):
+    """Renumbers a module's instructions into the linked program's indices"""
+    func_map, global_map, const_map = maps
+    relocated = []
+    try:
+        for instr, param in code:
+            if instr == Instr.CALL:
+                param = func_map[param]
+            elif instr in _GLOBAL_INSTRS:
+                param = global_map[param]
+            elif instr == Instr.LOAD_CONST:
+                param = const_map[param]
+            elif instr in Instr.JUMPS:
+                # A jump past the end of a module's toplevel carries on into
+                # the next module's
+                param += jump_offset
+            relocated.append((instr, param))
+    except IndexError:
+        raise ValueError('Malformed object file: index out of range')
+    return relocated
+
+
+###############
+# Build tools #
+###############
+def object_path(build_dir, path):
+    """Where build() keeps the object file of the module at path"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    digest = hashlib.sha1(os.path.abspath(path)).hexdigest()[:8]
+    return os.path.join(build_dir, '%s.%s%s' % (name, digest, OBJECT_EXT))
+
+
+def _is_stale(path, obj_path):
+    try:
+        return os.path.getmtime(obj_path) < os.path.getmtime(path)
+    except OSError:
+        return True
+
+
+def _compile_file(paths):
+    path, obj_path = paths
+    with open(path) as f:
+        obj = compile_module(f.read())
+    # So an interrupted build never leaves a partially-written object file
+    write_atomic(obj_path, obj)
+
+
+def build(paths, build_dir, jobs=1, host_globals=()):
+    """
+    Compiles the modules at paths into object files in build_dir, skipping
+    those whose object file is newer than their source, and links them in
+    order.
+
+    @param jobs: number of processes compiling modules at once
+    @return: (the linked binary, paths of the modules recompiled)
+    """
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+
+    obj_paths = [object_path(build_dir, path) for path in paths]
+    stale = [(path, obj_path) for path, obj_path in zip(paths, obj_paths)
+             if _is_stale(path, obj_path)]
+    if jobs > 1 and len(stale) > 1:
+        pool = Pool(min(jobs, len(stale)))
+        try:
+            pool.map(_compile_file, stale)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for module in stale:
+            _compile_file(module)
+
+    objects = []
+    for obj_path in obj_paths:
+        with open(obj_path, 'rb') as f:
+            objects.append(f.read())
+    return link(objects, host_globals), [path for path, _ in stale]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='yaksh.linker')
+    parser.add_argument('modules', nargs='+', help='.yk module sources, in '
+                                                   'the order to run them')
+    parser.add_argument('-o', '--output', required=True,
+                        help='where to write the linked .ysh binary')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of modules to compile at once')
+    parser.add_argument('--build-dir', default='build',
+                        help='where object files are kept between builds')
+    args = parser.parse_args()
+
+    bytecode, recompiled = build(args.modules, args.build_dir, args.jobs)
+    with open(args.output, 'wb') as f:
+        f.write(bytecode)
+    print 'Compiled %d of %d modules' % (len(recompiled), len(args.modules))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+"""
+The optimizations run on generated assembly before it's assembled.
+
+optimize() runs the peephole rules (see yaksh.peephole), then the dataflow
+passes below on each function body, and repeats both until neither changes
+anything, as each can leave work for the other. The dataflow passes use the
+analyses of yaksh.cfg:
+ - cse: an expression computed again in the same basic block, with the same
+   operands, is kept in a new local slot the first time and loaded from it
+   after. Calls and STORE_INDEX might change anything, so nothing computed
+   before them is reused after.
+ - dead_stores: a STORE_VAR whose value is never loaded becomes a POP. If
+   the value was a constant, or DUPed, neither is kept.
+ - compact_locals: locals never live at the same time share a slot, and
+   slots are renumbered from 0, so frames are smaller
+
+Finally, ADDs, MULTs and CMPs whose operands' types are proven are replaced
+with specialized opcodes (see yaksh.typeinfer). optimize_bodies() runs
+everything before that, which looks at one body at a time, so can be run on
+parts of a program separately.
+"""
+from collections import OrderedDict
+from functools import partial
+from itertools import count
+
+from yaksh import peephole, typeinfer
+from yaksh.bytecode_compiler import Instr, Instruction
+from yaksh.cfg import ControlFlowGraph, live_after, liveness
+
+
+# Instructions which push a value without side effects, or the chance of
+# an error
+_PURE_PUSHES = (Instr.LOAD_CONST, Instr.DUP)
+
+
+class OptimizeReport(object):
+    """How many instructions each pass removed or rewrote"""
+
+    def __init__(self):
+        self.counts = OrderedDict((name, 0) for name in PASSES)
+        for rule in peephole.RULES:
+            self.counts[rule] = 0
+        self.counts['typeinfer'] = 0
+
+    def __str__(self):
+        return '\n'.join('%-14s %d' % item for item in self.counts.iteritems())
+
+
+def optimize(asm, whole_program=True):
+    """
+    Optimizes asm in place. Globals its embedding host provides are known
+    from asm.host_globals.
+
+    @param whole_program: whether asm is the whole program, rather than a
+        module to be linked with others
+    @return: an OptimizeReport
+    """
+    # Unless something might store into them, lists and vectors can't tell
+    # whether they're shared
+    report = optimize_bodies(asm, mutable_containers=not whole_program or any(
+        instruction.instr == Instr.STORE_INDEX
+        for body in asm.bodies for instruction in body))
+    report.counts['typeinfer'] = typeinfer.specialize(asm, whole_program)
+    return report
+
+
+def optimize_bodies(asm, mutable_containers=True):
+    """
+    Optimizes asm in place as optimize() does, but without specializing
+    opcodes by type
+
+    @param mutable_containers: see cse()
+    @return: an OptimizeReport
+    """
+    passes = OrderedDict(PASSES)
+    passes['cse'] = partial(cse, mutable_containers=mutable_containers)
+
+    report = OptimizeReport()
+    _add_counts(report, peephole.optimize(asm))
+    changed = True
+    while changed:
+        changed = False
+        for func in asm.funcs:
+            for name, apply_pass in passes.iteritems():
+                count = apply_pass(func)
+                report.counts[name] += count
+                changed = changed or count
+        if changed:
+            changed = _add_counts(report, peephole.optimize(asm))
+    return report
+
+
+def _add_counts(report, peephole_report):
+    for rule, count in peephole_report.counts.iteritems():
+        report.counts[rule] += count
+    return peephole_report.total
+
+
+def dead_stores(body):
+    """
+    Replaces STORE_VARs of values never loaded with POPs.
+
+    @return: the number of stores removed
+    """
+    cfg = ControlFlowGraph(body)
+    _, live_out = liveness(cfg)
+    removed = 0
+    for block in cfg.blocks:
+        live = live_after(cfg, live_out, block)
+        for instruction, live in zip(cfg.instructions(block), live):
+            if (instruction.instr == Instr.STORE_VAR and
+                    instruction.param not in live):
+                instruction.instr = Instr.POP
+                instruction.param = None
+                removed += 1
+
+    if removed:
+        _remove_pure_pops(body)
+    return removed
+
+
+def _remove_pure_pops(body):
+    """Removes POPs of values pushed just before, without side effects"""
+    targets = peephole._jump_targets(body)
+    i = 0
+    while i < len(body) - 1:
+        if (body[i].instr in _PURE_PUSHES and
+                body[i + 1].instr == Instr.POP and
+                not targets.intersection(body[i + 1].labels)):
+            if i + 2 < len(body):
+                peephole._remove(body, i)
+                peephole._remove(body, i)
+            elif body[i].labels:
+                # At the end of the body, nothing follows to take the push's
+                # labels
+                body[i].instr, body[i].param = Instr.PASS, None
+                del body[i + 1]
+            else:
+                del body[i:]
+        else:
+            i += 1
+
+
+def compact_locals(body):
+    """
+    Gives locals never live at the same time the same slot, numbering slots
+    from 0.
+
+    @return: the number of slots saved
+    """
+    cfg = ControlFlowGraph(body)
+    live_in, live_out = liveness(cfg)
+
+    slots = []
+    interference = {}
+    for instruction in body:
+        if instruction.instr in (Instr.STORE_VAR, Instr.LOAD_LOCAL):
+            if instruction.param not in interference:
+                slots.append(instruction.param)
+                interference[instruction.param] = set()
+    if not slots:
+        return 0
+
+    def interfere(slot, others):
+        for other in others:
+            if other != slot:
+                interference[slot].add(other)
+                interference[other].add(slot)
+
+    # Slots read before they're stored hold nothing, but mustn't be given
+    # another's value
+    for slot in live_in[0]:
+        interfere(slot, live_in[0])
+    for block in cfg.blocks:
+        live = live_after(cfg, live_out, block)
+        for instruction, live in zip(cfg.instructions(block), live):
+            if instruction.instr == Instr.STORE_VAR:
+                interfere(instruction.param, live)
+
+    new_slots = {}
+    for slot in slots:
+        taken = set(new_slots.get(other) for other in interference[slot])
+        new_slot = 0
+        while new_slot in taken:
+            new_slot += 1
+        new_slots[slot] = new_slot
+
+    for instruction in body:
+        if instruction.instr in (Instr.STORE_VAR, Instr.LOAD_LOCAL):
+            instruction.param = new_slots[instruction.param]
+    return len(slots) - len(set(new_slots.itervalues()))
+
+
+####################################
+# Common subexpression elimination #
+####################################
+# Operators which might build a new list or vector
+_CONTAINER_OPS = (Instr.ADD, Instr.SUB, Instr.MULT, Instr.DIV)
+# Pure operators: how many values they pop
+_PURE_OPS = {
+    Instr.ADD: 2,
+    Instr.SUB: 2,
+    Instr.MULT: 2,
+    Instr.DIV: 2,
+    Instr.CMP: 2,
+    Instr.ADD_NUM: 2,
+    Instr.ADD_STR: 2,
+    Instr.MULT_NUM: 2,
+    Instr.CMP_NUM: 2,
+    Instr.LOAD_INDEX: 2,
+    Instr.LEN: 1,
+}
+# Instructions which only pop
+_POPS = {
+    Instr.STORE_VAR: 1,
+    Instr.STORE_GLOBAL: 1,
+    Instr.POP: 1,
+    Instr.JZ: 1,
+    Instr.JNZ: 1,
+    Instr.STORE_INDEX: 3,
+}
+
+
+class _Value(object):
+    """
+    A value on the stack while simulating a basic block
+
+    @ivar number: equal for values known to be equal
+    @ivar start: index of the first instruction computing the value, if it's
+        computed by body[start:end + 1] alone, else None
+    @ivar numeric: whether the value is known to be a number or bool
+    """
+    __slots__ = ('number', 'start', 'end', 'numeric')
+
+    def __init__(self, number, start, end, numeric=False):
+        self.number = number
+        self.start = start
+        self.end = end
+        self.numeric = numeric
+
+
+def _value_numbers(body, block, mutable_containers):
+    """
+    Simulates the stack through a basic block, numbering the values it
+    computes, so those computed more than once share a number.
+
+    @return: for each number, the (start, end) of each pure expression
+        computing it. start is None for those not computed by a range of
+        instructions of their own.
+    """
+    numbers = {}
+    fresh = count()
+    # Bumped by anything which may change a local, a global, or anything
+    versions = {}
+    state = [0]
+    occurrences = {}
+    stack = []
+
+    def number(key):
+        if key not in numbers:
+            numbers[key] = next(fresh)
+        return numbers[key]
+
+    def pop():
+        if stack:
+            return stack.pop()
+        # Pushed before the block, or an unknown number of instructions ago
+        return _Value(next(fresh), None, None)
+
+    def version(key):
+        if key not in versions:
+            versions[key] = next(fresh)
+        return versions[key]
+
+    for i in xrange(block.start, block.end):
+        instruction = body[i]
+        instr, param = instruction.instr, instruction.param
+        if instr == Instr.LOAD_CONST:
+            stack.append(_Value(number((instr, type(param), param)), i, i,
+                                type(param) in (int, float)))
+        elif instr == Instr.LOAD_LOCAL:
+            stack.append(_Value(number((instr, version(('local', param)))),
+                                i, i))
+        elif instr == Instr.LOAD_GLOBAL:
+            stack.append(_Value(
+                number((instr, version(('global', param)), state[0])), i, i))
+        elif instr in _PURE_OPS:
+            operands = [pop() for _ in xrange(_PURE_OPS[instr])]
+            numeric = (instr not in _CONTAINER_OPS or
+                       all(v.numeric for v in operands))
+            key = (instr, param, state[0]) + tuple(v.number for v in operands)
+            value = _Value(number(key), None, i, numeric)
+            # The operands are pushed bottom first, each computed right after
+            # the one below it
+            ranges = [(v.start, v.end) for v in reversed(operands)]
+            if (all(start is not None for start, _ in ranges) and
+                    all(a[1] + 1 == b[0] for a, b in
+                        zip(ranges, ranges[1:] + [(i, i)]))):
+                value.start = ranges[0][0]
+            stack.append(value)
+            if numeric or not mutable_containers:
+                occurrences.setdefault(value.number, []).append(
+                    (value.start, i))
+        elif instr == Instr.DUP:
+            v = pop()
+            stack.append(_Value(v.number, None, i, v.numeric))
+            stack.append(_Value(v.number, None, i, v.numeric))
+        elif instr in _POPS:
+            for _ in xrange(_POPS[instr]):
+                pop()
+            if instr == Instr.STORE_VAR:
+                versions[('local', param)] = next(fresh)
+            elif instr == Instr.STORE_GLOBAL:
+                versions[('global', param)] = next(fresh)
+            elif instr == Instr.STORE_INDEX:
+                state[0] = next(fresh)
+        elif instr in (Instr.PASS, Instr.JMP, Instr.RETN):
+            pass
+        else:
+            # Calls, and anything else whose effects on the stack, globals or
+            # containers aren't known
+            del stack[:]
+            state[0] = next(fresh)
+            if instr in (Instr.BUILD_LIST, Instr.BUILD_MAP):
+                stack.append(_Value(next(fresh), None, None))
+    return occurrences
+
+
+def cse(body, mutable_containers=True):
+    """
+    Keeps expressions computed more than once in a basic block in a new
+    local slot, loading them from it after the first time.
+
+    @param mutable_containers: whether the program might store into lists
+        or vectors, in which case arithmetic which might build one isn't
+        shared
+    @return: the number of expressions no longer computed
+    """
+    eliminated = 0
+    while True:
+        best = None
+        for block in ControlFlowGraph(body).blocks:
+            occurrences = _value_numbers(body, block, mutable_containers)
+            for ranges in occurrences.itervalues():
+                repeats = [(start, end) for start, end in ranges[1:]
+                           if start is not None]
+                # Each repeat saves all but one of its instructions, and
+                # keeping the value costs a DUP and STORE_VAR
+                saved = sum(end - start for start, end in repeats) - 2
+                if repeats and saved >= 0 and (best is None or
+                                               saved > best[0]):
+                    best = saved, ranges[0][1], repeats
+        if best is None:
+            return eliminated
+
+        _, first_end, repeats = best
+        slot = 1 + max([-1] + [instruction.param for instruction in body
+                               if instruction.instr in (Instr.STORE_VAR,
+                                                        Instr.LOAD_LOCAL)])
+        for start, end in reversed(repeats):
+            first = body[start]
+            body[start:end + 1] = [Instruction(Instr.LOAD_LOCAL, slot,
+                                               first.labels, first.line_no)]
+        line_no = body[first_end].line_no
+        body[first_end + 1:first_end + 1] = [
+            Instruction(Instr.DUP, line_no=line_no),
+            Instruction(Instr.STORE_VAR, slot, line_no=line_no),
+        ]
+        eliminated += len(repeats)
+
+
+PASSES = OrderedDict((
+    ('cse', cse),
+    ('dead_stores', dead_stores),
+    ('compact_locals', compact_locals),
+))
@@ -0,0 +1,153 @@
+"""
+Compiles a large source on several cores.
+
+compile_parallel() splits a source into pieces at its column-0 `def`s: each
+piece is a function, with any toplevel statements following it, and the
+first holds the statements before any function. Worker processes lex,
+parse, generate and optimize each piece as a module (see yaksh.linker), and
+the pieces are linked back together in source order. Linking numbers
+functions and globals in piece order, so the binary is the same however
+many processes compiled it.
+
+Type inference is left for the linked program, so it sees across pieces as
+it does compiling serially; it's all that runs after linking, as the other
+optimizer passes look at one body at a time (see
+yaksh.optimizer.optimize_bodies). A function called, or a global read,
+before the piece defining it is rejected with the same error as compiling
+serially.
+
+Generating the pieces as modules does still differ from compiling serially:
+calls from one piece to another aren't inlined or specialized for constant
+arguments, and no global is folded to a constant, as a module can't tell
+whether another assigns it. The program runs the same, with more CALLs and
+LOAD_GLOBALs. Nor can a piece tell whether another stores into lists, so
+arithmetic which might build one isn't shared by cse. A source defining a
+function twice is compiled serially, as pieces can't share a function.
+
+    python -m yaksh.parallel -j 8 -o program.ysh program.yk
+"""
+import argparse
+import re
+from collections import Counter
+from multiprocessing import Pool, cpu_count
+
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import assemble, build_assembly
+from yaksh.lexer import lex_fast
+from yaksh.linker import generate_module, link
+from yaksh.optimizer import optimize
+from yaksh.parser import parse
+from yaksh.typeinfer import specialize
+from yaksh.vm import AbstractMachine
+
+
+_DEF = re.compile(r'^def\s+(\w+)', re.MULTILINE)
+
+
+def split_pieces(source):
+    """
+    @return: (source, first line) of each piece of source, in order, lines
+        counting from 0
+    """
+    bounds = [0] + [match.start() for match in _DEF.finditer(source)]
+    bounds.append(len(source))
+    pieces = []
+    line_no = 0
+    for start, end in zip(bounds, bounds[1:]):
+        if start == end:
+            continue
+        piece = source[start:end]
+        pieces.append((piece, line_no))
+        line_no += piece.count('\n')
+    return pieces
+
+
+def _compile_piece(piece):
+    """
+    @return: (object file, functions defined, globals used, forward
+        references: see BytecodeAssemblyGenerator.forward_refs)
+    """
+    obj, gen = generate_module(*piece, infer_types=False)
+    func_names, global_names = gen.symbol_table()
+    defined = func_names[:len(func_names) - len(gen.imported_funcs)]
+    return obj, defined, global_names, gen.forward_refs
+
+
+def _check_references(compiled, host_globals):
+    """
+    Raises the error compiling serially would, if a piece refers to a
+    function or global before the piece defining it
+    """
+    defined = {'function': set(), 'global': set(host_globals)}
+    for _, funcs, global_names, forward_refs in compiled:
+        for kind, name, error in forward_refs:
+            if name not in defined[kind]:
+                raise error
+        defined['function'].update(funcs)
+        defined['global'].update(global_names)
+
+
+def _specialize_linked(bytecode, host_globals):
+    """Specializes the opcodes of a linked binary by type"""
+    asm = build_assembly(*AbstractMachine(bytecode).decode_all(),
+                         host_globals=len(host_globals))
+    specialize(asm)
+    return assemble(asm)
+
+
+def _compile_serial(source, host_globals):
+    gen = BytecodeAssemblyGenerator(parse(lex_fast(source)),
+                                    host_globals=host_globals)
+    asm = gen.generate()
+    optimize(asm)
+    return assemble(asm)
+
+
+def compile_parallel(source, jobs=None, host_globals=()):
+    """
+    Compiles source to a binary, its pieces in jobs processes at once
+
+    @param jobs: number of processes, by default one per core
+    @param host_globals: names of globals provided by the embedding host,
+        which are given the first global indices, in order
+    """
+    defined = Counter(_DEF.findall(source))
+    if any(count > 1 for count in defined.itervalues()):
+        return _compile_serial(source, host_globals)
+
+    pieces = split_pieces(source) or [(source, 0)]
+    if jobs is None:
+        jobs = cpu_count()
+    if jobs > 1 and len(pieces) > 1:
+        pool = Pool(min(jobs, len(pieces)))
+        try:
+            compiled = pool.map(_compile_piece, pieces)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        compiled = map(_compile_piece, pieces)
+
+    _check_references(compiled, host_globals)
+    objects = [obj for obj, _, _, _ in compiled]
+    return _specialize_linked(link(objects, host_globals, one_source=True),
+                              host_globals)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='yaksh.parallel')
+    parser.add_argument('source', help='.yk source to compile')
+    parser.add_argument('-o', '--output', required=True,
+                        help='where to write the .ysh binary')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of processes, by default one per core')
+    args = parser.parse_args()
+
+    with open(args.source) as f:
+        bytecode = compile_parallel(f.read(), args.jobs)
+    with open(args.output, 'wb') as f:
+        f.write(bytecode)
+
+
+if __name__ == '__main__':
+    main()
@@ -71,6 +71,37 @@ class Symbol(object):
         return '<%s %s, %d children>' % (self.__class__.__name__, self.name,
                                          len(self.symbols))
 
+    def tokens(self):
+        """Yields the source tokens beneath this symbol, depth-first"""
+        for s in self.symbols:
+            if isinstance(s, Symbol):
+                for token in s.tokens():
+                    yield token
+            # Tokens synthesized by the parser have no position
+            elif isinstance(s, Token) and s.line_no >= 0:
+                yield s
+
+    @property
+    def line_no(self):
+        """Line of the symbol's first token, or None if it has no tokens"""
+        for token in self.tokens():
+            return token.line_no
+
+    @property
+    def span(self):
+        """
+        ((line_no, char_no), (line_no, char_no)) of the start of the symbol's
+        first token and the end of its last, or None if it has no tokens.
+        Like Token's, lines and columns count from 0.
+        """
+        positions = [(t.line_no, t.char_no, len(t.text))
+                     for t in self.tokens()]
+        if not positions:
+            return None
+        start = min(positions)
+        end = max(positions)
+        return start[:2], (end[0], end[1] + end[2])
+
 
 class Name(Symbol):
     @property
@@ -198,6 +229,52 @@ class Var(Symbol):
         return self.text
 
 
+class ListLiteral(Symbol):
+    @property
+    def items(self):
+        return self.symbols
+
+    def __str__(self):
+        return '[%s]' % ', '.join(str(s) for s in self.symbols)
+
+
+class DictLiteral(Symbol):
+    @property
+    def items(self):
+        """List of (key, value) value_stmt pairs"""
+        return zip(self.symbols[::2], self.symbols[1::2])
+
+    def __str__(self):
+        return '{%s}' % ', '.join('%s: %s' % item for item in self.items)
+
+
+class Subscript(Symbol):
+    @property
+    def container(self):
+        return self.symbols[0]
+
+    @property
+    def index(self):
+        return self.symbols[1]
+
+    def __str__(self):
+        return '%s[%s]' % (self.container, self.index)
+
+
+class IndexAssign(Symbol):
+    @property
+    def target(self):
+        """The subscript symbol being assigned to"""
+        return self.symbols[0]
+
+    @property
+    def value(self):
+        return self.symbols[1]
+
+    def __str__(self):
+        return '%s = %s' % (self.target, self.value)
+
+
 class Parameters(Symbol):
     @property
     def names(self):
@@ -344,7 +421,8 @@ cur_sym = None
 cur_idx = None
 cur = None
 _tokens = []
-block_indent_level = None
+# Indentation of each block currently being parsed, innermost last
+indent_levels = []
 
 
 def _next():
@@ -408,12 +486,52 @@ def name():
 
 
 def operator():
-    if cur.type in OPERATORS.values():
+    if cur and cur.type in OPERATORS.values():
         _getsym()
         return _endsym('operator')
 
 
+def list_literal():
+    items = arglist().symbols
+    _term('CLOSE_BRACKET')
+    return Symbol('list_literal', items)
+
+
+def dict_literal():
+    items = []
+    while True:
+        key = value_stmt()
+        if not key:
+            break
+        _term('BLOCK_BEGIN')
+        v = value_stmt()
+        if not v:
+            raise ValueError('Expected a dict value')
+        items.extend((key, v))
+        if not _accept('COMMA', False):
+            break
+    _term('CLOSE_BRACE')
+    return Symbol('dict_literal', items)
+
+
+def subscripts(v):
+    """Wraps value `v` in a subscript symbol for each trailing [index]"""
+    while _accept('OPEN_BRACKET', False):
+        index = value_stmt()
+        if not index:
+            raise ValueError('Expected an index')
+        _term('CLOSE_BRACKET')
+        v = Symbol('value', (Symbol('subscript', (v, index)),))
+    return v
+
+
 def value():
+    v = _value()
+    if v:
+        return subscripts(v)
+
+
+def _value():
     _name = name()
     if _name:
         if _accept('OPEN_PAREN', False):
@@ -434,6 +552,10 @@ def value():
         elif _accept('LITERAL'):
             literal = _endsym('literal')
             return _sym('value', (literal,))
+        elif _accept('OPEN_BRACKET', False):
+            return Symbol('value', (list_literal(),))
+        elif _accept('OPEN_BRACE', False):
+            return Symbol('value', (dict_literal(),))
 
 
 def cmp_operator():
@@ -526,12 +648,12 @@ def reserved_stmt():
             if_piece.symbols.append(_block)
             if_pieces.append(if_piece)
 
-            if _accept('R_ELIF'):
+            if _accept_clause('R_ELIF'):
                 if_piece = _endsym('elif_stmt')
             else:
                 break
 
-        if _accept('R_ELSE'):
+        if _accept_clause('R_ELSE'):
             else_stmt = _endsym('else_stmt')
             _expect('BLOCK_BEGIN', False)
             _block = block()
@@ -571,6 +693,15 @@ def stmt():
             _term('CLOSE_PAREN')
             fcall.symbols.append(args)
             return fcall
+        elif cur and cur.type == 'OPEN_BRACKET':
+            var = _endsym('var')
+            var.symbols.append(_name)
+            target = subscripts(Symbol('value', (var,))).symbols[0]
+            _term('ASSIGN')
+            value = value_stmt()
+            if not value:
+                raise ValueError('Expected a value statement')
+            return Symbol('index_assign', (target, value))
         elif _accept('NEWLINE'):
             var = _endsym('var')
             var.symbols.append(_name)
@@ -585,20 +716,39 @@ def stmt():
             return value_stmt()
 
 
+def _indent_level():
+    """Indentation of the statements in the innermost block being parsed"""
+    return indent_levels[-1] if indent_levels else 0
+
+
+def _accept_clause(token_type):
+    """Accepts a clause (e.g. else) at the same indentation as its if"""
+    if (cur and cur.type == 'INDENT' and len(cur.text) == _indent_level() and
+            cur_idx + 1 < len(_tokens) and
+            _tokens[cur_idx + 1].type == token_type):
+        _next()
+    return _accept(token_type)
+
+
 def block():
     block_indent_level = None
     statements = []
     while True:
         _eat_newlines()
-        if not _accept('INDENT'):
+        if not cur or cur.type != 'INDENT':
             break
-        indent = _endsym('indent')
-        indent_level = len(indent.symbols[0].text)
-        if block_indent_level != indent_level:
-            if block_indent_level is None:
-                block_indent_level = indent_level
-            else:
-                raise ValueError('Mixed indentation %r' % indent)
+        indent_level = len(cur.text)
+        if block_indent_level is None:
+            if indent_level <= _indent_level():
+                break
+            block_indent_level = indent_level
+            indent_levels.append(indent_level)
+        elif indent_level < block_indent_level:
+            # Dedent, leave the INDENT for the enclosing block
+            break
+        elif indent_level > block_indent_level:
+            raise ValueError('Mixed indentation %r' % cur)
+        _next()
 
         if _accept('NEWLINE'):
             continue
@@ -608,6 +758,8 @@ def block():
             statements.append(s)
         else:
             break
+    if block_indent_level is not None:
+        indent_levels.pop()
     return Symbol('block', statements)
 
 
@@ -617,6 +769,7 @@ def parse(tokens):
 
     global symbols, cur_idx, cur_sym, _tokens, cur
     _tokens = tokens
+    indent_levels[:] = []
 
     symbols = []
     cur_idx = 0
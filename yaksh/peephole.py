@@ -0,0 +1,223 @@
+"""
+A peephole optimizer for in-memory assembly (see Assembly in
+yaksh.bytecode_compiler), run between BytecodeAssemblyGenerator.generate()
+and assemble().
+
+Each rule rewrites one function body, or the toplevel, and they're applied
+until none changes anything:
+ - dead_code: instructions no path reaches, like those after a RETN or JMP
+ - thread_jumps: jumps landing on a JMP are pointed at its target, and a JMP
+   landing on a RETN becomes a RETN
+ - jump_to_next: a JMP to the instruction right after it
+ - passes: PASSes, which the generator uses as landing pads for labels. Their
+   labels move to the next instruction. A PASS ending a body that's jumped to
+   is kept, as there's nothing after it to land on.
+ - store_load: `STORE_GLOBAL n; LOAD_GLOBAL n` becomes `DUP; STORE_GLOBAL n`,
+   and the same for locals
+
+The report counts how many instructions each rule removed, or for
+thread_jumps and store_load, how many it rewrote. Labels no jump uses any
+more are dropped.
+"""
+from collections import OrderedDict
+
+from yaksh.bytecode_compiler import Instr
+
+
+_STORE_LOADS = {
+    Instr.STORE_GLOBAL: Instr.LOAD_GLOBAL,
+    Instr.STORE_VAR: Instr.LOAD_LOCAL,
+}
+
+
+class PeepholeReport(object):
+    def __init__(self):
+        self.counts = OrderedDict((rule, 0) for rule in RULES)
+
+    @property
+    def total(self):
+        return sum(self.counts.itervalues())
+
+    def __str__(self):
+        return '\n'.join('%-14s %d' % item for item in self.counts.iteritems())
+
+
+def optimize(asm):
+    """
+    Optimizes each body of asm, in place.
+
+    @return: a PeepholeReport
+    """
+    report = PeepholeReport()
+    for body in asm.bodies:
+        optimize_body(body, report)
+    return report
+
+
+def optimize_body(body, report=None):
+    """Optimizes a list of Instructions in place"""
+    if report is None:
+        report = PeepholeReport()
+    _check_labels(body)
+    changed = True
+    while changed:
+        changed = False
+        for rule, apply_rule in RULES.iteritems():
+            count = apply_rule(body)
+            if count:
+                report.counts[rule] += count
+                changed = True
+
+    targets = _jump_targets(body)
+    for instruction in body:
+        if instruction.labels:
+            instruction.labels = [label for label in instruction.labels
+                                  if label in targets]
+    return report
+
+
+def _check_labels(body):
+    """Raises a ValueError for a jump to a missing label, as assemble() does"""
+    labels = _label_indices(body)
+    for label in _jump_targets(body):
+        if label not in labels:
+            raise ValueError("Unknown label '%s'" % label)
+
+
+def _label_indices(body):
+    indices = {}
+    for i, instruction in enumerate(body):
+        for label in instruction.labels:
+            indices[label] = i
+    return indices
+
+
+def _label_targets(body):
+    return dict((label, body[i])
+                for label, i in _label_indices(body).iteritems())
+
+
+def _jump_targets(body):
+    return set(instruction.param for instruction in body
+               if instruction.instr in Instr.JUMPS)
+
+
+def _remove(body, i):
+    """Removes body[i], moving its labels onto the next instruction"""
+    instruction = body.pop(i)
+    if instruction.labels:
+        following = body[i]
+        following.labels = list(instruction.labels) + list(following.labels)
+
+
+#########
+# Rules #
+#########
+def dead_code(body):
+    if not body:
+        return 0
+    labels = _label_indices(body)
+    reachable = set()
+    pending = [0]
+    while pending:
+        i = pending.pop()
+        if i in reachable or i >= len(body):
+            continue
+        reachable.add(i)
+        instr = body[i].instr
+        if instr in Instr.JUMPS:
+            pending.append(labels[body[i].param])
+        if instr not in (Instr.JMP, Instr.RETN):
+            pending.append(i + 1)
+
+    removed = len(body) - len(reachable)
+    if removed:
+        # No reachable jump lands on an unreachable instruction, so their
+        # labels go with them
+        body[:] = [instruction for i, instruction in enumerate(body)
+                   if i in reachable]
+    return removed
+
+
+def thread_jumps(body):
+    labels = _label_targets(body)
+    rewritten = 0
+    for instruction in body:
+        if instruction.instr not in Instr.JUMPS:
+            continue
+        target = labels[instruction.param]
+        if instruction.instr == Instr.JMP and target.instr == Instr.RETN:
+            instruction.instr = Instr.RETN
+            instruction.param = None
+            rewritten += 1
+            continue
+
+        seen = set()
+        label = instruction.param
+        while target.instr == Instr.JMP and target.param not in seen:
+            seen.add(target.param)
+            label = target.param
+            target = labels[label]
+        if label != instruction.param:
+            instruction.param = label
+            rewritten += 1
+    return rewritten
+
+
+def jump_to_next(body):
+    labels = _label_targets(body)
+    removed = 0
+    i = 0
+    while i < len(body) - 1:
+        instruction = body[i]
+        if (instruction.instr == Instr.JMP and
+                labels[instruction.param] is body[i + 1]):
+            _remove(body, i)
+            removed += 1
+        else:
+            i += 1
+    return removed
+
+
+def passes(body):
+    targets = _jump_targets(body)
+    removed = 0
+    i = 0
+    while i < len(body):
+        instruction = body[i]
+        if instruction.instr != Instr.PASS:
+            i += 1
+        elif i < len(body) - 1:
+            _remove(body, i)
+            removed += 1
+        elif targets.intersection(instruction.labels):
+            break
+        else:
+            body.pop()
+            removed += 1
+    return removed
+
+
+def store_load(body):
+    targets = _jump_targets(body)
+    rewritten = 0
+    for i in xrange(len(body) - 1):
+        store, load = body[i], body[i + 1]
+        if (_STORE_LOADS.get(store.instr) == load.instr and
+                store.param == load.param and
+                not targets.intersection(load.labels)):
+            load.instr = store.instr
+            load.line_no = store.line_no
+            store.instr = Instr.DUP
+            store.param = None
+            rewritten += 1
+    return rewritten
+
+
+RULES = OrderedDict((
+    ('dead_code', dead_code),
+    ('thread_jumps', thread_jumps),
+    ('jump_to_next', jump_to_next),
+    ('passes', passes),
+    ('store_load', store_load),
+))
@@ -0,0 +1,457 @@
+import io
+import os
+import sys
+import threading
+from StringIO import StringIO
+
+import pytest
+
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import (MAGIC_V2, Assembly, Instr, Instruction,
+                                     Section, _StreamingBody,
+                                     _StreamingConsts, _write_v2_body,
+                                     assemble, assemble_stream, build_assembly,
+                                     load_assembly, parse_assembly,
+                                     write_program, write_sections)
+from yaksh.lexer import lex
+from yaksh.parser import parse
+from yaksh.tests.utils import capture_stdout, run_output, vm_bytecode
+from yaksh.vm import AbstractMachine, StreamingMachine, convert
+
+
+def test_load_from_file(tmpdir):
+    path = tmpdir.join('strings.ysh')
+    path.write(assemble('''
+LOAD_CONST 'first'
+CALL_BUILTIN 0
+LOAD_CONST 'second'
+CALL_BUILTIN 0
+LOAD_CONST 3
+CALL_BUILTIN 0
+'''), mode='wb')
+
+    am = AbstractMachine.from_file(str(path))
+    assert run_output(am) == 'first\nsecond\n3\n'
+
+
+def test_string_constants():
+    strings = ['s%d' % i * i for i in xrange(1, 50)]
+    asm = '\n'.join("LOAD_CONST '%s'\nCALL_BUILTIN 0" % s for s in strings)
+    am = AbstractMachine(assemble(asm))
+    assert run_output(am) == ''.join(s + '\n' for s in strings)
+    assert am._consts == strings
+
+
+def test_lazy_decoding():
+    am = AbstractMachine(vm_bytecode('''
+def unused():
+    print('unused')
+def used(a):
+    if a:
+        print('used')
+used(1)
+''', inline_max_size=0, specialize_max_clones=0))
+    assert am._funcs == [None, None]
+    assert run_output(am) == 'used\n'
+    assert am._funcs[0] is None
+    assert am._funcs[1] is not None
+    assert 'unused' not in am._consts
+
+
+@pytest.mark.parametrize('size', (0, 2, 6, 9))
+def test_truncated(size):
+    bytecode = assemble("LOAD_CONST 'abc'\nCALL_BUILTIN 0")
+    with pytest.raises(ValueError):
+        AbstractMachine(bytecode[:size])
+
+
+def test_many_functions_and_constants():
+    num_funcs = 20000
+    asm = []
+    for i in xrange(num_funcs):
+        asm.append("PROC\nLOAD_CONST 'f%d'\nCALL_BUILTIN 0\nMAKE_FUNCTION" % i)
+    for i in (0, 255, 256, num_funcs - 1):
+        asm.append('CALL %d' % i)
+    # Push the constant index past 16 bits
+    asm.extend('LOAD_CONST %d' % i for i in xrange(70000))
+    asm.append('CALL_BUILTIN 0')
+
+    am = AbstractMachine(assemble('\n'.join(asm)))
+    assert len(am._funcs) == num_funcs
+    assert run_output(am) == 'f0\nf255\nf256\nf%d\n69999\n' % (num_funcs - 1)
+    assert am._toplevel[-2] == (Instr.LOAD_CONST, num_funcs + 69999)
+
+
+def test_wide_jump():
+    asm = ['JMP end']
+    asm.extend(['PASS'] * 70000)
+    asm.append("end: LOAD_CONST 'done'\nCALL_BUILTIN 0")
+    am = AbstractMachine(assemble('\n'.join(asm)))
+    assert am._toplevel[0] == (Instr.JMP, 70001)
+    assert run_output(am) == 'done\n'
+
+
+def test_many_globals_and_locals():
+    count = 300
+    params = ', '.join('p%d' % i for i in xrange(count))
+    source = ['def last(%s):' % params,
+              '    x = p%d' % (count - 1),
+              '    return x']
+    source.extend('g%d = %d' % (i, i) for i in xrange(count))
+    names = ', '.join('g%d' % i for i in xrange(count))
+    source.append('items = [%s]' % names)
+    source.append('print(last(%s))' % names)
+    source.append('print(len(items))')
+    assert run_output(AbstractMachine(vm_bytecode('\n'.join(source)))) == (
+        '%d\n%d\n' % (count - 1, count))
+
+
+FORMAT_PROGRAM = '''
+def greet(name, excited):
+    if excited:
+        return 'hello ' + name + '!!'
+    return 'hello ' + name
+print(greet('world', 1))
+print(3.5 * 2)
+'''
+
+
+@pytest.mark.parametrize('version', (1, 2))
+def test_format_versions(version):
+    bc_asm = BytecodeAssemblyGenerator(parse(lex(FORMAT_PROGRAM))).generate()
+    am = AbstractMachine(assemble(bc_asm, version=version))
+    assert am.version == version
+    assert run_output(am) == 'hello world!!\n7.0\n'
+
+
+# Written by the assembler from before binaries had indexes, from
+# fixtures/baseline.yk
+BASELINE = os.path.join(os.path.dirname(__file__), 'fixtures', 'baseline.ysh')
+BASELINE_OUTPUT = 'positive\nnegative\nzero\n3.0\ndone\n'
+
+
+def test_original_format():
+    with open(BASELINE, 'rb') as f:
+        am = AbstractMachine(f.read())
+    assert am.version == 0
+    assert run_output(am) == BASELINE_OUTPUT
+    assert run_output(AbstractMachine.from_file(BASELINE)) == BASELINE_OUTPUT
+
+
+def test_convert_original_format():
+    with open(BASELINE, 'rb') as f:
+        v0 = f.read()
+    for version in (1, 2):
+        am = AbstractMachine(convert(v0, version=version))
+        assert am.version == version
+        assert run_output(am) == BASELINE_OUTPUT
+    assert (AbstractMachine(convert(v0)).decode_all() ==
+            AbstractMachine(v0).decode_all())
+
+
+def test_convert():
+    v1 = assemble(BytecodeAssemblyGenerator(
+        parse(lex(FORMAT_PROGRAM))).generate(), version=1)
+    v2 = convert(v1)
+    assert v2.startswith(MAGIC_V2)
+    assert len(v2) < len(v1)
+    assert AbstractMachine(v2).decode_all() == AbstractMachine(v1).decode_all()
+    assert convert(v2, version=1) == v1
+
+
+def test_v2_constants():
+    consts = [-1, 0, 2 ** 40, -(2 ** 40), 0.1, 'a\0b', '', 'a\0b']
+    toplevel = [(Instr.LOAD_CONST, i) for i in xrange(len(consts))]
+    am = AbstractMachine(write_program(consts, [], toplevel))
+    assert am.decode_all()[0] == consts
+
+
+def test_v2_skips_unknown_sections():
+    bytecode = assemble("LOAD_CONST 'hi'\nCALL_BUILTIN 0")
+    sections = _split_sections(bytecode)
+    bytecode = write_sections([(99, 'unknown')] + sections)
+    assert run_output(AbstractMachine(bytecode)) == 'hi\n'
+
+
+def _split_sections(bytecode):
+    """Returns the (section id, data) pairs of a version 2 binary"""
+    am = AbstractMachine(bytecode)
+    return [(section_id, bytecode[start:end])
+            for section_id, (start, end) in sorted(am._sections.items(),
+                                                   key=lambda s: s[1])]
+
+
+def _chunks(bytecode, size):
+    return [bytecode[i:i + size] for i in xrange(0, len(bytecode), size)]
+
+
+@pytest.mark.parametrize('size', (1, 7, 4096))
+def test_streaming(size):
+    bytecode = vm_bytecode(FORMAT_PROGRAM)
+    am = StreamingMachine(_chunks(bytecode, size))
+    assert run_output(am) == 'hello world!!\n7.0\n'
+    assert am.decode_all() == AbstractMachine(bytecode).decode_all()
+
+
+def test_streaming_file():
+    bytecode = vm_bytecode(FORMAT_PROGRAM)
+    am = StreamingMachine(StringIO(bytecode), chunk_size=5)
+    assert run_output(am) == 'hello world!!\n7.0\n'
+
+
+def test_streaming_runs_before_end():
+    source = ['def f%d():\n    return %d' % (i, i) for i in xrange(200)]
+    source.append("print('first')")
+    source.append('print(f199())')
+    bytecode = vm_bytecode('\n'.join(source), inline_max_size=0)
+
+    with capture_stdout() as output:
+        # Output seen as each chunk is handed over
+        seen = []
+
+        def chunks():
+            for chunk in _chunks(bytecode, 16):
+                seen.append(output.getvalue())
+                yield chunk
+        StreamingMachine(chunks()).run()
+
+    assert output.getvalue() == 'first\n199\n'
+    first = seen.index('first\n')
+    assert first < len(seen) // 2
+    assert seen[first:] == ['first\n'] * (len(seen) - first)
+
+
+def test_streaming_pipe():
+    source = ['def f%d():\n    return %d' % (i, i) for i in xrange(200)]
+    source.append("print('first')")
+    source.append('print(f199())')
+    bytecode = vm_bytecode('\n'.join(source), inline_max_size=0)
+    printed = threading.Event()
+    # Whether 'first' was printed before the second half was written
+    early = []
+
+    class Output(object):
+        def __init__(self):
+            self.data = []
+
+        def write(self, s):
+            self.data.append(s)
+            printed.set()
+
+    def write():
+        os.write(w, bytecode[:len(bytecode) // 2])
+        early.append(printed.wait(5))
+        os.write(w, bytecode[len(bytecode) // 2:])
+        os.close(w)
+
+    r, w = os.pipe()
+    writer = threading.Thread(target=write)
+    writer.start()
+    old_stdout, sys.stdout = sys.stdout, Output()
+    try:
+        with io.open(r, 'rb') as f:
+            StreamingMachine(f).run()
+        output = ''.join(sys.stdout.data)
+    finally:
+        sys.stdout = old_stdout
+        writer.join()
+
+    assert output == 'first\n199\n'
+    assert early == [True]
+
+
+@pytest.mark.parametrize('open_pipe', (os.fdopen, io.open))
+def test_streaming_buffered(open_pipe):
+    # Whatever the file object has buffered is streamed too
+    r, w = os.pipe()
+    os.write(w, '#!yaksh\n' + vm_bytecode(FORMAT_PROGRAM))
+    os.close(w)
+    with open_pipe(r, 'rb') as f:
+        assert f.readline() == '#!yaksh\n'
+        assert run_output(StreamingMachine(f)) == 'hello world!!\n7.0\n'
+
+
+def test_streaming_functions_first():
+    bytecode = vm_bytecode(FORMAT_PROGRAM)
+    sections = sorted(_split_sections(bytecode),
+                      key=lambda s: s[0] != Section.FUNCS)
+    am = StreamingMachine(_chunks(write_sections(sections), 3))
+    assert run_output(am) == 'hello world!!\n7.0\n'
+
+
+def test_streaming_truncated():
+    # Cut into the function bodies, which are needed to run, rather than the
+    # line tables after them
+    bytecode = write_sections([s for s in _split_sections(
+        vm_bytecode(FORMAT_PROGRAM, specialize_max_clones=0))
+        if s[0] != Section.LINES])
+    with pytest.raises(ValueError):
+        run_output(StreamingMachine([bytecode[:-1]]))
+    with pytest.raises(ValueError):
+        StreamingMachine([assemble('LOAD_CONST 1', version=1)])
+
+
+LINES_PROGRAM = '''
+def half(x):
+    if x > 1:
+        return x / 2
+
+    return [] + x
+print(half(4))
+print(half(1))
+'''
+
+
+def test_line_table():
+    am = AbstractMachine(vm_bytecode(LINES_PROGRAM, inline_max_size=0,
+                                     specialize_max_clones=0))
+    with capture_stdout() as output:
+        with pytest.raises(TypeError) as excinfo:
+            am.run()
+    assert output.getvalue() == '2\n'
+    assert excinfo.value.line_no == 6
+    assert str(excinfo.value).endswith('(line 6)')
+
+    assert am.line_for(0) == 7
+    assert am.line_for(4) == 8
+    assert am.line_for(0, func_idx=0) == 2
+    assert am.line_for(1, func_idx=0) == 3
+    assert am.line_for(100, func_idx=0) == 6
+    assert am.line_for(0, func_idx=1) is None
+
+
+def test_line_table_formats():
+    bc_asm = BytecodeAssemblyGenerator(parse(lex(LINES_PROGRAM)),
+                                       inline_max_size=0,
+                                       specialize_max_clones=0).generate()
+    program = parse_assembly(bc_asm)
+    assert program[3][-1] == [(0, 7), (3, 8)]
+    v2 = assemble(bc_asm)
+    assert AbstractMachine(v2).decode_all() == program
+    assert convert(v2) == v2
+    assert AbstractMachine.from_decoded(*program).line_for(3) == 8
+
+    # Version 1 can't hold line tables, nor can programs without .line
+    assert AbstractMachine(assemble(bc_asm, version=1)).line_for(0) is None
+    assert AbstractMachine(assemble('PASS')).line_for(0) is None
+    assert len(assemble('.line 1\nPASS')) > len(assemble('PASS'))
+
+    with pytest.raises(ValueError):
+        assemble('.line one\nPASS')
+    with pytest.raises(ValueError):
+        assemble('.lines 1\nPASS')
+
+
+def test_streaming_line_table():
+    bytecode = vm_bytecode(LINES_PROGRAM, inline_max_size=0,
+                           specialize_max_clones=0)
+    am = StreamingMachine(_chunks(bytecode, 5))
+    with capture_stdout():
+        with pytest.raises(TypeError) as excinfo:
+            am.run()
+    # The line tables come last, after the functions being run
+    assert excinfo.value.line_no is None
+    am.decode_all()
+    assert am.line_for(1, func_idx=0) == 3
+
+
+def test_assembly_text():
+    asm = BytecodeAssemblyGenerator(parse(lex(FORMAT_PROGRAM + '''
+print('it\\'s \\ "quoted"')
+print(0.1 + 12345678901234567890)
+'''))).generate()
+    assert isinstance(asm, Assembly)
+    text = str(asm)
+    assert load_assembly(text) == asm
+    assert assemble(text) == assemble(asm)
+    assert run_output(AbstractMachine(assemble(asm))) == (
+        'hello world!!\n7.0\nit\'s \\ "quoted"\n1.23456789012e+19\n')
+
+
+def test_assembly_labels():
+    asm = Assembly(toplevel=[
+        Instruction(Instr.JMP, 'end'),
+        Instruction(Instr.LOAD_CONST, 'skipped'),
+        Instruction(Instr.CALL_BUILTIN, 0),
+        Instruction(Instr.LOAD_CONST, 'end', labels=['a', 'end']),
+        Instruction(Instr.CALL_BUILTIN, 0),
+    ])
+    assert str(asm).split('\n')[3] == "a: end: LOAD_CONST 'end'"
+    assert run_output(AbstractMachine(assemble(asm))) == 'end\n'
+
+    asm.toplevel[0].param = 'missing'
+    with pytest.raises(ValueError):
+        assemble(asm)
+    asm.toplevel[1].labels = ['a']
+    with pytest.raises(ValueError):
+        assemble(asm)
+
+
+def test_build_assembly():
+    asm = '\n'.join(_many_functions_asm(3)) + '\nJMP _out\n_out: PASS'
+    program = parse_assembly(asm)
+    asm = build_assembly(*program)
+    assert parse_assembly(asm) == program
+    # A jump to the end of a body lands on a PASS added for it
+    consts, funcs, toplevel, lines = program
+    asm = build_assembly(consts, funcs, toplevel[:-1], lines)
+    assert asm.toplevel[-1].instr == Instr.PASS
+    assert asm.toplevel[-2].param == asm.toplevel[-1].labels[0]
+
+
+def _many_functions_asm(count):
+    for i in xrange(count):
+        yield 'PROC'
+        yield '.line %d' % (i + 1)
+        yield "LOAD_CONST '%s'" % ('long string %d ' % (i % 3) * 10)
+        yield 'JZ _end'
+        yield 'LOAD_CONST %d' % i
+        yield '_end: CALL_BUILTIN 0'
+        yield 'MAKE_FUNCTION'
+    yield '_top: CALL %d' % (count - 1)
+    yield 'LOAD_CONST 0.5'
+    yield 'JNZ _top'
+
+
+@pytest.mark.parametrize('program', ('format', 'lines', 'functions'))
+def test_assemble_stream(program):
+    if program == 'functions':
+        asm = '\n'.join(_many_functions_asm(300))
+    else:
+        source = FORMAT_PROGRAM if program == 'format' else LINES_PROGRAM
+        asm = str(BytecodeAssemblyGenerator(parse(lex(source))).generate())
+    out = StringIO()
+    assemble_stream(StringIO(asm), out)
+    assert out.getvalue() == assemble(asm)
+
+
+@pytest.mark.parametrize('asm', (
+    'JMP _missing',
+    'PROC\nJMP _missing\nMAKE_FUNCTION',
+    '_a: PASS\n_a: PASS',
+    'PASS\nMAKE_FUNCTION',
+    'PROC\nPASS',
+))
+def test_assemble_stream_errors(asm):
+    with pytest.raises(ValueError):
+        assemble_stream(asm.split('\n'), StringIO())
+
+
+def test_assemble_stream_flushes():
+    out = StringIO()
+    body = _StreamingBody(_StreamingConsts(StringIO(), StringIO()), out,
+                          StringIO())
+    body.add(Instruction(Instr.LOAD_CONST, 1))
+    assert body.size == 2
+    # Held back until its label is seen
+    body.add(Instruction(Instr.JMP, 'a'))
+    body.add(Instruction(Instr.PASS))
+    assert body.size == 2
+    body.add(Instruction(Instr.PASS, labels=['a']))
+    assert body.size == 6
+    body.add(Instruction(Instr.JMP, 'a'))
+    assert body.size == 8
+    body.finish()
+    assert out.getvalue() == _write_v2_body(
+        [(Instr.LOAD_CONST, 0), (Instr.JMP, 3), (Instr.PASS, None),
+         (Instr.PASS, None), (Instr.JMP, 3)])
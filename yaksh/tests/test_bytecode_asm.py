@@ -0,0 +1,301 @@
+import pytest
+
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import Instr
+from yaksh.lexer import lex
+from yaksh.parser import parse
+from yaksh.peephole import optimize_body
+from yaksh.tests.utils import vm_output
+
+
+def _generate(source):
+    return BytecodeAssemblyGenerator(parse(lex(source))).generate()
+
+
+def _instrs(code):
+    return [(instr.instr, instr.param) for instr in code]
+
+
+@pytest.mark.parametrize(
+    ('expr', 'expected'),
+    (
+        ('8 / 2', 4),
+        ('4 - 4 / 2', 2),
+        # Operators group from the right
+        ('8 - 3 - 1', 6),
+        ('(8 - 3) - 1', 4),
+        ('1.5 * 2', 3.0),
+    )
+)
+def test_fold_constants(expr, expected):
+    asm = _generate('print(%s)' % expr)
+    assert _instrs(asm.toplevel) == [(Instr.LOAD_CONST, expected),
+                                     (Instr.CALL_BUILTIN, 0)]
+    assert vm_output('print(%s)' % expr) == '%s\n' % expected
+
+
+def test_fold_constant_suffix():
+    asm = _generate('def f(a):\n    return a * 2 + 3 * 4\n')
+    assert _instrs(asm.funcs[0])[1:] == [
+        (Instr.LOAD_CONST, 12),
+        (Instr.LOAD_CONST, 2),
+        (Instr.LOAD_LOCAL, 0),
+        (Instr.MULT, None),
+        (Instr.ADD, None),
+        (Instr.RETN, None),
+    ]
+
+
+@pytest.mark.parametrize('expr', ('1 / 0', '1 == 1', '65536 * 65536'))
+def test_not_folded(expr):
+    # Errors are left to the VM; bools and big ints wouldn't load back as-is
+    asm = _generate('print(%s)' % expr)
+    assert len(asm.toplevel) > 2
+
+
+def test_fold_constant_if():
+    asm = _generate('''
+if 1 + 1:
+    print('taco')
+elif x:
+    print('never')
+''')
+    assert _instrs(asm.toplevel) == [(Instr.LOAD_CONST, 'taco'),
+                                     (Instr.CALL_BUILTIN, 0)]
+
+
+@pytest.mark.parametrize(
+    ('source', 'expected'),
+    (
+        ('''
+if 1 - 1:
+    print('a')
+elif 2 > 1:
+    print('b')
+else:
+    print('c')
+''', 'b'),
+        ('''
+x = 5
+if 0:
+    x = 1
+elif x:
+    print('x')
+else:
+    print('not x')
+''', 'x'),
+        ('''
+def f(a):
+    if 0:
+        b = 1
+    else:
+        b = a
+    return b
+print(f(3))
+''', '3'),
+    )
+)
+def test_constant_if_output(source, expected):
+    assert vm_output(source).strip() == expected
+
+
+def test_write_once_globals():
+    asm = _generate('''
+SIZE = 2 * 4
+def area():
+    return SIZE * SIZE
+print(area())
+''')
+    assert _instrs(asm.funcs[0]) == [(Instr.LOAD_CONST, 64),
+                                     (Instr.RETN, None)]
+    assert vm_output('SIZE = 8\nif SIZE - 8:\n    print(1)\n') == ''
+
+
+@pytest.mark.parametrize('source', (
+    'a = 1\na = 2\nprint(a)',
+    "a = 1\nif 1 == 1:\n    a = 2\nprint(a)",
+))
+def test_reassigned_globals(source):
+    asm = _generate(source)
+    assert (Instr.LOAD_GLOBAL, 0) in _instrs(asm.toplevel)
+    assert vm_output(source) == '2\n'
+
+
+def test_host_globals_not_propagated():
+    symbols = parse(lex('a = 1\nprint(a)'))
+    asm = BytecodeAssemblyGenerator(symbols, host_globals=['a']).generate()
+    assert (Instr.LOAD_GLOBAL, 0) in _instrs(asm.toplevel)
+
+
+INLINE_PROGRAM = '''
+def test(a, b, c):
+    return a + b * c
+def clamp(x):
+    if x > 10:
+        return 10
+    return x
+def fact(n):
+    if n < 2:
+        return 1
+    return n * fact(n - 1)
+def f(x):
+    y = test(x, 2, 3) + clamp(x)
+    return y
+print(f(1))
+print(f(20))
+print(test(1, 2, 3) + test(4, 5, 6))
+print(fact(5))
+'''
+
+
+def test_inline():
+    gen = BytecodeAssemblyGenerator(parse(lex(INLINE_PROGRAM)),
+                                    specialize_max_clones=0)
+    asm = gen.generate()
+    # The right operand is generated first. f is too big once test and clamp
+    # are inlined into it, and fact is recursive.
+    assert gen.inlined == [
+        ('f', 'clamp', 13),
+        ('f', 'test', 13),
+        (None, 'test', 17),
+        (None, 'test', 17),
+    ]
+    assert [param for instr, param in _instrs(asm.toplevel)
+            if instr == Instr.CALL] == [3, 3, 2]
+    assert vm_output(INLINE_PROGRAM) == '8\n36\n41\n120\n'
+
+
+def test_inline_max_size():
+    # test and clamp are 9 instructions long
+    gen = BytecodeAssemblyGenerator(parse(lex(INLINE_PROGRAM)),
+                                    inline_max_size=8, specialize_max_clones=0)
+    gen.generate()
+    assert gen.inlined == []
+
+    assert vm_output(INLINE_PROGRAM, inline_max_size=0) == '8\n36\n41\n120\n'
+
+
+def test_inline_locals():
+    gen = BytecodeAssemblyGenerator(parse(lex('''
+def sq(x):
+    y = x * x
+    return y
+def f(x):
+    y = 1
+    return sq(x) + y
+print(f(3))
+''')), inline_max_size=12)
+    asm = gen.generate()
+    assert gen.inlined == [('f', 'sq', 7)]
+    # sq's x and y get their own slots in f's frame, after f's own
+    slots = set(param for instr, param in _instrs(asm.funcs[1])
+                if instr in (Instr.STORE_VAR, Instr.LOAD_LOCAL))
+    assert slots == set([0, 1, 2, 3])
+
+
+def test_inline_toplevel():
+    source = '''
+def sq(x):
+    y = x * x
+    return y
+print(sq(3))
+print(sq(4))
+'''
+    gen = BytecodeAssemblyGenerator(parse(lex(source)))
+    gen.generate()
+    # The toplevel has no frame, so sq's locals are kept in globals instead
+    assert gen.symbol_table()[1] == ['_<inline 0>.0', '_<inline 0>.1',
+                                     '_<inline 1>.0', '_<inline 1>.1']
+    assert vm_output(source) == '9\n16\n'
+
+
+SPECIALIZE_PROGRAM = '''
+def scale(mode, x):
+    if mode == 0:
+        return x
+    elif mode == 1:
+        return x * 2
+    return x * x
+print(scale(0, 5))
+print(scale(1, 5))
+print(scale(2, 5))
+print(scale(1, 6))
+'''
+
+
+def test_specialize():
+    gen = BytecodeAssemblyGenerator(parse(lex(SPECIALIZE_PROGRAM)),
+                                    inline_max_size=0)
+    asm = gen.generate()
+    assert gen.specialized == [
+        ('scale', '_<scale mode=0>', 8),
+        ('scale', '_<scale mode=1>', 9),
+        ('scale', '_<scale mode=2>', 10),
+        ('scale', '_<scale mode=1>', 11),
+    ]
+    # Only x is passed, and the conditions on mode are gone, leaving code
+    # after the return for the peephole optimizer to remove
+    optimize_body(asm.funcs[2])
+    assert _instrs(asm.funcs[2]) == [
+        (Instr.STORE_VAR, 0),
+        (Instr.LOAD_CONST, 2),
+        (Instr.LOAD_LOCAL, 0),
+        (Instr.MULT, None),
+        (Instr.RETN, None),
+    ]
+    assert [param for instr, param in _instrs(asm.toplevel)
+            if instr == Instr.CALL] == [1, 2, 3, 2]
+    assert vm_output(SPECIALIZE_PROGRAM) == '5\n10\n25\n12\n'
+
+
+def test_specialize_max_clones():
+    gen = BytecodeAssemblyGenerator(parse(lex(SPECIALIZE_PROGRAM)),
+                                    inline_max_size=0, specialize_max_clones=2)
+    asm = gen.generate()
+    assert [param for instr, param in _instrs(asm.toplevel)
+            if instr == Instr.CALL] == [1, 2, 0, 2]
+    assert vm_output(SPECIALIZE_PROGRAM, specialize_max_clones=0) == \
+        '5\n10\n25\n12\n'
+
+
+@pytest.mark.parametrize(('source', 'expected'), (
+    # A parameter assigned to isn't bound
+    ('''
+def f(a):
+    a = a + 1
+    if a == 1:
+        return 10
+    return 20
+print(f(0))
+''', '10\n'),
+    # Nor are calls passing constants no condition uses
+    ('''
+def f(a, b):
+    if b:
+        return a
+    return 0
+print(f(1, b))
+''', None),
+))
+def test_specialize_skipped(source, expected):
+    gen = BytecodeAssemblyGenerator(parse(lex('b = []\n' + source)))
+    gen.generate()
+    assert gen.specialized == []
+    if expected:
+        assert vm_output(source) == expected
+
+
+def test_specialize_recursive():
+    source = '''
+def fact(n):
+    if n < 2:
+        return 1
+    return n * fact(n - 1)
+print(fact(6))
+'''
+    gen = BytecodeAssemblyGenerator(parse(lex(source)), inline_max_size=0)
+    gen.generate()
+    # Each clone calls the next, until there are too many
+    assert [name for _, name, _ in gen.specialized] == [
+        '_<fact n=3>', '_<fact n=4>', '_<fact n=5>', '_<fact n=6>']
+    assert vm_output(source) == '720\n'
@@ -0,0 +1,75 @@
+from yaksh import cache
+from yaksh.linker import compile_module
+from yaksh.tests.utils import run_output, vm_bytecode
+from yaksh.vm import AbstractMachine
+
+
+SOURCE = '''
+def greet(name):
+    print('hello ' + name)
+greet('world')
+'''
+
+
+def _forbid_compile(monkeypatch):
+    def compile_source(source, function_cache=None):
+        raise AssertionError('Source was compiled, despite being cached')
+    monkeypatch.setattr(cache, 'compile_source', compile_source)
+
+
+def test_source_cache(tmpdir, monkeypatch):
+    path = tmpdir.join('greet.yk')
+    path.write(SOURCE)
+    cache_dir = str(tmpdir.join('cache'))
+
+    assert run_output(cache.load(str(path), cache_dir)) == 'hello world\n'
+    assert len(tmpdir.join('cache').listdir('*.ykc')) == 1
+
+    _forbid_compile(monkeypatch)
+    am = cache.load(str(path), cache_dir)
+    assert am._funcs[0] is not None
+    assert run_output(am) == 'hello world\n'
+
+
+def test_binary_cache(tmpdir):
+    path = tmpdir.join('greet.ysh')
+    bytecode = vm_bytecode(SOURCE)
+    path.write(bytecode, mode='wb')
+    cache_dir = str(tmpdir.join('cache'))
+
+    assert run_output(cache.load(str(path), cache_dir)) == 'hello world\n'
+    am = cache.load(str(path), cache_dir)
+    assert am.version is None
+    assert am.symbol_table() is None
+    assert am.line_for(0) == AbstractMachine(bytecode).line_for(0)
+    assert run_output(am) == 'hello world\n'
+
+
+def test_object_file_cache(tmpdir):
+    obj = compile_module("def greet(name):\n    print('hello ' + name)\n"
+                         "greet(who)")
+    path = tmpdir.join('greet.yko')
+    path.write(obj, mode='wb')
+    cache_dir = str(tmpdir.join('cache'))
+
+    symbols = AbstractMachine(obj).symbol_table()
+    assert symbols[0] == ['greet']
+    assert cache.load(str(path), cache_dir).symbol_table() == symbols
+    # Loaded from the cache
+    assert cache.load(str(path), cache_dir).symbol_table() == symbols
+
+
+def test_version_invalidates(tmpdir, monkeypatch):
+    path = tmpdir.join('greet.yk')
+    path.write(SOURCE)
+    cache_dir = str(tmpdir.join('cache'))
+    cache.load(str(path), cache_dir)
+
+    monkeypatch.setattr(cache, 'CACHE_VERSION', cache.CACHE_VERSION + 1)
+    compiled = []
+    real_compile = cache.compile_source
+    monkeypatch.setattr(cache, 'compile_source',
+                        lambda s, functions: (compiled.append(s) or
+                                              real_compile(s, functions)))
+    assert run_output(cache.load(str(path), cache_dir)) == 'hello world\n'
+    assert compiled == [SOURCE]
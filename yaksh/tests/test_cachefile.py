@@ -0,0 +1,24 @@
+from yaksh.cachefile import read_cache_file, write_cache_file, write_atomic
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join('entries', 'a.ykc'))
+    assert read_cache_file(path, 'YKT', 1) is None
+
+    value = {'funcs': ((1, 2), (3, None)), 'names': [u'f', 'g']}
+    write_cache_file(path, 'YKT', 1, value)
+    assert read_cache_file(path, 'YKT', 1) == value
+    entries = tmpdir.join('entries')
+    assert entries.listdir() == [entries.join('a.ykc')]
+
+
+def test_stale_and_corrupt(tmpdir):
+    path = str(tmpdir.join('a.ykc'))
+    write_cache_file(path, 'YKT', 1, [1, 2, 3])
+    assert read_cache_file(path, 'YKT', 2) is None
+    assert read_cache_file(path, 'YKU', 1) is None
+
+    data = open(path, 'rb').read()
+    for corrupt in (data[:2], data[:4] + 'garbage'):
+        write_atomic(path, corrupt)
+        assert read_cache_file(path, 'YKT', 1) is None
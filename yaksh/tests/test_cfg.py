@@ -0,0 +1,75 @@
+from yaksh.bytecode_compiler import load_assembly
+from yaksh.cfg import (ControlFlowGraph, dominators, liveness,
+                       reaching_definitions, solve)
+
+
+# An if/else, then a loop
+BODY = '''
+STORE_VAR 0
+LOAD_LOCAL 0
+JZ else
+LOAD_CONST 1
+STORE_VAR 1
+JMP loop
+else: LOAD_CONST 2
+STORE_VAR 1
+loop: LOAD_LOCAL 1
+JZ out
+LOAD_LOCAL 1
+STORE_VAR 2
+JMP loop
+out: LOAD_LOCAL 0
+RETN
+'''
+
+
+def _cfg(asm=BODY):
+    return ControlFlowGraph(load_assembly(asm).toplevel)
+
+
+def test_blocks():
+    cfg = _cfg()
+    assert [(b.start, b.end) for b in cfg.blocks] == [
+        (0, 3), (3, 6), (6, 8), (8, 10), (10, 13), (13, 15)]
+    assert [b.succs for b in cfg.blocks] == [
+        [1, 2], [3], [3], [4, 5], [3], []]
+    assert [b.preds for b in cfg.blocks] == [
+        [], [0], [0], [1, 2, 4], [3], [3]]
+    assert cfg.block_of(9).index == 3
+    assert cfg.exits == [cfg.blocks[5]]
+
+
+def test_dominators():
+    doms = dominators(_cfg())
+    assert doms == [set([0]), set([0, 1]), set([0, 2]), set([0, 3]),
+                    set([0, 3, 4]), set([0, 3, 5])]
+
+
+def test_liveness():
+    live_in, live_out = liveness(_cfg())
+    assert live_in == [set(), set([0]), set([0]), set([0, 1]), set([0, 1]),
+                       set([0])]
+    assert live_out[4] == set([0, 1])
+    # Slot 2 is stored, but never loaded
+    assert not any(2 in live for live in live_out)
+
+
+def test_reaching_definitions():
+    reach_in, reach_out = reaching_definitions(_cfg())
+    assert reach_in[3] == set([0, 4, 7, 11])
+    assert reach_out[1] == set([0, 4])
+    assert reach_in[5] == set([0, 4, 7, 11])
+
+
+def test_solve_backward_without_exits():
+    cfg = _cfg('a: LOAD_LOCAL 0\nJMP a\n')
+    ins, outs = solve(cfg, lambda block, v: v | set([block.index]),
+                      lambda values: frozenset().union(*values),
+                      frozenset(), frozenset(), forward=False)
+    assert ins == [set([0])]
+
+
+def test_empty_body():
+    cfg = ControlFlowGraph([])
+    assert cfg.blocks == []
+    assert liveness(cfg) == ([], [])
@@ -0,0 +1,155 @@
+import sys
+
+from yaksh import cost
+from yaksh.bytecode_compiler import Instr, assemble, load_assembly
+from yaksh.cost import TIMINGS, Cost, calibrate, estimate
+from yaksh.tests.utils import capture_stdout, vm_bytecode
+
+
+def test_straight_line():
+    asm = load_assembly('LOAD_CONST 1\nLOAD_CONST 2\nADD\nSTORE_GLOBAL 0')
+    assert estimate(asm) == ([], Cost(4, 4))
+    assert estimate(asm)[1].exact
+
+
+def test_branches():
+    asm = load_assembly('''
+LOAD_GLOBAL 0
+JZ else
+LOAD_CONST 1
+LOAD_CONST 2
+ADD
+JMP end
+else: LOAD_CONST 3
+end: STORE_GLOBAL 1
+''')
+    # Through the else, or the dearer if
+    assert estimate(asm)[1] == Cost(4, 7)
+
+
+def test_calls():
+    asm = load_assembly('''
+PROC
+STORE_VAR 0
+LOAD_LOCAL 0
+JZ zero
+LOAD_CONST 1
+RETN
+zero: LOAD_CONST 0
+RETN
+MAKE_FUNCTION
+LOAD_CONST 5
+CALL 0
+CALL 0
+''')
+    funcs, toplevel = estimate(asm)
+    assert funcs == [Cost(5, 5)]
+    assert toplevel == Cost(13, 13)
+
+
+def test_recursion():
+    bytecode = vm_bytecode('''
+def fact(n):
+    if n < 2:
+        return 1
+    return n * fact(n - 1)
+def double(x):
+    return x + x
+print(fact(double(3)))
+''', inline_max_size=0, specialize_max_clones=0)
+    funcs, toplevel = estimate(bytecode)
+    fact, double = funcs
+    assert fact.recursive and fact.max is None
+    # The path returning at once
+    assert 0 < fact.min < toplevel.min
+    # DUP, ADD_NUM, RETN
+    assert double == Cost(3, 3)
+    assert toplevel.recursive and toplevel.max is None
+
+
+def test_mutual_recursion():
+    asm = load_assembly('''
+PROC
+CALL 1
+MAKE_FUNCTION
+PROC
+LOAD_GLOBAL 0
+JZ out
+CALL 0
+out: PASS
+MAKE_FUNCTION
+PROC
+LOAD_CONST 1
+MAKE_FUNCTION
+CALL 2
+''')
+    funcs, toplevel = estimate(asm)
+    assert funcs[0] == Cost(4, None, True)
+    assert funcs[1] == Cost(3, None, True)
+    assert funcs[2] == Cost(1, 1)
+    assert toplevel == Cost(2, 2)
+
+
+NEVER_RETURNS = '''
+def f(a):
+    return f(a)
+def g(a):
+    if a:
+        return f(a)
+    return 1
+print(g(0))
+f(1)
+'''
+
+
+def test_never_returns():
+    bytecode = vm_bytecode(NEVER_RETURNS, inline_max_size=0,
+                           specialize_max_clones=0)
+    (f, g), toplevel = estimate(bytecode)
+    assert f == Cost(None, None, True)
+    assert not f.returns and not f.exact
+    assert repr(f) == '<Cost never returns recursive>'
+    # Only one of its paths calls f
+    assert g.returns and g.max is None
+    # The toplevel always calls f
+    assert toplevel == Cost(None, None, True)
+    assert not estimate(bytecode, TIMINGS)[1].returns
+
+
+def test_main_never_returns(tmpdir, monkeypatch):
+    path = tmpdir.join('never.ysh')
+    path.write(vm_bytecode(NEVER_RETURNS, inline_max_size=0,
+                           specialize_max_clones=0), mode='wb')
+    monkeypatch.setattr(sys, 'argv', ['yaksh.cost', str(path)])
+    with capture_stdout() as output:
+        cost.main()
+    rows = output.getvalue().splitlines()
+    assert rows[1].split() == ['function', '0', '(recursive)'] + [
+        'unbounded'] * 4
+    assert rows[2].split()[3:] == ['5', 'unbounded', '5.5', 'unbounded']
+    assert rows[3].split()[1:] == ['(recursive)'] + ['unbounded'] * 4
+
+
+def test_loop_unbounded():
+    asm = load_assembly('top: LOAD_CONST 1\nJNZ top')
+    assert estimate(asm)[1] == Cost(2, None)
+
+
+def test_binary_matches_assembly():
+    asm = ('PROC\nLOAD_CONST 1\nMAKE_FUNCTION\nLOAD_GLOBAL 0\nJZ end\n'
+           'CALL 0\nend: PASS')
+    assert estimate(assemble(asm)) == estimate(load_assembly(asm))
+
+
+def test_weights():
+    asm = load_assembly('LOAD_CONST 1\nLOAD_CONST 2\nADD\nPOP')
+    weights = {Instr.LOAD_CONST: 1, Instr.ADD: 5, Instr.POP: 2}
+    assert estimate(asm, weights)[1] == Cost(9, 9)
+    low = estimate(asm, TIMINGS)[1].min
+    assert 1e-6 < low < 1e-5
+
+
+def test_calibrate():
+    timings = calibrate(reps=50, repeat=1)
+    assert set(timings) == set(TIMINGS)
+    assert all(t >= 0 for t in timings.itervalues())
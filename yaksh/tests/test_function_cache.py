@@ -0,0 +1,201 @@
+from yaksh import cache
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import assemble
+from yaksh.function_cache import FunctionCache, LazyFdef, split_source
+from yaksh.lexer import lex
+from yaksh.optimizer import optimize
+from yaksh.parser import parse
+from yaksh.tests.utils import capture_stdout, run_output
+from yaksh.vm import AbstractMachine
+
+
+PROGRAM = '''
+limit = 10
+
+def double(x):
+    return x + x
+
+def clamp(n, top):
+    if n > top:
+        return top
+    return n
+
+def report(n):
+    print(clamp(double(n), limit))
+
+report(3)
+report(clamp(8, 4))
+'''
+
+
+def _compile(source, functions):
+    before = functions.hits, functions.misses
+    bytecode = cache.compile_source(source, functions)
+    return (bytecode, functions.hits - before[0],
+            functions.misses - before[1])
+
+
+def test_split_source():
+    symbols = split_source(PROGRAM)
+    assert [symbol.name for symbol in symbols] == [
+        'assign', 'fdef', 'fdef', 'fdef', 'fcall', 'fcall']
+    assert [symbol.func_name for symbol in symbols
+            if isinstance(symbol, LazyFdef)] == ['double', 'clamp', 'report']
+
+    def tokens(symbols):
+        return [[(t.type, t.text, t.line_no) for t in symbol.tokens()]
+                for symbol in symbols]
+    assert tokens(symbol.symbol if isinstance(symbol, LazyFdef) else symbol
+                  for symbol in symbols) == tokens(parse(lex(PROGRAM)))
+
+
+def test_cold_compile():
+    functions = FunctionCache()
+    bytecode, hits, misses = _compile(PROGRAM, functions)
+    assert (hits, misses) == (0, 3)
+    assert bytecode == cache.compile_source(PROGRAM)
+    assert run_output(bytecode) == '6\n8\n'
+
+
+def test_rebuild():
+    functions = FunctionCache()
+    _compile(PROGRAM, functions)
+
+    bytecode, hits, misses = _compile(PROGRAM, functions)
+    assert (hits, misses) == (3, 0)
+    assert bytecode == cache.compile_source(PROGRAM)
+
+    # Only the function changed is generated again
+    changed = PROGRAM.replace('print(clamp(double(n), limit))',
+                              'print(clamp(double(n), limit) + 1)')
+    bytecode, hits, misses = _compile(changed, functions)
+    assert (hits, misses) == (2, 1)
+    assert bytecode == cache.compile_source(changed)
+    assert run_output(bytecode) == '7\n9\n'
+
+
+def test_inlined_body_changed():
+    functions = FunctionCache()
+    _compile(PROGRAM, functions)
+
+    # report inlines double, so is generated again with its new body
+    changed = PROGRAM.replace('return x + x', 'return x * 2 + 1')
+    bytecode, hits, misses = _compile(changed, functions)
+    assert (hits, misses) == (1, 2)
+    assert bytecode == cache.compile_source(changed)
+    assert run_output(bytecode) == '7\n9\n'
+
+
+def test_global_const_changed():
+    functions = FunctionCache()
+    _compile(PROGRAM, functions)
+
+    # report loads limit as a constant
+    changed = PROGRAM.replace('limit = 10', 'limit = 5')
+    bytecode, hits, misses = _compile(changed, functions)
+    assert (hits, misses) == (2, 1)
+    assert run_output(bytecode) == '5\n5\n'
+
+
+def test_moved():
+    functions = FunctionCache()
+    _compile(PROGRAM, functions)
+
+    moved = '\n\n\nprint(1)\n' + PROGRAM
+    bytecode, hits, misses = _compile(moved, functions)
+    assert (hits, misses) == (3, 0)
+    assert bytecode == cache.compile_source(moved)
+    # Lines are where the functions are now
+    assert (AbstractMachine(bytecode).decode_all()[3] ==
+            AbstractMachine(cache.compile_source(moved)).decode_all()[3])
+
+
+def test_specialized_clones_replayed():
+    functions = FunctionCache()
+    gen_options = dict(function_cache=functions, inline_max_size=0)
+    specialized = []
+    for _ in xrange(2):
+        gen = BytecodeAssemblyGenerator(split_source(PROGRAM), **gen_options)
+        asm = gen.generate()
+        specialized.append(gen.specialized)
+    assert functions.hits == 3
+    assert specialized[0] == specialized[1]
+    assert specialized[0][0][:2] == ('clamp', '_<clamp top=10>')
+
+    optimize(asm)
+    expected = BytecodeAssemblyGenerator(parse(lex(PROGRAM)),
+                                         inline_max_size=0).generate()
+    optimize(expected)
+    assert assemble(asm) == assemble(expected)
+
+
+def test_module_imports():
+    source = 'def a():\n    return b()\ndef b():\n    return 1\n'
+    functions = FunctionCache()
+    objects = []
+    for _ in xrange(2):
+        gen = BytecodeAssemblyGenerator(split_source(source), module=True,
+                                        function_cache=functions)
+        asm = gen.generate()
+        optimize(asm, whole_program=False)
+        objects.append((assemble(asm), gen.symbol_table()))
+    assert functions.hits == 2
+    assert objects[0] == objects[1]
+
+    asm = BytecodeAssemblyGenerator(parse(lex(source)), module=True).generate()
+    optimize(asm, whole_program=False)
+    assert objects[0][0] == assemble(asm)
+
+
+def test_on_disk(tmpdir):
+    cache_dir = str(tmpdir.join('functions'))
+    _compile(PROGRAM, FunctionCache(cache_dir))
+    assert len(tmpdir.join('functions').listdir('*.func.ykc')) == 3
+
+    functions = FunctionCache(cache_dir)
+    bytecode, hits, misses = _compile(PROGRAM, functions)
+    assert (hits, misses) == (3, 0)
+    assert bytecode == cache.compile_source(PROGRAM)
+
+
+def test_corrupt_entry(tmpdir):
+    cache_dir = tmpdir.join('functions')
+    _compile(PROGRAM, FunctionCache(str(cache_dir)))
+    for path in cache_dir.listdir():
+        path.write('garbage', mode='wb')
+
+    bytecode, hits, misses = _compile(PROGRAM, FunctionCache(str(cache_dir)))
+    assert (hits, misses) == (0, 3)
+    assert run_output(bytecode) == '6\n8\n'
+
+
+def test_stats():
+    functions = FunctionCache()
+    assert functions.hit_rate == 0.0
+    _compile(PROGRAM, functions)
+    _compile(PROGRAM, functions)
+    assert functions.hit_rate == 0.5
+    assert str(functions) == '3 of 6 functions reused (50.0%)'
+
+
+def test_load_reuses_functions(tmpdir, monkeypatch):
+    path = tmpdir.join('program.yk')
+    path.write(PROGRAM)
+    cache_dir = str(tmpdir.join('cache'))
+    cache.load(str(path), cache_dir)
+
+    path.write(PROGRAM.replace('report(3)', 'report(4)'))
+    compiled = []
+    real_compile = cache.compile_source
+
+    def compile_source(source, functions):
+        bytecode = real_compile(source, functions)
+        compiled.append((functions.hits, functions.misses))
+        return bytecode
+
+    monkeypatch.setattr(cache, 'compile_source', compile_source)
+    am = cache.load(str(path), cache_dir)
+    assert compiled == [(3, 0)]
+    with capture_stdout() as output:
+        am.run()
+    assert output.getvalue() == '8\n8\n'
@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+from yaksh import TEST_PROGRAM
+from yaksh.lexer import lex, lex_fast
+
+
+CORPUS = (
+    '',
+    '\n\n',
+    TEST_PROGRAM,
+    'def f(a, b):\n    if a >= b:\n        return a\n    return b\nf(1, 2)',
+    "print('it\\'s', \"a \\\"b\\\" \\n\")",
+    # Reserved words, and names merely starting with them
+    'if elif else def return for in is pass iffy define',
+    # Numbers, and dots which aren't part of them
+    '1.2.3 1. .5 a.5 0x1f 12ab_c 3.x',
+    # A word alone on a line before any other token is dropped
+    'x\ny',
+    'x\n',
+    '  pass\n\nx = 1\n',
+    # A word running into a comparison or a literal is taken into it
+    'a==b 1>=2 c!=d e<=f',
+    "abc'x' y 1'2'",
+    # Indentation, blank lines, and whitespace at the end
+    'if 1:\n\tx = 1\n  \n    \ty = 2\n',
+    'a\n   ',
+    'a\n  \n  b',
+    "if 1:\n    'x'\n",
+    # Lines aren't counted within literals
+    "'a\nb' c\nd",
+    # A backslash only escapes a quote
+    "'a\\\\' b' 'c\\d'",
+    # Anything else is unknown
+    '# comment\nx\r\ny @ $\xe9',
+    u'x = 1\ny = x',
+    u'\xe9x = 1',
+)
+
+ERRORS = (
+    'a!b',
+    "'abc",
+    "'abc\\'",
+    "x\n  'a",
+    'x = "a',
+)
+
+
+def _tokens(f, source):
+    try:
+        return [(t.type, t.text, t.line_no, t.char_no) for t in f(source)]
+    except (SyntaxError, ValueError) as e:
+        return type(e), str(e)
+
+
+@pytest.mark.parametrize('source', CORPUS + ERRORS)
+def test_same_tokens(source):
+    assert _tokens(lex_fast, source) == _tokens(lex, source)
+
+
+def test_errors():
+    for source in ERRORS:
+        assert isinstance(_tokens(lex_fast, source), tuple)
+
+
+def test_random_sources():
+    rng = random.Random(0)
+    alphabet = list('ab_19.0x=<>!\'"\\\n\t #(),:') + [
+        'if', 'def', '  ', '\n    ', '==']
+    for _ in xrange(5000):
+        source = ''.join(rng.choice(alphabet)
+                         for _ in xrange(rng.randint(0, 16)))
+        assert _tokens(lex_fast, source) == _tokens(lex, source), source
@@ -0,0 +1,146 @@
+import os
+
+import pytest
+
+from yaksh import linker
+from yaksh.bytecode_compiler import Instr
+from yaksh.linker import build, compile_module, generate_module, link
+from yaksh.tests.utils import capture_stdout, run_output
+from yaksh.vm import AbstractMachine
+
+
+UTIL = '''
+def _double(x):
+    return x * 2
+def greet(name):
+    print(greeting + name)
+def quadruple(x):
+    return _double(_double(x))
+greeting = 'hello '
+'''
+
+MAIN = '''
+def _double(x):
+    return x + x + 1
+greet('world')
+print(quadruple(3))
+print(_double(3))
+greeting = 'bye '
+greet('world')
+'''
+
+
+def test_link():
+    bytecode = link([compile_module(UTIL), compile_module(MAIN)])
+    assert run_output(bytecode) == 'hello world\n12\n7\nbye world\n'
+
+
+def test_object_file():
+    am = AbstractMachine(compile_module(MAIN))
+    func_names, global_names = am.symbol_table()
+    assert func_names == ['_double', 'greet', 'quadruple']
+    # _double(3) is inlined at the toplevel, its parameter kept in a global
+    # private to the module
+    assert global_names == ['_<inline 0>.0', 'greeting']
+    assert len(am.decode_all()[1]) == 1
+    assert AbstractMachine(link([compile_module(UTIL)])).symbol_table() is None
+
+
+def test_generate_module_without_types():
+    source = ('def area(x):\n    n = len(x)\n    return n * n\n'
+              "print(area('ab'))")
+
+    def opcodes(obj):
+        _, funcs, _, _ = AbstractMachine(obj).decode_all()
+        return [instr for instr, _ in funcs[0]]
+
+    assert Instr.MULT_NUM in opcodes(generate_module(source)[0])
+    untyped = generate_module(source, infer_types=False)[0]
+    assert Instr.MULT in opcodes(untyped)
+    assert Instr.MULT_NUM not in opcodes(untyped)
+    assert run_output(link([untyped])) == '4\n'
+
+
+def test_link_constants():
+    a = compile_module("print('shared')\nprint(1)")
+    b = compile_module("print(1.0)\nprint('shared')")
+    am = AbstractMachine(link([a, b]))
+    assert am.decode_all()[0] == ['shared', 1, 1.0]
+
+
+def test_link_forward_and_recursive_calls():
+    bytecode = link([compile_module('''
+def countdown(n):
+    if n:
+        print(n)
+        countdown(n - 1)
+def start():
+    countdown(later())
+def later():
+    return 2
+start()
+''')])
+    assert run_output(bytecode) == '2\n1\n'
+
+
+def test_link_toplevel_jumps():
+    first = compile_module('''
+x = 0
+if x:
+    print('skipped')
+''')
+    second = compile_module("print('second')")
+    assert run_output(link([first, second])) == 'second\n'
+
+
+def test_link_host_globals():
+    bytecode = link([compile_module('print(column)')],
+                    host_globals=('column',))
+    with capture_stdout() as output:
+        AbstractMachine(bytecode).run(globals={0: 42})
+    assert output.getvalue() == '42\n'
+
+
+def test_link_errors():
+    with pytest.raises(NameError):
+        link([compile_module('missing()')])
+    with pytest.raises(NameError):
+        link([compile_module(UTIL), compile_module('_double(1)')])
+    with pytest.raises(ValueError):
+        link([compile_module(UTIL), compile_module(UTIL)])
+    with pytest.raises(ValueError):
+        link([compile_module(UTIL)[:-1]])
+
+
+def _write_modules(tmpdir):
+    paths = []
+    for name, source in (('util.yk', UTIL), ('main.yk', MAIN)):
+        path = tmpdir.join(name)
+        path.write(source)
+        paths.append(str(path))
+    return paths
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_build(tmpdir, jobs):
+    paths = _write_modules(tmpdir)
+    build_dir = str(tmpdir.join('build'))
+
+    bytecode, recompiled = build(paths, build_dir, jobs)
+    assert recompiled == paths
+    assert run_output(bytecode) == 'hello world\n12\n7\nbye world\n'
+
+    assert build(paths, build_dir, jobs) == (bytecode, [])
+
+    tmpdir.join('util.yk').write(UTIL.replace('hello', 'hi'))
+    stat = os.stat(paths[0])
+    os.utime(paths[0], (stat.st_atime, stat.st_mtime + 10))
+    bytecode, recompiled = build(paths, build_dir, jobs)
+    assert recompiled == paths[:1]
+    assert run_output(bytecode) == 'hi world\n12\n7\nbye world\n'
+
+
+def test_build_object_paths(tmpdir):
+    build_dir = str(tmpdir.join('build'))
+    assert (linker.object_path(build_dir, 'a/util.yk') !=
+            linker.object_path(build_dir, 'b/util.yk'))
@@ -0,0 +1,241 @@
+import pytest
+
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import Instr, load_assembly
+from yaksh.lexer import lex
+from yaksh.optimizer import compact_locals, cse, dead_stores, optimize
+from yaksh.parser import parse
+from yaksh.tests.utils import vm_output
+
+
+def _body(asm):
+    return load_assembly(asm).toplevel
+
+
+def _instrs(body):
+    return [(instr.instr, instr.param) for instr in body]
+
+
+def test_dead_stores():
+    body = _body('''
+LOAD_CONST 1
+STORE_VAR 0
+CALL 0
+STORE_VAR 1
+LOAD_CONST 2
+STORE_VAR 0
+LOAD_LOCAL 0
+RETN
+''')
+    assert dead_stores(body) == 2
+    # The call's result is still popped
+    assert _instrs(body) == [
+        (Instr.CALL, 0),
+        (Instr.POP, None),
+        (Instr.LOAD_CONST, 2),
+        (Instr.STORE_VAR, 0),
+        (Instr.LOAD_LOCAL, 0),
+        (Instr.RETN, None),
+    ]
+
+
+def test_dead_stores_in_branches():
+    body = _body('''
+LOAD_CONST 1
+STORE_VAR 0
+LOAD_GLOBAL 0
+JZ skip
+LOAD_CONST 2
+STORE_VAR 0
+skip: LOAD_LOCAL 0
+RETN
+''')
+    assert dead_stores(body) == 0
+
+
+def test_dead_stores_at_end():
+    body = _body('LOAD_CONST 1\nSTORE_VAR 0\nLOAD_CONST 2\nSTORE_VAR 1')
+    assert dead_stores(body) == 2
+    assert body == []
+
+    # A label at the end stays, on a PASS
+    body = _body('LOAD_GLOBAL 0\nJZ end\nCALL 0\nPOP\n'
+                 'end: LOAD_CONST 1\nSTORE_VAR 0')
+    assert dead_stores(body) == 1
+    assert _instrs(body)[-1] == (Instr.PASS, None)
+    assert body[-1].labels == ['end']
+
+    source = 'def f():\n    x = 1'
+    asm = BytecodeAssemblyGenerator(parse(lex(source))).generate()
+    optimize(asm)
+    assert Instr.POP not in [instruction.instr for instruction in asm.funcs[0]]
+
+
+def test_compact_locals():
+    body = _body('''
+STORE_VAR 0
+LOAD_LOCAL 0
+STORE_VAR 1
+LOAD_LOCAL 1
+STORE_VAR 2
+LOAD_LOCAL 2
+LOAD_LOCAL 0
+RETN
+''')
+    assert compact_locals(body) == 1
+    assert [i.param for i in body] == [0, 0, 1, 1, 1, 1, 0, None]
+
+
+def test_compact_locals_read_before_store():
+    # Slot 1 is loaded before anything is stored in it, so mustn't share 0
+    body = _body('''
+LOAD_CONST 1
+STORE_VAR 0
+LOAD_LOCAL 0
+LOAD_LOCAL 1
+RETN
+''')
+    assert compact_locals(body) == 0
+
+
+def test_cse():
+    body = _body('''
+LOAD_LOCAL 1
+LOAD_LOCAL 0
+MULT
+CALL_BUILTIN 0
+LOAD_LOCAL 1
+LOAD_LOCAL 0
+MULT
+LOAD_CONST 1
+ADD
+RETN
+''')
+    # CALL_BUILTIN is a barrier
+    assert cse(body, mutable_containers=False) == 0
+
+    body = _body('''
+LOAD_LOCAL 1
+LOAD_LOCAL 0
+MULT
+LOAD_LOCAL 1
+LOAD_LOCAL 0
+MULT
+ADD
+LOAD_LOCAL 1
+LOAD_LOCAL 0
+MULT
+ADD
+RETN
+''')
+    assert cse(body, mutable_containers=False) == 2
+    assert _instrs(body) == [
+        (Instr.LOAD_LOCAL, 1),
+        (Instr.LOAD_LOCAL, 0),
+        (Instr.MULT, None),
+        (Instr.DUP, None),
+        (Instr.STORE_VAR, 2),
+        (Instr.LOAD_LOCAL, 2),
+        (Instr.ADD, None),
+        (Instr.LOAD_LOCAL, 2),
+        (Instr.ADD, None),
+        (Instr.RETN, None),
+    ]
+
+
+@pytest.mark.parametrize(('asm', 'mutable_containers', 'eliminated'), (
+    # a is stored between the two
+    ('LOAD_LOCAL 0\nLEN\nSTORE_VAR 0\nLOAD_LOCAL 0\nLEN\n', True, 0),
+    # Keeping a single repeat of `a LEN` would cost more than it saves
+    ('LOAD_LOCAL 0\nLEN\nLOAD_LOCAL 0\nLEN\nADD\n', True, 0),
+    ('LOAD_LOCAL 0\nLEN\nLOAD_LOCAL 0\nLEN\nADD\nLOAD_LOCAL 0\nLEN\n',
+     True, 2),
+    # Might be a list, so sharing it might be seen
+    ('LOAD_LOCAL 0\nDUP\nADD\nLOAD_LOCAL 0\nDUP\nADD\n', True, 0),
+    ('LOAD_LOCAL 0\nLOAD_LOCAL 0\nADD\nLOAD_LOCAL 0\nLOAD_LOCAL 0\nADD\n',
+     False, 1),
+    # The index might be stored into in between
+    ('LOAD_CONST 0\nLOAD_LOCAL 0\nLOAD_INDEX\nLOAD_CONST 1\nLOAD_CONST 0\n'
+     'LOAD_LOCAL 1\nSTORE_INDEX\nLOAD_CONST 0\nLOAD_LOCAL 0\nLOAD_INDEX\n',
+     True, 0),
+    ('LOAD_CONST 0\nLOAD_LOCAL 0\nLOAD_INDEX\nLOAD_CONST 0\nLOAD_LOCAL 0\n'
+     'LOAD_INDEX\n', True, 1),
+))
+def test_cse_invalidation(asm, mutable_containers, eliminated):
+    body = _body(asm)
+    assert cse(body, mutable_containers) == eliminated
+
+
+def test_cse_containers_stored_into():
+    source = '''
+def f(l):
+    a = l + l
+    b = l + l
+    a[0] = 5
+    print(b)
+f([1])
+'''
+    asm = BytecodeAssemblyGenerator(parse(lex(source))).generate()
+    assert optimize(asm).counts['cse'] == 0
+    assert vm_output(source) == '[1, 1]\n'
+
+
+def test_optimize_function():
+    asm = BytecodeAssemblyGenerator(parse(lex('''
+def f(a, unused):
+    b = a * 2
+    c = b + 1
+    d = 5
+    return c
+print(f(1, 2))
+'''))).generate()
+    report = optimize(asm)
+    # unused, d, then c once `c = b + 1; return c` is a DUP
+    assert report.counts['dead_stores'] == 3
+    assert report.counts['compact_locals'] == 2
+    slots = set(i.param for i in asm.funcs[0]
+                if i.instr in (Instr.STORE_VAR, Instr.LOAD_LOCAL))
+    assert slots == set([0])
+
+
+@pytest.mark.parametrize(('source', 'expected'), (
+    ('''
+def f(a, b):
+    c = a + b
+    d = c * 2
+    e = d - a
+    return e + c
+print(f(3, 4))
+''', '18'),
+    ('''
+def pick(a, b):
+    if a > b:
+        m = a
+    else:
+        m = b
+    n = m * 2
+    return n
+print(pick(3, 9))
+print(pick(9, 3))
+''', '18\n18'),
+    ('''
+def noisy(x):
+    print(x)
+    return x
+def f(a):
+    unused = noisy(a)
+    return 0
+print(f(7))
+''', '7\n0'),
+    ('''
+def f(a, b):
+    c = a * b + 1
+    d = a * b - 2
+    if a * b > c:
+        print(a * b)
+    return (a * b) + (a * b) + c + d
+print(f(3, 4))
+''', '47'),
+))
+def test_optimized_output(source, expected):
+    assert vm_output(source).strip() == expected
@@ -0,0 +1,120 @@
+import pytest
+
+from yaksh.parallel import compile_parallel, split_pieces
+from yaksh.tests.utils import (capture_stdout, run_output, vm_bytecode,
+                               vm_output)
+from yaksh.typeinfer import SPECIALIZED
+from yaksh.vm import AbstractMachine
+
+
+PROGRAM = '''
+_scale = 3
+total = 0
+
+def scale(x):
+    return x * _scale
+
+def add(x):
+    return scale(x) + total
+
+total = add(1)
+print(total)
+
+def report(label):
+    print(label)
+
+print(add(total))
+'''
+
+
+def test_split_pieces():
+    pieces = split_pieces(PROGRAM)
+    assert [piece.split('\n', 1)[0] for piece, _ in pieces] == [
+        '', 'def scale(x):', 'def add(x):', 'def report(label):']
+    assert [line_no for _, line_no in pieces] == [0, 4, 7, 13]
+    assert ''.join(piece for piece, _ in pieces) == PROGRAM
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_compile_parallel(jobs):
+    bytecode = compile_parallel(PROGRAM, jobs)
+    assert run_output(bytecode) == vm_output(PROGRAM) == '3\n12\n'
+
+
+def test_deterministic():
+    assert compile_parallel(PROGRAM, 1) == compile_parallel(PROGRAM, 2)
+
+
+def test_lines():
+    source = ('def f(x):\n    return x\n\n'
+              'def g(x):\n    return x / 0\nf(g(1))\n')
+    with pytest.raises(ZeroDivisionError) as excinfo:
+        AbstractMachine(compile_parallel(source, 1)).run()
+    assert '(line 5)' in str(excinfo.value)
+
+
+TYPED_PROGRAM = '''
+def double(a):
+    return a * 2
+
+def greet(name):
+    return 'hi ' + name
+
+x = double(3)
+print(x + 1)
+print(greet('bob'))
+'''
+
+
+def _specialized(bytecode):
+    """Number of instructions type inference specialized"""
+    _, funcs, toplevel, _ = AbstractMachine(bytecode).decode_all()
+    specialized = set(SPECIALIZED.itervalues())
+    return sum(instr in specialized
+               for code in funcs + [toplevel] for instr, _ in code)
+
+
+@pytest.mark.parametrize('source', (PROGRAM, TYPED_PROGRAM))
+def test_same_as_serial(source):
+    assert run_output(compile_parallel(source, 2)) == vm_output(source)
+
+
+def test_types_inferred_across_pieces():
+    bytecode = compile_parallel(TYPED_PROGRAM, 2)
+    assert _specialized(bytecode) == _specialized(vm_bytecode(TYPED_PROGRAM))
+    assert _specialized(bytecode) == 3
+
+
+def _error(compile):
+    try:
+        compile()
+    except Exception as e:
+        return type(e), str(e)
+
+
+@pytest.mark.parametrize('source', (
+    'def f():\n    return g() + 1\ndef g():\n    return 1\nprint(f())',
+    'print(g())\ndef g():\n    return 1\n',
+    'def f():\n    return y\ny = 1\nprint(f())\n',
+    'print(y)\ny = 1\ndef f():\n    return 1\n',
+    'def f():\n    return 1\nprint(g())\n',
+))
+def test_forward_references(source):
+    error = _error(lambda: compile_parallel(source, 1))
+    assert error is not None
+    assert error == _error(lambda: vm_bytecode(source))
+
+
+def test_redefined_compiles_serially():
+    source = ('def f():\n    return 1\nprint(f())\n'
+              'def f():\n    return 2\nprint(f())\n')
+    assert run_output(compile_parallel(source, 2)) == vm_output(source)
+    assert vm_output(source) == '1\n2\n'
+
+
+def test_host_globals():
+    source = 'def f():\n    return x + 1\nprint(f())'
+    bytecode = compile_parallel(source, 1, host_globals=['x'])
+    with capture_stdout() as output:
+        AbstractMachine(bytecode).run(globals={0: 41})
+    assert output.getvalue() == '42\n'
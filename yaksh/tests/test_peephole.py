@@ -0,0 +1,135 @@
+import pytest
+
+from yaksh.bytecode_compiler import Instr, load_assembly
+from yaksh.peephole import optimize, optimize_body
+from yaksh.tests.utils import vm_output
+
+
+def _optimized(asm):
+    asm = load_assembly(asm)
+    report = optimize(asm)
+    return str(asm), report.counts
+
+
+def test_dead_code():
+    asm, counts = _optimized('''
+PROC
+LOAD_CONST 1
+RETN
+LOAD_CONST 2
+RETN
+MAKE_FUNCTION
+CALL 0
+''')
+    assert asm == 'PROC\nLOAD_CONST 1\nRETN\nMAKE_FUNCTION\n\nCALL 0\n'
+    assert counts['dead_code'] == 2
+
+
+def test_thread_jumps():
+    asm, counts = _optimized('''
+LOAD_GLOBAL 0
+JZ a
+LOAD_CONST 1
+CALL_BUILTIN 0
+a: JMP b
+LOAD_CONST 2
+b: LOAD_CONST 3
+CALL_BUILTIN 0
+''')
+    assert asm == ('LOAD_GLOBAL 0\nJZ b\nLOAD_CONST 1\nCALL_BUILTIN 0\n'
+                   'b: LOAD_CONST 3\nCALL_BUILTIN 0\n')
+    assert counts['thread_jumps'] == 1
+    assert counts['jump_to_next'] == 1
+    assert counts['dead_code'] == 1
+
+
+def test_jump_to_retn():
+    asm, counts = _optimized('''
+PROC
+JZ a
+LOAD_CONST 1
+JMP out
+a: LOAD_CONST 2
+out: RETN
+MAKE_FUNCTION
+''')
+    assert asm == ('PROC\nJZ a\nLOAD_CONST 1\nRETN\na: LOAD_CONST 2\nRETN\n'
+                   'MAKE_FUNCTION\n\n')
+    assert counts['thread_jumps'] == 1
+
+
+def test_passes():
+    asm, counts = _optimized('''
+LOAD_GLOBAL 0
+JZ out
+JMP a
+a: PASS
+LOAD_CONST 1
+CALL_BUILTIN 0
+out: PASS
+''')
+    assert asm == ('LOAD_GLOBAL 0\nJZ out\nLOAD_CONST 1\nCALL_BUILTIN 0\n'
+                   'out: PASS\n')
+    assert counts['passes'] == 1
+
+
+def test_store_load():
+    asm, counts = _optimized('''
+LOAD_CONST 1
+STORE_GLOBAL 0
+LOAD_GLOBAL 0
+CALL_BUILTIN 0
+LOAD_CONST 2
+STORE_GLOBAL 1
+a: LOAD_GLOBAL 1
+JMP a
+''')
+    assert asm == ('LOAD_CONST 1\nDUP\nSTORE_GLOBAL 0\nCALL_BUILTIN 0\n'
+                   'LOAD_CONST 2\nSTORE_GLOBAL 1\na: LOAD_GLOBAL 1\nJMP a\n')
+    assert counts['store_load'] == 1
+
+
+def test_jump_cycle():
+    body = load_assembly('a: JMP b\nb: JMP a\n').toplevel
+    report = optimize_body(body)
+    assert len(body) == 1
+    assert body[0].instr == Instr.JMP
+    assert body[0].labels == [body[0].param]
+    assert report.counts['thread_jumps'] == 0
+
+
+@pytest.mark.parametrize('asm', (
+    'JMP missing\nLOAD_CONST 1',
+    'LOAD_GLOBAL 0\nJZ missing\nLOAD_CONST 1\nJMP missing',
+))
+def test_unknown_label(asm):
+    with pytest.raises(ValueError) as excinfo:
+        optimize(load_assembly(asm))
+    assert str(excinfo.value) == "Unknown label 'missing'"
+
+
+@pytest.mark.parametrize(('source', 'expected'), (
+    ('''
+def sign(a):
+    if a > 0:
+        return 1
+    elif a < 0:
+        return 0 - 1
+    else:
+        return 0
+    print('unreachable')
+print(sign(5))
+print(sign(0 - 5))
+print(sign(0))
+''', '1\n-1\n0\n'),
+    ('''
+x = 3
+x = x * 2
+print(x)
+if x > 5:
+    pass
+print(x)
+''', '6\n6\n'),
+))
+def test_optimized_output(source, expected):
+    assert vm_output(source) == expected
@@ -0,0 +1,82 @@
+import pytest
+
+from yaksh.bytecode_compiler import Instr
+from yaksh.tests.utils import run_output, vm_bytecode
+from yaksh.treeshake import shake, shake_binary
+from yaksh.vm import AbstractMachine
+
+
+PROGRAM = '''
+def helper(x):
+    return x * 2
+def unused(x):
+    print('never printed')
+    return helper(x)
+def double(x):
+    return x + x
+unwritten = 'only stored'
+total = double(21)
+print(total)
+'''
+
+
+def test_shake():
+    bytecode = vm_bytecode(PROGRAM, inline_max_size=0)
+    shaken, report = shake_binary(bytecode)
+    assert run_output(shaken) == run_output(bytecode) == '42\n'
+    assert report.funcs_removed == 2
+    assert report.consts_removed == 2
+    # total is only read straight after it's stored, which the peephole
+    # optimizer turns into a DUP
+    assert report.globals_removed == 2
+    assert report.bytes_after == len(shaken) < report.bytes_before
+
+    consts, funcs, toplevel, _ = AbstractMachine(shaken).decode_all()
+    assert len(funcs) == 1
+    assert consts == ['only stored', 21]
+    assert (Instr.POP, None) in toplevel
+
+
+def test_shake_transitive_calls():
+    bytecode = vm_bytecode('''
+def c():
+    return 3
+def unused():
+    return 0
+def b():
+    return c()
+def a():
+    return b()
+print(a())
+''', inline_max_size=0)
+    shaken, report = shake_binary(bytecode)
+    assert report.funcs_removed == 1
+    assert run_output(shaken) == '3\n'
+
+
+def test_shake_host_globals():
+    program = ([], [], [(Instr.LOAD_GLOBAL, 2), (Instr.STORE_GLOBAL, 0),
+                        (Instr.STORE_GLOBAL, 1)], None)
+    (_, _, toplevel, _), report = shake(program, host_globals=1)
+    assert toplevel == [(Instr.LOAD_GLOBAL, 1), (Instr.STORE_GLOBAL, 0),
+                        (Instr.POP, None)]
+    assert report.globals_removed == 1
+
+
+def test_shake_lines():
+    bytecode = vm_bytecode('''
+def unused():
+    return 1
+def used():
+    return 1 / 0
+used()
+''', inline_max_size=0)
+    shaken, _ = shake_binary(bytecode)
+    with pytest.raises(ZeroDivisionError) as exc_info:
+        AbstractMachine(shaken).run()
+    assert exc_info.value.line_no == 5
+
+
+def test_shake_missing_function():
+    with pytest.raises(ValueError):
+        shake(([], [], [(Instr.CALL, 0)], None))
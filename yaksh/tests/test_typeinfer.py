@@ -0,0 +1,165 @@
+import pytest
+
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import Instr, assemble, load_assembly
+from yaksh.lexer import lex
+from yaksh.linker import compile_module
+from yaksh.optimizer import optimize
+from yaksh.parser import parse
+from yaksh.tests.utils import capture_stdout, vm_output
+from yaksh.typeinfer import ANY, NUM, STR, infer, specialize
+from yaksh.vm import AbstractMachine
+
+
+def _generate(source, **options):
+    asm = BytecodeAssemblyGenerator(parse(lex(source)), inline_max_size=0,
+                                    **options).generate()
+    optimize(asm)
+    return asm
+
+
+def _ops(body):
+    return [instruction.instr for instruction in body
+            if instruction.instr in (Instr.ADD, Instr.MULT, Instr.CMP,
+                                     Instr.ADD_NUM, Instr.ADD_STR,
+                                     Instr.MULT_NUM, Instr.CMP_NUM)]
+
+
+TYPED_PROGRAM = '''
+def poly(x):
+    return x * x + 3 * x + 1
+def greet(name):
+    return 'hi ' + name
+n = 0
+s = 'a'
+n = n + poly(2)
+s = s + 'b'
+if n > poly(3):
+    print(s + s)
+print(greet(s))
+print(n)
+'''
+
+
+def test_specialize():
+    asm = _generate(TYPED_PROGRAM)
+    assert _ops(asm.funcs[0]) == [Instr.MULT_NUM, Instr.ADD_NUM,
+                                  Instr.MULT_NUM, Instr.ADD_NUM]
+    assert _ops(asm.funcs[1]) == [Instr.ADD_STR]
+    assert _ops(asm.toplevel) == [Instr.ADD_NUM, Instr.ADD_STR,
+                                  Instr.CMP_NUM, Instr.ADD_STR]
+    assert vm_output(TYPED_PROGRAM) == 'hi ab\n11\n'
+
+
+def test_infer():
+    asm = BytecodeAssemblyGenerator(parse(lex(TYPED_PROGRAM)),
+                                    inline_max_size=0).generate()
+    info = infer(asm)
+    assert info.globals == {0: NUM, 1: STR}
+    assert info.returns == {0: NUM, 1: STR}
+
+
+@pytest.mark.parametrize(('source', 'expected'), (
+    # Called with numbers and strings
+    ('''
+def double(x):
+    return x + x
+print(double(2))
+print(double('ab'))
+''', '4\nabab\n'),
+    # Assigned a number and a string
+    ('''
+a = 1
+if len([]):
+    a = 'a'
+print(a + a)
+''', '2\n'),
+    # Lists, and whatever builtins return
+    ('''
+xs = [1] + [2]
+print(sum(xs) + 1)
+''', '4\n'),
+))
+def test_generic(source, expected):
+    asm = _generate(source)
+    assert set(_ops(asm.toplevel) + _ops(sum(asm.funcs, []))) == \
+        set([Instr.ADD])
+    assert vm_output(source) == expected
+
+
+def test_host_globals():
+    source = 'x = x + x\ny = len([1, 2])\nprint(y * y)'
+    asm = _generate(source, host_globals=['x'])
+    # The host could set x to anything
+    assert _ops(asm.toplevel) == [Instr.ADD, Instr.MULT_NUM]
+
+    with capture_stdout() as output:
+        vm = AbstractMachine(assemble(asm)).run(globals={0: 'ab'})
+    assert output.getvalue() == '4\n'
+    assert vm.get_global(0) == 'abab'
+
+    # Kept by the generator's assembly, and its text
+    assert asm.host_globals == 1
+    assert load_assembly(str(asm)) == asm
+
+
+def test_host_globals_directive():
+    asm = load_assembly('''
+.host_globals 1
+LOAD_CONST 1
+STORE_GLOBAL 0
+LOAD_CONST 2
+STORE_GLOBAL 1
+LOAD_GLOBAL 0
+LOAD_GLOBAL 0
+ADD
+LOAD_GLOBAL 1
+LOAD_GLOBAL 1
+ADD
+''')
+    assert asm.host_globals == 1
+    specialize(asm)
+    assert _ops(asm.toplevel) == [Instr.ADD, Instr.ADD_NUM]
+
+    with pytest.raises(ValueError):
+        load_assembly('LOAD_CONST 1\n.host_globals 1')
+
+
+def test_module():
+    # Other modules could call it with anything
+    obj = compile_module('def double(x):\n    return x + x\nprint(double(2))')
+    funcs = AbstractMachine(obj).decode_all()[1]
+    assert [instr for instr, _ in funcs[0]
+            if instr in (Instr.ADD, Instr.ADD_NUM)] == [Instr.ADD]
+
+
+def test_uncalled_stays_generic():
+    asm = load_assembly('''
+PROC
+STORE_VAR 0
+LOAD_CONST 1
+LOAD_LOCAL 0
+ADD
+RETN
+MAKE_FUNCTION
+LOAD_CONST 2
+LOAD_CONST 3
+ADD
+''')
+    assert specialize(asm) == 1
+    assert _ops(asm.funcs[0]) == [Instr.ADD]
+    assert _ops(asm.toplevel) == [Instr.ADD_NUM]
+    assert infer(asm).returns == {0: ANY}
+
+
+@pytest.mark.parametrize(('asm', 'expected'), (
+    ('LOAD_CONST 2\nLOAD_CONST 3\nADD_NUM', 5),
+    ("LOAD_CONST 'b'\nLOAD_CONST 'a'\nADD_STR", 'ab'),
+    ('LOAD_CONST 2\nLOAD_CONST 3\nMULT_NUM', 6),
+    # 3 > 2
+    ('LOAD_CONST 2\nLOAD_CONST 3\nCMP_NUM 2', True),
+))
+def test_vm_specialized(asm, expected):
+    with capture_stdout() as output:
+        AbstractMachine(assemble(asm + '\nCALL_BUILTIN 0')).run()
+    assert output.getvalue() == '%s\n' % expected
@@ -1,6 +1,14 @@
+import sys
+from array import array
+
 import pytest
 
-from yaksh.tests.utils import vm_output
+from yaksh.bytecode_asm import BytecodeAssemblyGenerator
+from yaksh.bytecode_compiler import assemble
+from yaksh.lexer import lex
+from yaksh.parser import parse
+from yaksh.tests.utils import capture_stdout, vm_output
+from yaksh.vm import AbstractMachine, Rope, concat
 
 
 def _expected_actual(expected, output, source):
@@ -29,9 +37,11 @@ def _expected_actual(expected, output, source):
         ('(8 - 4) + (8 * 4)', '36'),
     )
 )
-def test_arithmetic(expr, expected):
+# Unoptimized, constant expressions are left to the VM to evaluate
+@pytest.mark.parametrize('optimized', (True, False))
+def test_arithmetic(expr, expected, optimized):
     source = 'print(%s)' % expr
-    output = vm_output(source).strip()
+    output = vm_output(source, optimized=optimized).strip()
     assert output == expected, _expected_actual(expected, output, source)
 
 
@@ -55,7 +65,30 @@ print_param_arith(1, 2, 3)''', '6'),
         ('''
 def do_arith(a, b, c):
     return a + b + c
-print(do_arith(1, 2, 3))''', '6')
+print(do_arith(1, 2, 3))''', '6'),
+        ('''
+def local_arith(a):
+    b = a * 2
+    c = b + 1
+    return c
+print(local_arith(3))''', '7'),
+        ('''
+def nested_if(a):
+    if a > 1:
+        if a > 2:
+            return 3
+        return 2
+    else:
+        return 1
+print(nested_if(3))
+print(nested_if(2))
+print(nested_if(1))''', '3\n2\n1'),
+        ('''
+def fact(n):
+    if n > 1:
+        return n * fact(n - 1)
+    return 1
+print(fact(5))''', '120'),
     ),
 )
 def test_functions(source, expected):
@@ -92,9 +125,185 @@ elif 1 - 1:
 elif 1 + 1:
     print(2)
 else:
-    print(3)''', '2')
+    print(3)''', '2'),
+        ('''
+if 0:
+    print(0)
+if 1:
+    print(1)
+    print(2)''', '1\n2'),
+        ('''
+if 1:
+    if 0:
+        print(0)
+print(1)''', '1'),
+        ('''
+def f(x):
+    if x:
+        if x - 1:
+            print(x)
+f(1)
+f(2)''', '2'),
+    )
+)
+@pytest.mark.parametrize('optimized', (True, False))
+def test_if_chain(source, expected, optimized):
+    output = vm_output(source, optimized=optimized).strip()
+    assert output == expected, _expected_actual(expected, output, source)
+
+
+@pytest.mark.parametrize(
+    ('source', 'expected'),
+    (
+        ('print([1, 2, 3])', '[1, 2, 3]'),
+        ('print([])', '[]'),
+        ('print(len([4, 5, 6]))', '3'),
+        ('print([4, 5, 6][1])', '5'),
+        ('print({1: 2}[1])', '2'),
+        ('print(len({}))', '0'),
+        ('''
+xs = [1, 2, 3]
+xs[0] = xs[1] + xs[2]
+print(xs)''', '[5, 2, 3]'),
+        ('''
+d = {'a': [1, 2], 'b': 3}
+d['a'][1] = 4
+d['c'] = d['b'] * 2
+print(d['a'])
+print(d['c'])''', '[1, 4]\n6'),
+        ('''
+def first(xs):
+    ys = xs
+    return ys[0]
+print(first([7, 8]))''', '7'),
+    )
+)
+def test_collections(source, expected):
+    output = vm_output(source).strip()
+    assert output == expected, _expected_actual(expected, output, source)
+
+
+LONG = 'x' * 70
+
+
+@pytest.mark.parametrize(
+    ('source', 'expected'),
+    (
+        ("print('ab' + 'cd')", 'abcd'),
+        ('''
+s = '%s'
+s = s + 'a'
+s = s + 'b'
+print(s)
+print(len(s))''' % LONG, LONG + 'ab\n72'),
+        ('''
+s = '%s'
+t = s + 'a'
+u = s + 'b'
+print(t)
+print(u)''' % LONG, LONG + 'a\n' + LONG + 'b'),
+        ('''
+s = '%s' + 'a'
+print('b' + s + s)''' % LONG, 'b' + (LONG + 'a') * 2),
+        ('''
+s = '%s' + 'a'
+if s == '%sa':
+    print('equal')
+d = {s: 1}
+print(d['%sa'])''' % (LONG, LONG, LONG), 'equal\n1'),
     )
 )
-def test_if_chain(source, expected):
+def test_strings(source, expected):
     output = vm_output(source).strip()
     assert output == expected, _expected_actual(expected, output, source)
+
+
+def test_rope_comparisons():
+    s = concat(LONG, 'a')
+    t = concat(concat(LONG[:40], LONG[40:]), 'a')
+    assert type(s) is Rope and type(t) is Rope
+    assert s == t and s == LONG + 'a' and LONG + 'a' == s
+    assert not s != t
+    assert [s] == [t]
+    assert {1: s} == {1: LONG + 'a'}
+    assert {s: 1}[LONG + 'a'] == 1
+    u = concat(LONG, 'b')
+    assert s < u and u > s and s <= t and u >= s
+    assert LONG < s
+    assert min([u, s]) is s and max([u, s]) is u
+
+
+def test_ropes_in_collections():
+    # x is a host global, so the strings are concatenated at run time
+    source = """
+a = [x + 'a', x + 'b']
+b = [x + 'a', x + 'b']
+print(a == b)
+print({1: x + 'a'} == {1: x + 'a'})
+print(min(b) == x + 'a')
+print(max(b) == x + 'b')
+"""
+    bc_gen = BytecodeAssemblyGenerator(parse(lex(source)), host_globals=('x',))
+    bytecode = assemble(bc_gen.generate())
+    with capture_stdout() as output:
+        AbstractMachine(bytecode).run(globals={0: LONG})
+    assert output.getvalue() == 'True\n' * 4
+
+
+@pytest.mark.parametrize(
+    ('source', 'expected'),
+    (
+        ('print(vector([1, 2, 3]))', 'vector([1, 2, 3])'),
+        ('print(vector([1, 2]) + vector([3, 4]))', 'vector([4, 6])'),
+        ('print(vector([1, 2]) * 2)', 'vector([2, 4])'),
+        ('print(10 - vector([1, 2]))', 'vector([9, 8])'),
+        ('print(vector([1, 2]) / 2.0)', 'vector([0.5, 1.0])'),
+        ('print(sum(vector([1.5, 2.5])))', '4.0'),
+        ('print(min(vector([3, 1, 2])))', '1'),
+        ('print(max([3, 1, 2]))', '3'),
+        ('print(dot(vector([1, 2]), vector([3, 4])))', '11'),
+        ('print(slice(vector([1, 2, 3, 4]), 1, 3))', 'vector([2, 3])'),
+        ('print(len(vector([1, 2, 3])))', '3'),
+        ('print(vector([1, 2, 3])[2])', '3'),
+    )
+)
+def test_vectors(source, expected):
+    output = vm_output(source).strip()
+    assert output == expected, _expected_actual(expected, output, source)
+
+
+@pytest.mark.parametrize(
+    ('source', 'message'),
+    (
+        ('print(vector([%d]) * 2)' % sys.maxint, 'Integer vector overflow.'),
+        ('print(vector([%d]) + vector([1]))' % sys.maxint,
+         'Integer vector overflow.'),
+        ('print(vector([%d]))' % (sys.maxint + 1), 'Integer vector overflow.'),
+        ('v = vector([1, 2])\nv[0] = 1.5',
+         'Cannot store float 1.5 in an integer vector.'),
+        ('v = vector([1, 2])\nv[0] = %d' % (sys.maxint + 1),
+         '%dL is too large for an integer vector.' % (sys.maxint + 1)),
+        ("v = vector([1.0])\nv[0] = 'a'", 'Cannot store str in a vector.'),
+    )
+)
+def test_vector_errors(source, message):
+    with pytest.raises(RuntimeError) as excinfo:
+        vm_output(source)
+    assert str(excinfo.value).startswith(message)
+
+
+def test_vector_host_round_trip():
+    source = '''
+doubled = column * 2
+column[0] = 5.0
+'''
+    bc_gen = BytecodeAssemblyGenerator(parse(lex(source)),
+                                       host_globals=('column',))
+    bytecode = assemble(bc_gen.generate())
+
+    column = array('d', [1.0, 2.0])
+    vm = AbstractMachine(bytecode).run(globals={0: column})
+
+    assert vm.get_global(0) is column
+    assert column.tolist() == [5.0, 2.0]
+    assert vm.get_global(bc_gen._globals['doubled']).tolist() == [2.0, 4.0]
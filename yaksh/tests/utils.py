@@ -9,6 +9,7 @@ except ImportError:
 from yaksh.bytecode_asm import BytecodeAssemblyGenerator
 from yaksh.bytecode_compiler import assemble
 from yaksh.lexer import lex
+from yaksh.optimizer import optimize
 from yaksh.parser import parse
 from yaksh.vm import AbstractMachine
 
@@ -20,14 +21,36 @@ def capture_stdout():
     sys.stdout = _old_stdout
 
 
-def vm_output(s):
+def vm_bytecode(s, optimized=True, **options):
+    """
+    @param optimized: whether to fold constants and run the optimizer.
+        Without, constant expressions reach the VM's own arithmetic and jumps.
+    @param options: passed to BytecodeAssemblyGenerator
+    """
     tokens = lex(s)
     symbols = parse(tokens)
     # print '\n'.join(map(str, symbols))###########################
-    bc_gen = BytecodeAssemblyGenerator(symbols)
+    if not optimized:
+        options.setdefault('fold_constants', False)
+    bc_gen = BytecodeAssemblyGenerator(symbols, **options)
     bc_asm = bc_gen.generate()
-    bytecode = assemble(bc_asm)
-    vm = AbstractMachine(bytecode)
+    if optimized:
+        optimize(bc_asm)
+    return assemble(bc_asm)
+
+
+def run_output(program):
+    """
+    Runs a program and returns what it printed
+
+    @param program: a binary, or an AbstractMachine
+    """
+    if not isinstance(program, AbstractMachine):
+        program = AbstractMachine(program)
     with capture_stdout() as output:
-        vm.run()
+        program.run()
     return output.getvalue()
+
+
+def vm_output(s, **options):
+    return run_output(vm_bytecode(s, **options))
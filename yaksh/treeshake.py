@@ -0,0 +1,163 @@
+"""
+Whole-program tree shaking: dropping the functions, constants and globals a
+program never uses.
+
+Starting from the toplevel, shake() follows CALLs to find every function that
+can run. The rest are dropped, along with constants only they loaded, and
+globals nothing reachable reads. A store to a dead global is replaced with a
+POP, so the value it stored is still computed. The functions, constants and
+globals kept are then renumbered, in their original order.
+
+    python -m yaksh.treeshake -o small.ysh program.ysh
+"""
+import argparse
+import time
+
+from yaksh.bytecode_compiler import FORMAT_VERSION, Instr, write_program
+from yaksh.vm import AbstractMachine
+
+
+class ShakeReport(object):
+    """What shake() removed, and what it saved"""
+
+    def __init__(self, funcs_removed, consts_removed, globals_removed):
+        self.funcs_removed = funcs_removed
+        self.consts_removed = consts_removed
+        self.globals_removed = globals_removed
+        self.bytes_before = self.bytes_after = 0
+        self.decode_before = self.decode_after = 0.0
+
+    @property
+    def bytes_removed(self):
+        return self.bytes_before - self.bytes_after
+
+    @property
+    def decode_time_removed(self):
+        return self.decode_before - self.decode_after
+
+    def __str__(self):
+        return ('Removed %d functions, %d constants and %d globals: '
+                '%d of %d bytes, %.2f ms of %.2f ms decoding' % (
+                    self.funcs_removed, self.consts_removed,
+                    self.globals_removed, self.bytes_removed,
+                    self.bytes_before, self.decode_time_removed * 1000,
+                    self.decode_before * 1000))
+
+
+def shake(program, host_globals=0):
+    """
+    Removes what's unreachable from a decoded program.
+
+    @param program: (consts, funcs, toplevel, lines), as from
+        AbstractMachine.decode_all()
+    @param host_globals: number of globals set or read by the embedding host,
+        which are always kept, at their indices
+    @return: (the shaken program, a ShakeReport)
+    """
+    consts, funcs, toplevel, lines = program
+
+    reachable = set()
+    pending = [toplevel]
+    while pending:
+        for instr, param in pending.pop():
+            if instr == Instr.CALL and param not in reachable:
+                if param >= len(funcs):
+                    raise ValueError('Call to missing function %d' % param)
+                reachable.add(param)
+                pending.append(funcs[param])
+    kept_funcs = sorted(reachable)
+    bodies = [funcs[i] for i in kept_funcs] + [toplevel]
+
+    used_consts = set()
+    read_globals = set(xrange(host_globals))
+    for body in bodies:
+        for instr, param in body:
+            if instr == Instr.LOAD_CONST:
+                used_consts.add(param)
+            elif instr == Instr.LOAD_GLOBAL:
+                read_globals.add(param)
+
+    func_map = dict((old, new) for new, old in enumerate(kept_funcs))
+    kept_consts = sorted(used_consts)
+    const_map = dict((old, new) for new, old in enumerate(kept_consts))
+    kept_globals = sorted(read_globals)
+    global_map = dict((old, new) for new, old in enumerate(kept_globals))
+
+    new_bodies = []
+    for body in bodies:
+        new_body = []
+        for instr, param in body:
+            if instr == Instr.CALL:
+                param = func_map[param]
+            elif instr == Instr.LOAD_CONST:
+                param = const_map[param]
+            elif instr == Instr.LOAD_GLOBAL:
+                param = global_map[param]
+            elif instr == Instr.STORE_GLOBAL:
+                if param in global_map:
+                    param = global_map[param]
+                else:
+                    instr, param = Instr.POP, None
+            new_body.append((instr, param))
+        new_bodies.append(new_body)
+
+    if lines:
+        lines = [lines[i] for i in kept_funcs] + [lines[-1]]
+
+    shaken = ([consts[i] for i in kept_consts], new_bodies[:-1],
+              new_bodies[-1], lines)
+    all_globals = set(param for body in funcs + [toplevel]
+                      for instr, param in body
+                      if instr in (Instr.LOAD_GLOBAL, Instr.STORE_GLOBAL))
+    report = ShakeReport(len(funcs) - len(kept_funcs),
+                         len(consts) - len(kept_consts),
+                         len(all_globals - read_globals))
+    return shaken, report
+
+
+def _decode_time(bytecode):
+    best = None
+    for _ in xrange(3):
+        start = time.time()
+        AbstractMachine(bytecode).decode_all()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def shake_binary(bytecode, host_globals=0, version=FORMAT_VERSION):
+    """
+    Shakes a binary, timing how long it takes to decode before and after.
+
+    @return: (the shaken binary, a ShakeReport)
+    """
+    shaken, report = shake(AbstractMachine(bytecode).decode_all(),
+                           host_globals)
+    shaken_bytecode = write_program(*shaken, version=version)
+    report.bytes_before = len(bytecode)
+    report.bytes_after = len(shaken_bytecode)
+    report.decode_before = _decode_time(bytecode)
+    report.decode_after = _decode_time(shaken_bytecode)
+    return shaken_bytecode, report
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='yaksh.treeshake')
+    parser.add_argument('binary', help='.ysh binary to shake')
+    parser.add_argument('-o', '--output', required=True,
+                        help='where to write the shaken binary')
+    parser.add_argument('--host-globals', type=int, default=0,
+                        help='number of globals the host uses, which are '
+                             'always kept')
+    args = parser.parse_args()
+
+    with open(args.binary, 'rb') as f:
+        bytecode, report = shake_binary(f.read(), args.host_globals)
+    with open(args.output, 'wb') as f:
+        f.write(bytecode)
+    print report
+
+
+if __name__ == '__main__':
+    main()
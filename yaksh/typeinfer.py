@@ -0,0 +1,360 @@
+"""
+Static type inference over in-memory assembly, and the specialized opcodes
+it lets the optimizer select.
+
+Values are typed NUM (an int or float, or the bool a CMP gives), STR (a
+string, or a rope of them) or ANY. Types are inferred:
+ - for the stack and local slots of each body, flow-sensitively, by solving
+   a forward dataflow problem over its ControlFlowGraph (see yaksh.cfg)
+ - for globals, as the join of every value the program stores in them
+ - for functions, as the join of every value they return
+
+Functions and globals depend on each other, so a body is analysed again
+whenever the type of a global it loads, a function it calls returns, or
+the stack it's called with changes, until none do.
+
+Where both operands of an ADD, MULT or CMP are proven, it's replaced with a
+specialized opcode (ADD_NUM, ADD_STR, MULT_NUM or CMP_NUM), which the VM
+runs without checking for strings, or flattening ropes. Everything else
+keeps the generic opcode.
+"""
+from collections import deque
+
+from yaksh.bytecode_compiler import Instr
+from yaksh.cfg import ControlFlowGraph, solve
+
+
+NUM = 'num'
+STR = 'str'
+ANY = 'any'
+
+# Specialized opcodes, by generic opcode and the type of both operands
+SPECIALIZED = {
+    (Instr.ADD, NUM): Instr.ADD_NUM,
+    (Instr.ADD, STR): Instr.ADD_STR,
+    (Instr.MULT, NUM): Instr.MULT_NUM,
+    (Instr.CMP, NUM): Instr.CMP_NUM,
+}
+_GENERIC = dict((specialized, generic)
+                for (generic, _), specialized in SPECIALIZED.iteritems())
+
+_ARITHMETIC = (Instr.ADD, Instr.SUB, Instr.MULT, Instr.DIV)
+
+
+def join(a, b):
+    """The type of a value which may be of type a or b. None is no value."""
+    if a is None:
+        return b
+    if b is None or a == b:
+        return a
+    return ANY
+
+
+def const_type(value):
+    if type(value) in (int, long, float):
+        return NUM
+    elif isinstance(value, basestring):
+        return STR
+    return ANY
+
+
+class TypeInfo(object):
+    """
+    Types of a program's globals and function returns
+
+    @ivar globals: types of globals, by index. Those missing are ANY.
+    @ivar returns: types functions return, by index. Those missing are ANY.
+    @ivar entries: the _State each function is called in, by index, or None
+        for those never called
+    """
+
+    def __init__(self, globals, returns, entries):
+        self.globals = globals
+        self.returns = returns
+        self.entries = entries
+
+    def global_type(self, global_idx):
+        return self.globals.get(global_idx, ANY)
+
+    def return_type(self, func_idx):
+        return self.returns.get(func_idx, ANY)
+
+    def entry(self, func_idx):
+        """
+        The _State asm.bodies[func_idx] starts in: for the toplevel, an
+        empty stack
+        """
+        if func_idx == len(self.entries):
+            return _State()
+        return self.entries[func_idx]
+
+
+class _State(object):
+    """
+    Types before an instruction: of the top of the stack, and of local slots
+
+    @ivar stack: tuple of the types of the values known to be on top of the
+        stack, bottom first. Values below them are ANY.
+    @ivar locals: dict of local slots to their types. Slots missing are ANY.
+    """
+    __slots__ = ('stack', 'locals')
+
+    def __init__(self, stack=(), locals=None):
+        self.stack = stack
+        self.locals = locals or {}
+
+    def __eq__(self, other):
+        return (isinstance(other, _State) and self.stack == other.stack and
+                self.locals == other.locals)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def top(self, n):
+        """Types of the top n values, topmost first"""
+        known = list(reversed(self.stack[-n:]))
+        return known + [ANY] * (n - len(known))
+
+
+def _meet(states):
+    states = [state for state in states if state is not None]
+    if not states:
+        return None
+    stack = states[0].stack
+    locals = dict(states[0].locals)
+    for state in states[1:]:
+        # Only the values known on top of both stacks stay known
+        depth = min(len(stack), len(state.stack))
+        stack = tuple(join(a, b) for a, b in zip(
+            stack[len(stack) - depth:],
+            state.stack[len(state.stack) - depth:]))
+        for slot in locals.keys():
+            if slot in state.locals:
+                locals[slot] = join(locals[slot], state.locals[slot])
+            else:
+                del locals[slot]
+    return _State(stack, locals)
+
+
+def _result_type(instr, operands):
+    """Type of the value instr pushes, given its operands', topmost first"""
+    if instr == Instr.CMP:
+        return NUM
+    if None in operands:
+        # Not known yet
+        return None
+    if all(t == NUM for t in operands):
+        return NUM
+    if instr == Instr.ADD and all(t == STR for t in operands):
+        return STR
+    if instr == Instr.MULT and sorted(operands) == [NUM, STR]:
+        return STR
+    return ANY
+
+
+def step(state, instruction, info):
+    """
+    @return: the _State after instruction runs, given the one before it
+    """
+    instr, param = instruction.instr, instruction.param
+    instr = _GENERIC.get(instr, instr)
+    stack = list(state.stack)
+    locals = state.locals
+
+    def pop(n=1):
+        popped = list(reversed(stack[-n:])) if n else []
+        del stack[max(0, len(stack) - n):]
+        return popped + [ANY] * (n - len(popped))
+
+    if instr == Instr.LOAD_CONST:
+        stack.append(const_type(param))
+    elif instr == Instr.LOAD_LOCAL:
+        stack.append(locals.get(param, ANY))
+    elif instr == Instr.LOAD_GLOBAL:
+        stack.append(info.global_type(param))
+    elif instr == Instr.STORE_VAR:
+        locals = dict(locals)
+        locals[param] = pop()[0]
+    elif instr in (Instr.STORE_GLOBAL, Instr.POP, Instr.JZ, Instr.JNZ):
+        pop()
+    elif instr in _ARITHMETIC or instr == Instr.CMP:
+        stack.append(_result_type(instr, pop(2)))
+    elif instr == Instr.LEN:
+        pop()
+        stack.append(NUM)
+    elif instr == Instr.DUP:
+        stack.extend(pop() * 2)
+    elif instr == Instr.LOAD_INDEX:
+        pop(2)
+        stack.append(ANY)
+    elif instr == Instr.STORE_INDEX:
+        pop(3)
+    elif instr == Instr.BUILD_LIST:
+        pop(param)
+        stack.append(ANY)
+    elif instr == Instr.BUILD_MAP:
+        pop(param * 2)
+        stack.append(ANY)
+    elif instr == Instr.CALL:
+        # Pops however many arguments the function takes
+        stack = [info.return_type(param)]
+    elif instr in (Instr.PASS, Instr.JMP, Instr.RETN):
+        pass
+    else:
+        # CALL_BUILTIN, and anything else whose effect on the stack isn't
+        # known, but which pushes a value
+        stack = [ANY]
+    return _State(tuple(stack), locals)
+
+
+def analyse(body, info, entry):
+    """
+    @param entry: the _State body starts in
+    @return: (the ControlFlowGraph of body, the _State before each of its
+        blocks, or None for those never reached)
+    """
+    cfg = ControlFlowGraph(body)
+
+    def transfer(block, state):
+        if state is None:
+            return None
+        for instruction in cfg.instructions(block):
+            state = step(state, instruction, info)
+        return state
+
+    ins, _ = solve(cfg, transfer, _meet, entry, None)
+    return cfg, ins
+
+
+def _walk(body, info, entry):
+    """Yields (i, the _State before body[i]) for each instruction reached"""
+    cfg, ins = analyse(body, info, entry)
+    for block in cfg.blocks:
+        state = ins[block.index]
+        if state is None:
+            continue
+        for i in xrange(block.start, block.end):
+            yield i, state
+            state = step(state, body[i], info)
+
+
+def _is_exit(body, i):
+    """Whether control can leave body right after body[i]"""
+    instr = body[i].instr
+    return instr == Instr.RETN or (i == len(body) - 1 and instr != Instr.JMP)
+
+
+def infer(asm, whole_program=True):
+    """
+    Infers the types of the globals and function returns of asm, and of the
+    stacks its functions are called with. The types of globals its embedding
+    host provides (see Assembly.host_globals) aren't known.
+
+    @param whole_program: whether asm is the whole program. If not, other
+        modules could store anything in its globals, or call its functions
+        with anything, and its imports could return anything.
+    @return: a TypeInfo
+    """
+    return _infer(asm, whole_program)[0]
+
+
+def _infer(asm, whole_program):
+    """
+    @return: (the TypeInfo, and for each body reached, by index, the
+        (i, _State before body[i]) of each of its instructions reached)
+    """
+    # Everything starts out holding no value (None), or for functions, never
+    # called, and only widens, so this terminates
+    globals = {}
+    if whole_program:
+        for body in asm.bodies:
+            for instruction in body:
+                if (instruction.instr == Instr.STORE_GLOBAL and
+                        instruction.param >= asm.host_globals):
+                    globals[instruction.param] = None
+    returns = dict((i, None) for i in xrange(len(asm.funcs)))
+    entries = dict((i, None if whole_program else _State())
+                   for i in xrange(len(asm.funcs)))
+    info = TypeInfo(globals, returns, entries)
+
+    # The bodies to analyse again when a global's type, or a function's
+    # return type, changes
+    loaders = {}
+    callers = {}
+    for func_idx, body in enumerate(asm.bodies):
+        for instruction in body:
+            if instruction.instr == Instr.LOAD_GLOBAL:
+                loaders.setdefault(instruction.param, set()).add(func_idx)
+            elif instruction.instr == Instr.CALL:
+                callers.setdefault(instruction.param, set()).add(func_idx)
+
+    walks = {}
+    pending = deque(xrange(len(asm.bodies)))
+    queued = set(pending)
+
+    def changed(func_indices):
+        for func_idx in func_indices:
+            if func_idx not in queued:
+                pending.append(func_idx)
+                queued.add(func_idx)
+
+    while pending:
+        func_idx = pending.popleft()
+        queued.discard(func_idx)
+        entry = info.entry(func_idx)
+        if entry is None:
+            continue
+        body = asm.bodies[func_idx]
+        walks[func_idx] = walk = list(_walk(body, info, entry))
+        for i, state in walk:
+            instr, param = body[i].instr, body[i].param
+            if instr == Instr.STORE_GLOBAL and param in globals:
+                t = join(globals[param], state.top(1)[0])
+                if t != globals[param]:
+                    globals[param] = t
+                    changed(loaders.get(param, ()))
+            elif instr == Instr.CALL and param in entries:
+                # The function starts with its caller's stack
+                new_entry = _meet([entries[param], _State(state.stack)])
+                if new_entry != entries[param]:
+                    entries[param] = new_entry
+                    changed([param])
+            if func_idx in returns and _is_exit(body, i):
+                # Returning, or falling off the end, leaves the top of the
+                # stack
+                returned = step(state, body[i], info).top(1)[0]
+                t = join(returns[func_idx], returned)
+                if t != returns[func_idx]:
+                    returns[func_idx] = t
+                    changed(callers.get(func_idx, ()))
+
+    # Globals and returns still without a value are never read, as nothing
+    # stores them or returns
+    for types in (globals, returns):
+        for key, t in types.items():
+            if t is None:
+                types[key] = ANY
+    return info, walks
+
+
+def specialize(asm, whole_program=True):
+    """
+    Replaces generic opcodes of asm with specialized ones, where the types
+    of their operands are proven, in place.
+
+    @return: the number of instructions specialized
+    """
+    # Each body was last analysed after the last change to the types it
+    # depends on, so its walk then still holds
+    _, walks = _infer(asm, whole_program)
+    specialized = 0
+    for func_idx, walk in walks.iteritems():
+        body = asm.bodies[func_idx]
+        for i, state in walk:
+            operands = set(state.top(2))
+            if len(operands) == 1:
+                key = (body[i].instr, operands.pop())
+                if key in SPECIALIZED:
+                    body[i].instr = SPECIALIZED[key]
+                    specialized += 1
+    return specialized
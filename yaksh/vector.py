@@ -0,0 +1,146 @@
+"""
+Numeric vectors for the VM.
+
+A Vector wraps an `array.array` of doubles ('d') or machine longs ('l'), and
+implements arithmetic elementwise, so a single ADD/SUB/MULT/DIV instruction
+processes a whole column. The other operand may be a vector of the same length
+or a scalar, which is broadcast.
+
+Hosts hand arrays to the VM and get them back without copying: the VM wraps
+an incoming array in a Vector, and unwraps it again on the way out (see
+`VirtualMachine.set_global` and `get_global`). The array itself exposes the
+buffer protocol (`buffer(vec.array)`).
+
+Python 2 has no array('q'), so integer vectors use 'l', which is 64-bit on
+LP64 platforms.
+"""
+import operator
+from array import array
+from itertools import imap
+
+
+FLOAT_TYPECODE = 'd'
+INT_TYPECODE = 'l'
+TYPECODES = (FLOAT_TYPECODE, INT_TYPECODE)
+
+
+class Vector(object):
+    __slots__ = ('array',)
+
+    def __init__(self, arr):
+        if arr.typecode not in TYPECODES:
+            raise TypeError("Unsupported vector typecode '%s'" % arr.typecode)
+        self.array = arr
+
+    @staticmethod
+    def from_values(values):
+        if isinstance(values, Vector):
+            return Vector(array(values.array.typecode, values.array))
+        values = list(values)
+        if all(isinstance(v, (int, long)) for v in values):
+            try:
+                return Vector(array(INT_TYPECODE, values))
+            except OverflowError:
+                raise RuntimeError('Integer vector overflow.')
+        return Vector(array(FLOAT_TYPECODE, values))
+
+    def _typecode(self, other):
+        if isinstance(other, Vector):
+            other_typecode = other.array.typecode
+        elif isinstance(other, float):
+            other_typecode = FLOAT_TYPECODE
+        else:
+            other_typecode = INT_TYPECODE
+        if FLOAT_TYPECODE in (self.array.typecode, other_typecode):
+            return FLOAT_TYPECODE
+        return INT_TYPECODE
+
+    def _elementwise(self, op, other, reflected=False):
+        if isinstance(other, Vector):
+            if len(other.array) != len(self.array):
+                raise RuntimeError('Vector length mismatch (%d and %d).' %
+                                   (len(self.array), len(other.array)))
+            if reflected:
+                values = imap(op, other.array, self.array)
+            else:
+                values = imap(op, self.array, other.array)
+        elif isinstance(other, (int, long, float)):
+            if reflected:
+                values = (op(other, v) for v in self.array)
+            else:
+                values = (op(v, other) for v in self.array)
+        else:
+            return NotImplemented
+        try:
+            return Vector(array(self._typecode(other), values))
+        except OverflowError:
+            raise RuntimeError('Integer vector overflow.')
+
+    def __add__(self, other):
+        return self._elementwise(operator.add, other)
+
+    def __radd__(self, other):
+        return self._elementwise(operator.add, other, True)
+
+    def __sub__(self, other):
+        return self._elementwise(operator.sub, other)
+
+    def __rsub__(self, other):
+        return self._elementwise(operator.sub, other, True)
+
+    def __mul__(self, other):
+        return self._elementwise(operator.mul, other)
+
+    def __rmul__(self, other):
+        return self._elementwise(operator.mul, other, True)
+
+    def __div__(self, other):
+        return self._elementwise(operator.div, other)
+
+    def __rdiv__(self, other):
+        return self._elementwise(operator.div, other, True)
+
+    def __eq__(self, other):
+        return isinstance(other, Vector) and self.array == other.array
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __setitem__(self, index, value):
+        try:
+            self.array[index] = value
+        except OverflowError:
+            raise RuntimeError('%r is too large for an integer vector.' %
+                               (value,))
+        except TypeError:
+            if isinstance(value, float):
+                raise RuntimeError('Cannot store float %r in an integer '
+                                   'vector.' % (value,))
+            raise RuntimeError('Cannot store %s in a vector.' %
+                               type(value).__name__)
+
+    def __str__(self):
+        return 'vector(%s)' % list(self.array)
+    __repr__ = __str__
+
+
+def dot(a, b):
+    if len(a) != len(b):
+        raise RuntimeError('Vector length mismatch (%d and %d).' %
+                           (len(a), len(b)))
+    return sum(imap(operator.mul, a, b))
+
+
+def vslice(v, start, end):
+    if isinstance(v, Vector):
+        return Vector(v.array[start:end])
+    return v[start:end]
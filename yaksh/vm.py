@@ -1,13 +1,135 @@
+import mmap
+import os
 import struct
+from array import array
+from bisect import bisect_right
 
 from yaksh.bytecode_asm import BUILTINS
-from yaksh.bytecode_compiler import MAGIC, Const, Instr, Compare
+from yaksh.bytecode_compiler import (FORMAT_VERSION, MAGIC, MAGIC_V0,
+                                     MAGIC_V2, Compare, Const, Instr, Section,
+                                     unzigzag, write_program)
+from yaksh.vector import Vector, dot, vslice
+
+
+# Strings concatenated to less than this length are joined eagerly
+ROPE_MIN_LENGTH = 64
+
+_BYTE = struct.Struct('B')
+_INT = struct.Struct('i')
+_USHORT = struct.Struct('H')
+_UINT = struct.Struct('I')
+_FLOAT = struct.Struct('f')
+_DOUBLE = struct.Struct('<d')
+_NO_PARAMS = frozenset(Instr.NO_PARAMS)
+
+# Placeholder for constants not yet decoded
+_UNDECODED = object()
 
 
 class Return(Exception):
     pass
 
 
+class Rope(object):
+    """A string built by concatenation, only joined once its value is read.
+
+    Ropes share their list of pieces with the rope they were extended from.
+    The newest rope on a list appends to it in place, making accumulation
+    with repeated ADDs linear; extending any older rope copies its pieces.
+    """
+    __slots__ = ('_pieces', '_count', '_len', '_flat')
+
+    def __init__(self, pieces, length):
+        self._pieces = pieces
+        self._count = len(pieces)
+        self._len = length
+        self._flat = None
+
+    def concat(self, s):
+        pieces = self._pieces
+        if len(pieces) != self._count:
+            pieces = pieces[:self._count]
+        if type(s) is Rope:
+            pieces.extend(s._pieces[:s._count])
+        else:
+            pieces.append(s)
+        return Rope(pieces, self._len + len(s))
+
+    def __len__(self):
+        return self._len
+
+    def __str__(self):
+        if self._flat is None:
+            pieces = self._pieces
+            if len(pieces) != self._count:
+                pieces = pieces[:self._count]
+            self._flat = ''.join(pieces)
+        return self._flat
+
+    def __repr__(self):
+        return repr(str(self))
+
+    # A rope is equal to, ordered and hashed like its string, so it can be a
+    # value in lists and maps, be compared there, and be passed to min/max
+    def __eq__(self, other):
+        return str(self) == flatten(other)
+
+    def __ne__(self, other):
+        return str(self) != flatten(other)
+
+    def __lt__(self, other):
+        return str(self) < flatten(other)
+
+    def __le__(self, other):
+        return str(self) <= flatten(other)
+
+    def __gt__(self, other):
+        return str(self) > flatten(other)
+
+    def __ge__(self, other):
+        return str(self) >= flatten(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+STRING_TYPES = {str, Rope}
+
+
+def concat(l, r):
+    """Concatenates strings or ropes, building a rope unless both are short"""
+    if type(l) is Rope:
+        return l.concat(r)
+    length = len(l) + len(r)
+    if type(r) is Rope:
+        return Rope([l] + r._pieces[:r._count], length)
+    elif length < ROPE_MIN_LENGTH:
+        return l + r
+    else:
+        return Rope([l, r], length)
+
+
+def flatten(v):
+    """Joins a rope into a str, leaving other values untouched"""
+    if type(v) is Rope:
+        return str(v)
+    return v
+
+
+def from_host(v):
+    """Converts a value passed in by the embedding host for use in the VM"""
+    if isinstance(v, array):
+        return Vector(v)
+    return v
+
+
+def to_host(v):
+    """Converts a VM value for the embedding host, without copying vectors"""
+    if type(v) is Vector:
+        return v.array
+    return flatten(v)
+
+
 class _VirtualMachinePartial(object):
     def _pop(self):
         try:
@@ -41,6 +163,37 @@ class Builtins(_VirtualMachinePartial):
     def do_print(self):
         print self._pop()
 
+    def do_vector(self):
+        try:
+            return Vector.from_values(self._pop())
+        except TypeError:
+            raise RuntimeError('vector() needs a sequence of numbers.')
+
+    def do_sum(self):
+        return sum(self._pop())
+
+    def do_min(self):
+        try:
+            return min(self._pop())
+        except ValueError:
+            raise RuntimeError('min() of an empty sequence.')
+
+    def do_max(self):
+        try:
+            return max(self._pop())
+        except ValueError:
+            raise RuntimeError('max() of an empty sequence.')
+
+    def do_dot(self):
+        b = self._pop()
+        a = self._pop()
+        return dot(a, b)
+
+    def do_slice(self):
+        end = self._pop()
+        start = self._pop()
+        return vslice(flatten(self._pop()), start, end)
+
 
 class VirtualMachine(_VirtualMachinePartial):
     """Handles the actual execution of instructions"""
@@ -51,11 +204,27 @@ class VirtualMachine(_VirtualMachinePartial):
         self._ctx_stack = []
         self._globals = {}
         self._builtins = Builtins(self)
+        # Index of the function being run, or None for the toplevel
+        self._func_idx = None
+
+    def get_global(self, global_idx):
+        """Reads a global for the embedding host"""
+        try:
+            return to_host(self._globals[global_idx])
+        except KeyError:
+            raise RuntimeError('Invalid global index %d.' % global_idx)
+
+    def set_global(self, global_idx, value):
+        """Sets a global from the embedding host"""
+        self._globals[global_idx] = from_host(value)
 
     def add(self):
         l = self._pop()
         r = self._pop()
-        self._push(l + r)
+        if type(l) in STRING_TYPES and type(r) in STRING_TYPES:
+            self._push(concat(l, r))
+        else:
+            self._push(l + r)
 
     def sub(self):
         l = self._pop()
@@ -68,20 +237,56 @@ class VirtualMachine(_VirtualMachinePartial):
         self._push(l / r)
 
     def mult(self):
-        l = self._pop()
-        r = self._pop()
+        l = flatten(self._pop())
+        r = flatten(self._pop())
         self._push(l * r)
 
+    # Specialized for operands known to be numbers, or strings, so they skip
+    # the checks and flattening of the generic instructions
+    def add_num(self):
+        stack = self._stack
+        try:
+            l = stack.pop()
+            stack[-1] = l + stack[-1]
+        except IndexError:
+            raise RuntimeError('Popped an empty stack.')
+
+    def add_str(self):
+        stack = self._stack
+        try:
+            l = stack.pop()
+            stack[-1] = concat(l, stack[-1])
+        except IndexError:
+            raise RuntimeError('Popped an empty stack.')
+
+    def mult_num(self):
+        stack = self._stack
+        try:
+            l = stack.pop()
+            stack[-1] = l * stack[-1]
+        except IndexError:
+            raise RuntimeError('Popped an empty stack.')
+
+    def cmp_num(self, op):
+        stack = self._stack
+        try:
+            l = stack.pop()
+            stack[-1] = Compare.cmp(op, l, stack[-1])
+        except IndexError:
+            raise RuntimeError('Popped an empty stack.')
+
     def retn(self):
         raise Return()
 
     def call(self, idx):
         try:
-            func_instr = self.am._funcs[idx]
+            func_instr = self.am._func(idx)
         except IndexError:
             raise RuntimeError('Function %d does not exist.' % idx)
 
         old_ip = self._ip
+        old_func_idx = self._func_idx
+        self._func_idx = idx
         self._ctx_stack.append({})
         try:
             self.execute(func_instr)
@@ -89,6 +294,7 @@ class VirtualMachine(_VirtualMachinePartial):
             pass
         self._ctx_stack.pop()
         self._ip = old_ip
+        self._func_idx = old_func_idx
 
     def store_var(self, local_idx):
         try:
@@ -101,7 +307,7 @@ class VirtualMachine(_VirtualMachinePartial):
 
     def load_const(self, const_idx):
         try:
-            self._push(self.am._consts[const_idx])
+            self._push(self.am._const(const_idx))
         except IndexError:
             raise RuntimeError('Invalid constant index %d.' % const_idx)
 
@@ -128,6 +334,9 @@ class VirtualMachine(_VirtualMachinePartial):
     def make_function(self):
         raise RuntimeError('MAKE_FUNCTION instruction should never be executed.')
 
+    def extended_arg(self, arg):
+        raise RuntimeError('EXTENDED_ARG instruction should never be executed.')
+
     def call_builtin(self, builtin_idx):
         self._builtins.call(builtin_idx)
 
@@ -149,143 +358,808 @@ class VirtualMachine(_VirtualMachinePartial):
         self._ip = local_ptr - 1
 
     def cmp(self, op):
-        self._push(Compare.cmp(op, self._pop(), self._pop()))
+        self._push(Compare.cmp(op, flatten(self._pop()),
+                               flatten(self._pop())))
+
+    def _pop_n(self, n):
+        if n > len(self._stack):
+            raise RuntimeError('Popped an empty stack.')
+        if not n:
+            return []
+        items = self._stack[-n:]
+        del self._stack[-n:]
+        return items
+
+    def build_list(self, size):
+        self._push(self._pop_n(size))
+
+    def build_map(self, size):
+        items = self._pop_n(size * 2)
+        keys = [flatten(k) for k in items[::2]]
+        self._push(dict(zip(keys, items[1::2])))
+
+    def load_index(self):
+        container = flatten(self._pop())
+        index = flatten(self._pop())
+        try:
+            self._push(container[index])
+        except (IndexError, KeyError):
+            raise RuntimeError('Invalid index %r.' % (index,))
+        except TypeError:
+            raise RuntimeError('%s is not indexable.' %
+                               type(container).__name__)
+
+    def store_index(self):
+        container = self._pop()
+        index = flatten(self._pop())
+        try:
+            container[index] = self._pop()
+        except IndexError:
+            raise RuntimeError('Invalid index %r.' % (index,))
+        except TypeError:
+            raise RuntimeError('%s does not support index assignment.' %
+                               type(container).__name__)
+
+    def pop(self):
+        self._pop()
+
+    def dup(self):
+        v = self._pop()
+        self._push(v)
+        self._push(v)
+
+    def len(self):
+        try:
+            self._push(len(self._pop()))
+        except TypeError:
+            raise RuntimeError('Value has no length.')
 
     def execute(self, instructions):
         self._ip = 0
-        while self._ip < len(instructions):
-            instr, arg = instructions[self._ip]
-            try:
-                instr_name = Instr._names[instr]
-                f = getattr(self, instr_name)
-            except KeyError:
-                raise RuntimeError('Unknown instruction type %d' % instr)
-            except AttributeError:
-                raise NotImplementedError()
+        try:
+            while (self._ip < len(instructions) or
+                   self.am._wait_for(instructions, self._ip)):
+                instr, arg = instructions[self._ip]
+                try:
+                    instr_name = Instr._names[instr]
+                    f = getattr(self, instr_name)
+                except KeyError:
+                    raise RuntimeError('Unknown instruction type %d' % instr)
+                except AttributeError:
+                    raise NotImplementedError()
 
-            if instr in Instr.NO_PARAMS:
-                f()
-            else:
-                f(arg)
+                if instr in Instr.NO_PARAMS:
+                    f()
+                else:
+                    f(arg)
 
-            self._ip += 1
+                self._ip += 1
+        except Return:
+            raise
+        except Exception as e:
+            self._add_line(e)
+            raise
+
+    def _add_line(self, e):
+        """Notes the source line being run in an error's message"""
+        if hasattr(e, 'line_no'):
+            # Already noted by the function the error was raised in
+            return
+        e.line_no = self.am.line_for(self._ip, self._func_idx)
+        if (e.line_no is not None and len(e.args) == 1 and
+                isinstance(e.args[0], basestring)):
+            e.args = ('%s (line %d)' % (e.args[0], e.line_no),)
 
 
 class AbstractMachine(object):
     """Decodes bytecode and bootstraps virtual machines."""
 
     def __init__(self, bytecode):
-        self._bc = buffer(bytecode)
+        """
+        @param bytecode: the binary, as a str or mmap. It's decoded in place
+            with struct.unpack_from, so nothing but string constants is copied.
+        """
+        self._bc = bytecode
+        self._bc_len = len(bytecode)
 
-        self._last_read_len = 0
         # Read pointer
         self._rp = 0
+        # Line tables and symbol table, decoded on first use
+        self._lines = None
+        self._symbols = None
 
-        self._funcs = []
-        self._consts = []
+        magic = self._bc[:len(MAGIC)]
+        if magic == MAGIC_V2:
+            self.version = 2
+            self._rp = len(MAGIC_V2)
+            self._read_sections()
+        elif magic == MAGIC:
+            self.version = 1
+            self._rp = len(MAGIC)
+            self._read_const_index()
+            self._read_func_index()
 
-        self._read_magic()
-        self._decode_consts()
-        self._read_funcs()
-        self._first_instr = self._rp
+            self._rp = self._code_start + self._toplevel_offset
+            self._toplevel = self._decode()
+        elif magic == MAGIC_V0:
+            self.version = 0
+            self._rp = len(MAGIC_V0)
+            self._read_v0()
+        else:
+            raise ValueError('Magic constant not found. Invalid bytecode.')
 
-        self._toplevel = self._decode()
+    @classmethod
+    def from_decoded(cls, consts, funcs, toplevel, lines=None,
+                     symbols=None):
+        """
+        Bootstraps from a program already decoded (see decode_all)
 
-    def _read(self, n=1, advance=True):
-        """@rtype: str"""
-        self._last_read_len = n
-        bytes = self._bc[self._rp:self._rp + n]
-        if advance:
-            self._advance()
-        return bytes
+        @param symbols: its symbol table, if it's an object file (see
+            symbol_table)
+        """
+        am = cls.__new__(cls)
+        # There's no binary left to decode anything from, so the format it
+        # came in is no longer known
+        am.version = None
+        am._bc = ''
+        am._bc_len = 0
+        am._sections = {}
+        am._consts = consts
+        am._funcs = funcs
+        am._toplevel = toplevel
+        am._lines = lines or []
+        am._symbols = symbols
+        return am
 
-    def _advance(self, n=None):
-        if n is None:
-            n = self._last_read_len
-        self._rp += n
+    def decode_all(self):
+        """
+        Decodes every constant and function.
 
-    def _read_magic(self):
-        if self._read(4) != MAGIC:
-            raise ValueError('Magic constant not found. Invalid bytecode.')
+        @return: (consts, funcs, toplevel, lines), to pass to from_decoded
+        """
+        for const_idx in xrange(len(self._consts)):
+            self._const(const_idx)
+        for func_idx in xrange(len(self._funcs)):
+            self._func(func_idx)
+        return self._consts, self._funcs, self._toplevel, self._read_lines()
+
+    def line_for(self, ip, func_idx=None):
+        """
+        Maps an instruction to the source line it was compiled from, counting
+        from 1.
+
+        @param ip: index of the instruction in its function
+        @param func_idx: the function, or None for the toplevel
+        @return: the line, or None if the binary doesn't say
+        """
+        lines = self._read_lines()
+        if not lines:
+            return None
+        if func_idx is None:
+            # The toplevel's table comes last
+            table = lines[-1]
+        elif 0 <= func_idx < len(lines) - 1:
+            table = lines[func_idx]
+        else:
+            return None
+        i = bisect_right(table, (ip, float('inf'))) - 1
+        if i >= 0:
+            return table[i][1]
+
+    def symbol_table(self):
+        """
+        @return: the (function names, global names) of an object file, or
+            None for a binary without a symbol table
+        """
+        if (self._symbols is None and self.version == 2 and
+                Section.SYMBOLS in self._sections):
+            start, end = self._sections[Section.SYMBOLS]
+            self._symbols = _decode_symbols(self._bc, start, end)
+        return self._symbols
+
+    def _read_lines(self):
+        if self._lines is None:
+            if self.version == 2 and Section.LINES in self._sections:
+                self._lines = _decode_lines(self._bc,
+                                            *self._sections[Section.LINES])
+            else:
+                self._lines = []
+        return self._lines
+
+    @classmethod
+    def from_file(cls, path):
+        """Memory-maps the binary at path and decodes it"""
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise ValueError('Magic constant not found. Invalid bytecode.')
+            bytecode = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(bytecode)
+
+    def _unpack(self, fmt):
+        """Reads one value of the precompiled struct `fmt`"""
+        try:
+            v, = fmt.unpack_from(self._bc, self._rp)
+        except struct.error:
+            raise ValueError('Unexpected end of code')
+        self._rp += fmt.size
+        return v
 
     def _instr(self, advance=True):
-        byte = self._read(advance=advance)
-        if not byte:
+        if self._rp >= self._bc_len:
             return None
+        instr, = _BYTE.unpack_from(self._bc, self._rp)
+        if advance:
+            self._rp += 1
+        return instr
+
+    def _byte(self):
+        return self._unpack(_BYTE)
+
+    def _unpack_offsets(self, count):
+        fmt = struct.Struct('%dI' % count)
+        try:
+            offsets = fmt.unpack_from(self._bc, self._rp)
+        except struct.error:
+            raise ValueError('Unexpected end of code')
+        self._rp += fmt.size
+        return offsets
+
+    def _read_const_index(self):
+        table_size = self._unpack(_UINT)
+        count = self._unpack(_UINT)
+        self._const_offsets = self._unpack_offsets(count)
+        self._consts_start = self._rp
+        self._consts_end = self._rp + table_size
+        self._consts = [_UNDECODED] * count
+        self._rp = self._consts_end
+
+    def _read_func_index(self):
+        count = self._unpack(_UINT)
+        offsets = self._unpack_offsets(count + 1)
+        self._func_offsets = offsets[:-1]
+        self._toplevel_offset = offsets[-1]
+        # Jump pointers are relative to the start of the code sections
+        self._code_start = self._rp
+        self._funcs = [None] * count
+
+    def _const(self, const_idx):
+        """Returns a constant, decoding it on first use"""
+        v = self._consts[const_idx]
+        if v is _UNDECODED:
+            v = self._consts[const_idx] = self._decode_const(const_idx)
+        return v
+
+    def _decode_const(self, const_idx):
+        if self.version == 2:
+            start, length = self._string_spans[self._const_strings[const_idx]]
+            return self._bc[start:start + length]
+
+        self._rp = self._consts_start + self._const_offsets[const_idx]
+        typ = self._byte()
+        if typ == Const.INT:
+            return self._unpack(_INT)
+        elif typ == Const.FLOAT:
+            return self._unpack(_FLOAT)
+        elif typ == Const.STRING:
+            nul = self._bc.find('\0', self._rp, self._consts_end)
+            if nul == -1:
+                raise ValueError('Unterminated string.')
+            return self._bc[self._rp:nul]
         else:
-            return struct.unpack('B', byte)[0]
-    _byte = _instr
+            raise TypeError('Unknown constant type %d' % typ)
 
-    def _short(self):
-        short = self._read(2)
-        return struct.unpack('H', short)[0]
+    def _func(self, func_idx):
+        """Returns a function's instructions, decoding them on first CALL"""
+        func_instr = self._funcs[func_idx]
+        if func_instr is None and self.version == 2:
+            func_instr = self._funcs[func_idx] = self._decode_v2(
+                *self._func_spans[func_idx])
+        elif func_instr is None:
+            self._rp = self._code_start + self._func_offsets[func_idx]
+            if self._instr() != Instr.PROC:
+                raise ValueError('Function %d does not begin with PROC' %
+                                 func_idx)
+            func_instr = self._funcs[func_idx] = self._decode(
+                Instr.MAKE_FUNCTION)
+        return func_instr
 
-    def _decode_consts(self):
-        table_size, = struct.unpack('I', self._read(4))
-        if table_size == 0:
-            return
+    def _decode(self, until=None, jump_fmt=_UINT):
+        offs_rps = {}
+        repl_offs = []
+        instructions = []
+        extended_arg = 0
+        while True:
+            offs_rps[self._rp] = len(instructions)
+            instr = self._instr()
+            if instr == until:
+                break
+            elif instr is None:
+                raise ValueError('Unexpected end of code')
+
+            if instr == Instr.EXTENDED_ARG:
+                extended_arg = (extended_arg | self._byte()) << 8
+                continue
+            elif instr in Instr.JUMPS:
+                repl_offs.append(len(instructions))
+                pack = (instr, self._code_start + self._unpack(jump_fmt))
+            elif instr in Instr.ONE_PARAM:
+                pack = (instr, extended_arg | self._byte())
+            else:
+                pack = (instr, None)
+            instructions.append(pack)
+            extended_arg = 0
+
+        for i in repl_offs:
+            instr, rp = instructions[i]
+            try:
+                instructions[i] = (instr, offs_rps[rp])
+            except KeyError:
+                raise ValueError('Invalid jump')
+
+        return instructions
 
-        consts_end = self._rp + table_size
+    #############
+    # Version 0 #
+    #############
+    def _read_v0(self):
+        """
+        Decodes a binary in the original layout all at once: without indexes,
+        the only way to find a function is to decode those before it.
+        """
+        consts_end = self._unpack(_UINT) + self._rp
+        self._consts = []
         while self._rp < consts_end:
             typ = self._byte()
             if typ == Const.INT:
-                v, = struct.unpack('I', self._read(4))
+                v = self._unpack(_INT)
             elif typ == Const.FLOAT:
-                v, = struct.unpack('f', self._read(4))
+                v = self._unpack(_FLOAT)
             elif typ == Const.STRING:
-                start = self._bc[self._rp:]
-                try:
-                    nul = start.index('\0')
-                except IndexError:
+                nul = self._bc.find('\0', self._rp, consts_end)
+                if nul == -1:
                     raise ValueError('Unterminated string.')
-                v = start[:nul]
-                self._advance(nul + 1)
+                v = self._bc[self._rp:nul]
+                self._rp = nul + 1
             else:
                 raise TypeError('Unknown constant type %d' % typ)
-
             self._consts.append(v)
 
-    def _read_funcs(self):
-        while True:
-            proc = self._instr(False)
-            if proc != Instr.PROC:
-                return
-            self._advance()
-
-            func_instr = self._decode(Instr.MAKE_FUNCTION)
-            self._funcs.append(func_instr)
-
-    def _decode(self, until=None):
-            offs_rps = {}
-            repl_offs = []
-            instructions = []
+        # Jump pointers are 16-bit, and relative to the start of the code
+        self._code_start = self._rp
+        self._funcs = []
+        while self._instr(False) == Instr.PROC:
+            self._rp += 1
+            self._funcs.append(self._decode(Instr.MAKE_FUNCTION, _USHORT))
+        self._toplevel = self._decode(jump_fmt=_USHORT)
+
+    #############
+    # Version 2 #
+    #############
+    def _varint(self):
+        n = shift = 0
+        try:
             while True:
-                offs_rps[self._rp] = len(instructions)
-                instr = self._instr()
-                if instr == until:
-                    break
+                byte = ord(self._bc[self._rp])
+                self._rp += 1
+                n |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    return n
+                shift += 7
+        except IndexError:
+            raise ValueError('Unexpected end of code')
 
-                if instr in Instr.JUMPS:
-                    repl_offs.append(len(instructions))
-                    pack = (instr, self._first_instr + self._short())
-                elif instr in Instr.ONE_PARAM:
-                    pack = (instr, self._byte())
-                else:
-                    pack = (instr, None)
-                instructions.append(pack)
+    def _read_sections(self):
+        entries = []
+        for _ in xrange(self._varint()):
+            section_id = self._byte()
+            entries.append((section_id, self._varint()))
+
+        self._sections = {}
+        offset = self._rp
+        for section_id, length in entries:
+            self._sections[section_id] = (offset, offset + length)
+            offset += length
+        if offset > self._bc_len:
+            raise ValueError('Unexpected end of code')
+        for section_id in (Section.STRINGS, Section.CONSTS, Section.FUNCS,
+                           Section.CODE):
+            if section_id not in self._sections:
+                raise ValueError('Missing section %d' % section_id)
+
+        self._read_strings()
+        self._read_consts()
+        self._read_func_lengths()
+        self._toplevel = self._decode_v2(*self._sections[Section.CODE])
+
+    def _read_strings(self):
+        """Finds the span of each string in the pool, without copying them"""
+        self._rp, end = self._sections[Section.STRINGS]
+        self._string_spans = spans = []
+        for _ in xrange(self._varint()):
+            length = self._varint()
+            spans.append((self._rp, length))
+            self._rp += length
+        if self._rp != end:
+            raise ValueError('Malformed string pool')
+
+    def _read_consts(self):
+        self._rp, end = self._sections[Section.CONSTS]
+        self._consts = []
+        # Map of string constant indices to their string pool index
+        self._const_strings = {}
+        for const_idx in xrange(self._varint()):
+            typ = self._byte()
+            if typ == Const.INT:
+                self._consts.append(unzigzag(self._varint()))
+            elif typ == Const.FLOAT:
+                self._consts.append(self._unpack(_DOUBLE))
+            elif typ == Const.STRING:
+                string_idx = self._varint()
+                if string_idx >= len(self._string_spans):
+                    raise ValueError('Invalid string index %d' % string_idx)
+                self._const_strings[const_idx] = string_idx
+                self._consts.append(_UNDECODED)
             else:
-                if until is not None:
-                    raise ValueError('Unexpected end of code')
+                raise TypeError('Unknown constant type %d' % typ)
+        if self._rp != end:
+            raise ValueError('Malformed constants table')
 
-            for i in repl_offs:
-                instr, rp = instructions[i]
-                try:
-                    instructions[i] = (instr, offs_rps[rp])
-                except IndexError:
-                    raise ValueError('Invalid jump')
+    def _read_func_lengths(self):
+        self._rp, end = self._sections[Section.FUNCS]
+        lengths = [self._varint() for _ in xrange(self._varint())]
+        self._func_spans = []
+        offset = self._rp
+        for length in lengths:
+            self._func_spans.append((offset, offset + length))
+            offset += length
+        if offset != end:
+            raise ValueError('Malformed functions section')
+        self._funcs = [None] * len(lengths)
 
-            return instructions
+    def _decode_v2(self, start, end):
+        return _decode_instructions(self._bc, start, end)
 
-    def run(self):
+    def _wait_for(self, instructions, ip):
+        """
+        Called when the VM runs off the end of instructions. Returns whether
+        more are available to continue at ip.
+        """
+        return False
+
+    def run(self, globals=None):
+        """
+        @param globals: map of global indices to values from the embedding
+            host (see BytecodeAssemblyGenerator's host_globals)
+        @return: the VirtualMachine, to read globals back out
+        """
         vm = VirtualMachine(self)
+        if globals:
+            for global_idx, value in globals.iteritems():
+                vm.set_global(global_idx, value)
         vm.execute(self._toplevel)
+        return vm
+
+
+class StreamingMachine(AbstractMachine):
+    """
+    Decodes a version 2 binary while it's being read, from a file-like object
+    or an iterable of chunks, and starts running the toplevel as soon as its
+    first instructions arrive.
+
+    Reading only advances as far as the VM needs: when it runs past the
+    toplevel decoded so far, jumps ahead of it, or calls a function that
+    hasn't arrived yet.
+
+    A stream from the io module, such as io.open(sys.stdin.fileno(), 'rb'),
+    is read with read1, which returns whatever has arrived rather than
+    waiting for a whole chunk. Other file-like objects are read a chunk at a
+    time.
+    """
+
+    def __init__(self, stream, chunk_size=64 * 1024):
+        if hasattr(stream, 'read'):
+            self._chunks = iter(_chunk_reader(stream, chunk_size), '')
+        else:
+            self._chunks = iter(stream)
+        self._chunk_size = chunk_size
+        # Data read from the stream, and how much of it has been consumed
+        self._buf = ''
+        self._buf_pos = 0
+
+        if self._read_exact(len(MAGIC_V2)) != MAGIC_V2:
+            raise ValueError('Magic constant not found. Streaming needs a '
+                             'version 2 binary.')
+        self.version = 2
+
+        self._directory = []
+        for _ in xrange(self._stream_varint()):
+            section_id = ord(self._read_exact(1))
+            self._directory.append((section_id, self._stream_varint()))
+
+        self._section_data = {}
+        self._lines = None
+        self._symbols = None
+        self._consts = []
+        self._funcs = []
+        self._func_bodies = []
+        self._toplevel = []
+        self._code_done = False
+        self._funcs_done = False
+        self._done = False
+        self._steps = self._decode_stream()
+
+        while Section.CONSTS not in self._section_data and self._advance():
+            pass
+        if Section.CONSTS not in self._section_data:
+            raise ValueError('Missing section %d' % Section.CONSTS)
+
+    def _read_exact(self, n):
+        end = self._buf_pos + n
+        if end <= len(self._buf):
+            data = self._buf[self._buf_pos:end]
+            self._buf_pos = end
+            return data
+
+        pieces = [self._buf[self._buf_pos:]]
+        have = len(pieces[0])
+        while have < n:
+            chunk = next(self._chunks, '')
+            if not chunk:
+                raise ValueError('Unexpected end of code')
+            pieces.append(chunk)
+            have += len(chunk)
+        self._buf = ''.join(pieces)
+        self._buf_pos = n
+        return self._buf[:n]
+
+    def _read_some(self, n):
+        """Reads at most n bytes, reading at most one chunk from the stream"""
+        if self._buf_pos >= len(self._buf):
+            chunk = next(self._chunks, '')
+            if not chunk:
+                raise ValueError('Unexpected end of code')
+            self._buf = chunk
+            self._buf_pos = 0
+        end = min(self._buf_pos + n, len(self._buf))
+        data = self._buf[self._buf_pos:end]
+        self._buf_pos = end
+        return data
+
+    def _stream_varint(self):
+        n = shift = 0
+        while True:
+            byte = ord(self._read_exact(1))
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def _advance(self):
+        """Decodes the next piece of the stream. Returns False at its end."""
+        try:
+            next(self._steps)
+            return True
+        except StopIteration:
+            self._done = True
+            return False
+
+    def _decode_stream(self):
+        """Generator decoding the stream, yielding after each piece"""
+        for section_id, length in self._directory:
+            if section_id == Section.CODE:
+                for _ in self._stream_code(length):
+                    yield
+                self._code_done = True
+            elif section_id == Section.FUNCS:
+                for _ in self._stream_funcs(length):
+                    yield
+                self._funcs_done = True
+            elif section_id in (Section.STRINGS, Section.CONSTS,
+                                Section.LINES):
+                self._section_data[section_id] = self._read_exact(length)
+                if section_id == Section.CONSTS:
+                    self._load_consts()
+                yield
+            else:
+                self._read_exact(length)
+
+    def _load_consts(self):
+        if Section.STRINGS not in self._section_data:
+            raise ValueError('The STRINGS section must precede CONSTS')
+        strings = self._section_data[Section.STRINGS]
+        consts = self._section_data[Section.CONSTS]
+        # The decoding of the base class works on these sections in _bc
+        self._bc = strings + consts
+        self._bc_len = len(self._bc)
+        self._sections = {
+            Section.STRINGS: (0, len(strings)),
+            Section.CONSTS: (len(strings), self._bc_len),
+        }
+        self._read_strings()
+        self._read_consts()
+
+    def _stream_code(self, length):
+        # Bytes of an instruction cut off by the end of a chunk
+        pending = ''
+        left = length
+        while left:
+            chunk = self._read_some(min(left, self._chunk_size))
+            left -= len(chunk)
+            data = pending + chunk
+            instructions, used = _decode_instructions(data, 0, len(data),
+                                                      partial=True)
+            self._toplevel.extend(instructions)
+            pending = data[used:]
+            yield
+        if pending:
+            raise ValueError('Unexpected end of code')
+
+    def _stream_funcs(self, length):
+        count = self._stream_varint()
+        lengths = [self._stream_varint() for _ in xrange(count)]
+        if sum(lengths) > length:
+            raise ValueError('Malformed functions section')
+        self._funcs = [None] * count
+        for body_length in lengths:
+            self._func_bodies.append(self._read_exact(body_length))
+            yield
+
+    def _func(self, func_idx):
+        while (func_idx >= len(self._func_bodies) and not self._funcs_done and
+                self._advance()):
+            pass
+        func_instr = self._funcs[func_idx]
+        if func_instr is None:
+            body = self._func_bodies[func_idx]
+            func_instr = self._funcs[func_idx] = _decode_instructions(
+                body, 0, len(body))
+        return func_instr
+
+    def _read_lines(self):
+        if self._lines is None:
+            data = self._section_data.get(Section.LINES)
+            if data is not None:
+                self._lines = _decode_lines(data, 0, len(data))
+            elif self._done:
+                self._lines = []
+            else:
+                # The line tables haven't arrived yet
+                return []
+        return self._lines
+
+    def _wait_for(self, instructions, ip):
+        if instructions is not self._toplevel:
+            return False
+        while ip >= len(instructions) and not self._code_done:
+            if not self._advance():
+                break
+        return ip < len(instructions)
+
+    def decode_all(self):
+        while self._advance():
+            pass
+        if not self._code_done or not self._funcs_done:
+            raise ValueError('Missing section %d' % (
+                Section.FUNCS if self._code_done else Section.CODE))
+        return super(StreamingMachine, self).decode_all()
+
+
+def _decode_instructions(bc, start, end, partial=False):
+    """
+    Decodes the version 2 instructions in bc[start:end].
+
+    @param partial: if True, bc may end partway through an instruction
+    @return: the instructions, or with partial, (instructions, end offset of
+        the last complete instruction)
+    """
+    no_params = _NO_PARAMS
+    rp = instr_start = start
+    instructions = []
+    jumps = []
+    try:
+        while rp < end:
+            instr_start = rp
+            instr = ord(bc[rp])
+            rp += 1
+            if instr in no_params:
+                instructions.append((instr, None))
+                continue
+            if instr in Instr.JUMPS:
+                jumps.append(len(instructions))
+            param = shift = 0
+            while True:
+                byte = ord(bc[rp])
+                rp += 1
+                param |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            instructions.append((instr, param))
+    except IndexError:
+        if partial:
+            return instructions, instr_start
+        raise ValueError('Unexpected end of code')
+    if partial:
+        return instructions, rp
+    if rp != end:
+        raise ValueError('Unexpected end of code')
+
+    for i in jumps:
+        if instructions[i][1] > len(instructions):
+            raise ValueError('Invalid jump')
+    return instructions
+
+
+def _read_varint(bc, rp):
+    """Reads a varint at bc[rp], returning it and the offset after it"""
+    n = shift = 0
+    while True:
+        byte = ord(bc[rp])
+        rp += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, rp
+        shift += 7
+
+
+def _decode_lines(bc, start, end):
+    """
+    Decodes the line tables in bc[start:end], as lists of (instruction index,
+    line) pairs
+    """
+    rp = start
+    lines = []
+    try:
+        count, rp = _read_varint(bc, rp)
+        for _ in xrange(count):
+            table = []
+            index = line_no = 0
+            num_entries, rp = _read_varint(bc, rp)
+            for _ in xrange(num_entries):
+                index_delta, rp = _read_varint(bc, rp)
+                line_delta, rp = _read_varint(bc, rp)
+                index += index_delta
+                line_no += unzigzag(line_delta)
+                table.append((index, line_no))
+            lines.append(table)
+    except IndexError:
+        raise ValueError('Unexpected end of code')
+    if rp != end:
+        raise ValueError('Malformed line tables')
+    return lines
+
+
+def _decode_symbols(bc, start, end):
+    """Decodes the (function names, global names) in bc[start:end]"""
+    rp = start
+    tables = []
+    try:
+        for _ in xrange(2):
+            names = []
+            count, rp = _read_varint(bc, rp)
+            for _ in xrange(count):
+                length, rp = _read_varint(bc, rp)
+                if rp + length > end:
+                    raise IndexError()
+                names.append(bc[rp:rp + length])
+                rp += length
+            tables.append(names)
+    except IndexError:
+        raise ValueError('Unexpected end of code')
+    if rp != end:
+        raise ValueError('Malformed symbol table')
+    return tuple(tables)
+
+
+def _chunk_reader(stream, chunk_size):
+    """Returns a function reading the next chunk of a file-like object"""
+    if hasattr(stream, 'read1'):
+        # What's buffered, or what a single read of the file returns
+        return lambda: stream.read1(chunk_size)
+    return lambda: stream.read(chunk_size)
+
+
+def convert(bytecode, version=FORMAT_VERSION):
+    """Rewrites a binary, of any version including 0, in another version"""
+    return write_program(*AbstractMachine(bytecode).decode_all(),
+                         version=version)